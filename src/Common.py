@@ -22,6 +22,8 @@ class Common:
         self.SET_RESOURCES_PUBLIC = True if '--make_resources_public' in args else False    # Set all modified resources to public
         self.SKIP_QUERIES = True if '--skip_queries' in args else False         # Do not query data for CSV files
         self.SKIP_HYDROSHARE = True if '--skip_hydroshare' in args else False   # Do not modify HydroShare resources
+        self.STREAM_QUERIES = True if '--stream_queries' in args else False     # Write CSV files in QUERY_CHUNK_SIZE pieces
+        self.INCREMENTAL_EXPORT = True if '--incremental_export' in args else False  # Only append new values to existing CSV files
 
         self.IS_WINDOWS = 'nt' in os.name
         self.APP_LOCAL = os.getenv('LOCALAPPDATA') or '/var/lib/h2outility'  # TODO: make this configurable
@@ -32,6 +34,7 @@ class Common:
         self.DATASET_DIR = os.path.abspath(os.path.join(self.USER_APP_DIR, 'datasets'))  # Directory for generated CSV files
         # self.LOGFILE_DIR = '{}/logs/'.format(self.USER_APP_DIR)                  # Directory for log files
         self.LOGFILE_DIR = os.path.abspath(os.path.join(self.USER_APP_DIR, 'logs'))  # Directory for log files
+        self.CATALOG_CACHE_DIR = os.path.abspath(os.path.join(self.USER_APP_DIR, 'catalogs'))  # Directory for cached series catalogs
         self.GUI_MODE = False                                                    # If true, send logs to GUI
 
         """
@@ -54,6 +57,25 @@ class Common:
             self.SETTINGS_FILE_NAME = os.path.join(self.USER_APP_DIR, op_file)  # Settings file name
 
 
+        self.DATASET_WORKERS = max(1, GetIntegerArg(args, '--dataset_workers', 1))  # Number of CSV files generated concurrently
+        self.UPLOAD_WORKERS = max(1, GetIntegerArg(args, '--upload_workers', 4))    # Number of files uploaded concurrently
+        self.UPLOAD_RETRIES = GetIntegerArg(args, '--upload_retries', 3)            # Retries per file before an upload fails
+        self.UPLOAD_BACKOFF = 2                                                     # Seconds to wait before the first retry, doubled on each retry
+        self.UPLOAD_JOURNAL_FLUSH_COUNT = 25                                        # Uploaded files recorded before the upload journal is saved
+        self.UPLOAD_JOURNAL_FLUSH_INTERVAL = 30                                     # Seconds between upload journal saves while files are uploaded
+        self.DB_POOL_SIZE = max(GetIntegerArg(args, '--db_pool_size', 5),
+                                2 * self.DATASET_WORKERS + 1)                       # Database connections kept open per connection string
+        self.DB_POOL_RECYCLE = 3600                                                 # Seconds before a pooled database connection is reopened
+        self.DB_POOL_PRE_PING = True                                                # Test pooled database connections before using them
+        self.DB_CONNECT_TIMEOUT = 8                                                 # Seconds to wait for a database to accept a login
+        self.DB_POOL_TIMEOUT = 5                                                    # Seconds to wait for a free pooled connection, below DB_CONNECT_TIMEOUT
+        self.CONNECTION_VERIFY_TTL = 60                                             # Seconds a successful connection test is remembered
+        self.LOG_QUEUE_SIZE = 10000                                                 # Log messages waiting to be written before printing blocks
+        self.LOG_FLUSH_INTERVAL = 0.5                                               # Seconds the log writer waits for new messages
+        self.LOG_FLUSH_TIMEOUT = 5                                                  # Seconds flushing the log waits for queued messages
+        self.LOG_MAX_BYTES = 10 * 1024 * 1024                                       # Log file size at which a new log file is started
+        self.LOG_BACKUP_COUNT = 5                                                   # Rotated log files kept next to the current one
+
         """
         H2O-specific constants
         """
@@ -79,6 +101,17 @@ Functions used among H2O Services
 """
 
 
+def GetIntegerArg(args, name, default):
+    """
+    Reads an integer command line argument given as `name=value`, e.g. `--dataset_workers=4`
+    """
+    prefix = name + '='
+    for item in args:
+        if item.startswith(prefix):
+            return int(item[len(prefix):])
+    return default
+
+
 def GetSeriesColumnName(series):
     """
     Prints useful information for a given series object.
@@ -14,7 +14,7 @@ from sample import Sample
 from sample_medium_cv import SampleMediumCV
 from sample_type_cv import SampleTypeCV
 from series import Series
-from session_factory import SessionFactory
+from session_factory import SessionFactory, engine_registry
 from site import Site
 from site_type_cv import SiteTypeCV
 from source import Source
@@ -62,5 +62,6 @@ __all__ = [
     'VerticalDatumCV',
     'MemoryDatabase',
     'copy_series',
-    'copy_data_value'
+    'copy_data_value',
+    'engine_registry'
 ]
\ No newline at end of file
@@ -53,12 +53,7 @@ class MemoryDatabase(object):
 
     def getDataValuesforGraph(self, seriesID, noDataValue, startDate=None, endDate=None):
         series = self.series_service.get_series_by_id(seriesID)
-        DataValues = [
-            (dv.data_value, dv.local_date_time, dv.censor_code, dv.local_date_time.strftime('%m'), dv.local_date_time.strftime('%Y') )
-            for dv in series.data_values
-            if dv.data_value != noDataValue if dv.local_date_time >= startDate if dv.local_date_time <= endDate
-        ]
-        return DataValues
+        return self.series_service.get_plot_value_rows(series, noDataValue, startDate, endDate)
 
     def getSeriesCatalog(self):
         sql = "SELECT * FROM SeriesCatalog"
@@ -98,12 +93,9 @@ class MemoryDatabase(object):
     def initEditValues(self, seriesID):
         if not self.editLoaded:
             series = self.series_service.get_series_by_id(seriesID)
-            self.DataValues = [(dv.id, dv.data_value, dv.value_accuracy, dv.local_date_time, dv.utc_offset, dv.date_time_utc,
-                dv.site_id, dv.variable_id, dv.offset_value, dv.offset_type_id, dv.censor_code,
-                dv.qualifier_id, dv.method_id, dv.source_id, dv.sample_id, dv.derived_from_id,
-                dv.quality_control_level_id) for dv in series.data_values]
-
-            self.cursor.executemany("INSERT INTO DataValues VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", self.DataValues)
+            # Copy the values batch by batch, straight from the database rows
+            for rows in self.series_service.get_value_rows_by_series(series):
+                self.cursor.executemany("INSERT INTO DataValues VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
             self.conn.commit()
             self.editLoaded = True
 
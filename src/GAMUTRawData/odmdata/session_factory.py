@@ -1,14 +1,87 @@
+import atexit
+import threading
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker, Session
 
 
+class EngineRegistry():
+    """
+    Keeps one engine, and therefore one connection pool, per connection string for the whole process, so creating a
+    new service reuses the connections that are already open instead of logging in to the database again
+    """
+    def __init__(self, pool_size=5, max_overflow=0, pool_timeout=5, pool_recycle=3600, pool_pre_ping=True,
+                 connect_timeout=None):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout  # Seconds to wait for a free pooled connection before raising TimeoutError
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.connect_timeout = connect_timeout  # Seconds the driver waits to connect and log in, if it supports it
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **pool_settings):
+        """
+        Changes the pool settings used for engines created from now on, e.g. `configure(pool_size=10)`
+        """
+        for name, value in pool_settings.iteritems():
+            if not hasattr(self, name) or name.startswith('_'):
+                raise AttributeError('Unknown engine pool setting: {}'.format(name))
+            setattr(self, name, value)
+
+    def get_engine(self, connection_string, echo=False):
+        with self._lock:
+            engine = self._engines.get((connection_string, echo), None)
+            if engine is None:
+                engine = create_engine(connection_string, **self._engine_arguments(connection_string, echo))
+                self._engines[(connection_string, echo)] = engine
+            return engine
+
+    def _engine_arguments(self, connection_string, echo):
+        arguments = {'encoding': 'utf-8', 'echo': echo, 'pool_pre_ping': self.pool_pre_ping}
+        url = make_url(connection_string)
+
+        # SQLite uses its own pools, which don't take a size or an overflow
+        if url.get_backend_name() != 'sqlite':
+            arguments.update(pool_size=self.pool_size,
+                             max_overflow=self.max_overflow,
+                             pool_timeout=self.pool_timeout,
+                             pool_recycle=self.pool_recycle)
+
+        if self.connect_timeout:
+            if url.get_driver_name() == 'pyodbc':
+                arguments['connect_args'] = {'timeout': self.connect_timeout}
+            elif url.get_backend_name() in ('postgresql', 'mysql'):
+                arguments['connect_args'] = {'connect_timeout': self.connect_timeout}
+        return arguments
+
+    def dispose(self, connection_string):
+        """
+        Closes the pooled connections of one database, e.g. after its connection details changed
+        """
+        with self._lock:
+            for key in [key for key in self._engines if key[0] == connection_string]:
+                self._engines.pop(key).dispose()
+
+    def shutdown(self):
+        """
+        Closes every pooled connection. Runs when the process exits.
+        """
+        with self._lock:
+            for engine in self._engines.itervalues():
+                engine.dispose()
+            self._engines.clear()
+
+
+engine_registry = EngineRegistry()
+atexit.register(engine_registry.shutdown)
+
+
 class SessionFactory():
     def __init__(self, connection_string, echo):
-        self.engine = create_engine(connection_string, encoding='utf-8', echo=echo,
-                                    #pool_size=20,
-                                    pool_recycle=3600,
-                                    pool_timeout=3600,
-                                    max_overflow=0)
+        self.engine = engine_registry.get_engine(connection_string, echo)
 
         # Create session maker
         self.Session = sessionmaker(bind=self.engine)
@@ -1,5 +1,7 @@
 import sqlite3
 
+import numpy as np
+
 from GAMUTRawData.odmdata import SessionFactory
 from GAMUTRawData.odmdata import DataValue
 from GAMUTRawData.odmservices.series_service import SeriesService
@@ -13,7 +15,9 @@ class EditService():
         self._connection = connection
         self._series_id = series_id
         self._filter_from_selection = False
+        self._filter_list = np.zeros(0, dtype=bool)
         self._debug = debug
+        self._clear_changes()
 
         if (connection_string is not ""):
             self._session_factory = SessionFactory(connection_string, debug)
@@ -30,20 +34,22 @@ class EditService():
         self._edit_session = self._session_factory.get_session()
 
         if self._connection == None:
-            series_service = SeriesService(connection_string, False)
-            series = series_service.get_series_by_id(series_id)
-            DataValues = [(dv.id, dv.data_value, dv.value_accuracy, dv.local_date_time, dv.utc_offset, dv.date_time_utc,
-                           dv.site_id, dv.variable_id, dv.offset_value, dv.offset_type_id, dv.censor_code,
-                           dv.qualifier_id, dv.method_id, dv.source_id, dv.sample_id, dv.derived_from_id,
-                           dv.quality_control_level_id) for dv in series.data_values]
+            series = self._series_service.get_series_by_id(series_id)
             self._connection = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
             tmpCursor = self._connection.cursor()
             self.init_table(tmpCursor)
-            tmpCursor.executemany("INSERT INTO DataValues VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", DataValues)
+            # Copy the values batch by batch, straight from the database rows
+            for rows in self._series_service.get_value_rows_by_series(series):
+                tmpCursor.executemany("INSERT INTO DataValues VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
 
         self._connection.commit()
         self._cursor = self._connection.cursor()
 
+        # Created before any edit: the sqlite3 module commits the open transaction before running a CREATE
+        self._cursor.execute("CREATE TEMP TABLE IF NOT EXISTS EditValues "
+                             "(ValueID INTEGER PRIMARY KEY, DataValue FLOAT NOT NULL)")
+        self._cursor.execute("CREATE TEMP TABLE IF NOT EXISTS EditIds (ValueID INTEGER PRIMARY KEY)")
+
         self._populate_series()
         self.reset_filter()
 
@@ -53,12 +59,61 @@ class EditService():
         results = self._cursor.fetchall()
 
         self._series_points = results
-
+        self._set_point_arrays(results)
+
+    def _set_point_arrays(self, points):
+        """
+        Keeps the ids, values and times of the points as NumPy arrays, which the filters work on, and resizes the
+        selection to match
+        """
+        if len(points):
+            ids, values, times = zip(*points)
+        else:
+            ids, values, times = (), (), ()
+
+        self._point_ids = np.array(ids, dtype=np.int64)
+        self._point_values = np.array(values, dtype=np.float64)
+        self._point_times = np.array(times, dtype='datetime64[us]')
+
+        # Points were added or deleted; points past the end of the old selection are not selected
+        length = len(self._point_ids)
+        if len(self._filter_list) != length:
+            filter_list = np.zeros(length, dtype=bool)
+            kept = min(length, len(self._filter_list))
+            filter_list[:kept] = self._filter_list[:kept]
+            self._filter_list = filter_list
+
+    def _clear_changes(self):
+        # ValueIDs of the edit table that changed since the last save; inserted ids only exist in the edit table
+        self._changed_ids = set()
+        self._inserted_ids = set()
+        self._deleted_ids = set()
 
     def _test_filter_previous(self):
         if not self._filter_from_selection:
             self.reset_filter()
 
+    def _apply_filter(self, matches, from_selection):
+        """
+        Selects the points where `matches` is True. When filtering from the selection, points that are not already
+        selected stay unselected.
+        """
+        if from_selection:
+            self._filter_list = self._filter_list & matches
+        else:
+            self._filter_list = matches
+
+    def _select_neighbours(self, matches):
+        """
+        Selects both points of every consecutive pair where `matches` (one entry per pair) is True, and nothing else
+        """
+        if self._filter_from_selection:
+            matches = matches & self._filter_list[:-1]
+
+        self.reset_filter()
+        self._filter_list[:-1] |= matches
+        self._filter_list[1:] |= matches
+
     ###################
     # Filters
     ###################
@@ -67,51 +122,23 @@ class EditService():
         self._test_filter_previous()
 
         if operator == '<':  # less than
-            for i in range(len(self._series_points)):
-                # If it's not already in the selection, skip it
-                if (self._filter_from_selection and not self._filter_list[i]):
-                    continue
-                if self._series_points[i][1] < value:
-                    self._filter_list[i] = True
-                else:
-                    self._filter_list[i] = False
+            self._apply_filter(self._point_values < value, self._filter_from_selection)
         if operator == '>':  # greater than
-            for i in range(len(self._series_points)):
-                if (self._filter_from_selection and not self._filter_list[i]):
-                    continue
-                if self._series_points[i][1] > value:
-                    self._filter_list[i] = True
-                else:
-                    self._filter_list[i] = False
+            self._apply_filter(self._point_values > value, self._filter_from_selection)
 
     def filter_date(self, before, after):
         self._test_filter_previous()
 
         previous_date_filter = False
         if before != None:
-            tmp = []
-            for i in range(len(self._series_points)):
-                if (self._filter_from_selection and not self._filter_list[i]):
-                    continue
-                if self._series_points[i][2] < before:
-                    self._filter_list[i] = True
-                else:
-                    self._filter_list[i] = False
+            self._apply_filter(self._point_times < np.datetime64(before), self._filter_from_selection)
             previous_date_filter = True  # We've done a previous date filter
         if after != None:
-            for i in range(len(self._series_points)):
-                if ((previous_date_filter or self._filter_from_selection)
-                    and not self._filter_list[i]):
-                    continue
-                if self._series_points[i][2] > after:
-                    self._filter_list[i] = True
-                else:
-                    self._filter_list[i] = False
+            self._apply_filter(self._point_times > np.datetime64(after),
+                               previous_date_filter or self._filter_from_selection)
 
     # Data Gaps
     def data_gaps(self, value, time_period):
-        length = len(self._series_points)
-
         value_sec = 0
 
         if time_period == 'second':
@@ -123,48 +150,14 @@ class EditService():
         if time_period == 'day':
             value_sec = value * 60 * 60 * 24
 
-        tmp = {}
-
-        for i in xrange(length):
-            if (self._filter_from_selection and
-                    not self._filter_list[i]):
-                continue
-
-            if i + 1 < length:  # make sure we stay in bounds
-                point1 = self._series_points[i]
-                point2 = self._series_points[i + 1]
-                interval = point2[2] - point1[2]
-                interval_total_sec = interval.total_seconds()
-
-                if interval_total_sec >= value_sec:
-                    tmp[i] = True
-                    tmp[i + 1] = True
-
-        self.reset_filter()
-        for key in tmp.keys():
-            self._filter_list[key] = True
+        intervals = np.diff(self._point_times) / np.timedelta64(1, 's')
+        self._select_neighbours(intervals >= value_sec)
 
     def value_change_threshold(self, value):
-        length = len(self._series_points)
-        tmp = {}
-        for i in xrange(length):
-            if (self._filter_from_selection and
-                    not self._filter_list[i]):
-                continue
-
-            if i + 1 < length:  # make sure we stay in bounds
-                point1 = self._series_points[i]
-                point2 = self._series_points[i + 1]
-                if abs(point1[1] - point2[1]) >= value:
-                    tmp[i] = True
-                    tmp[i + 1] = True
-
-        self.reset_filter()
-        for key in tmp.keys():
-            self._filter_list[key] = True
+        self._select_neighbours(np.abs(np.diff(self._point_values)) >= value)
 
     def select_points_tf(self, tf_list):
-        self._filter_list = tf_list
+        self._filter_list = np.array(tf_list, dtype=bool)
 
     def select_points(self, id_list=[], datetime_list=[]):
         self.reset_filter()
@@ -172,20 +165,23 @@ class EditService():
         # This should be either one or the other. If it's both, id is used first.
         # If neither are set this function does nothing.
         if len(id_list)>0:
-            for i in range(len(self._series_points)):
-                if self._series_points[i][0] in id_list:
-                    self._filter_list[i] = True
+            self._filter_list = np.in1d(self._point_ids, np.array(list(id_list)))
         elif datetime_list != None:
-            for i in range(len(self._series_points)):
-
-                if self._series_points[i][2] in datetime_list:
-                    self._filter_list[i] = True
+            if not len(datetime_list):
+                return
+            try:
+                datetimes = np.array(list(datetime_list), dtype='datetime64[us]')
+                self._filter_list = np.in1d(self._point_times, datetimes)
+            except (TypeError, ValueError):
+                # Not something NumPy can turn into dates, so compare the points' datetimes one by one
+                datetimes = set(datetime_list)
+                self._filter_list = np.array([point[2] in datetimes for point in self._series_points], dtype=bool)
         else:
             pass
 
 
     def reset_filter(self):
-        self._filter_list = [False] * len(self._series_points)
+        self._filter_list = np.zeros(len(self._series_points), dtype=bool)
 
     def toggle_filter_previous(self):
         self._filter_from_selection = not self._filter_from_selection
@@ -203,16 +199,11 @@ class EditService():
 
     def get_filtered_points(self):
         #list of selected points
-        tmp = []
-        for i in range(len(self._series_points)):
-            if self._filter_list[i]:
-                tmp.append(self._series_points[i])
-
-        return tmp
+        return [self._series_points[i] for i in np.flatnonzero(self._filter_list)]
 
     def get_filter_list(self):
         #true or false list the length of the entire series. true indicate the point is selected
-        return self._filter_list
+        return self._filter_list.tolist()
 
     def get_qcl(self, qcl_id):
         return self._series_service.get_qcl_by_id(qcl_id)
@@ -231,26 +222,25 @@ class EditService():
     #################
 
     def change_value(self, value, operator):
-        filtered_points = self.get_filtered_points()
+        value_ids = self._selected_ids()
+        if not len(value_ids):
+            return
         tmp_filter_list = self._filter_list
         query = "UPDATE DataValues SET DataValue = "
         if operator == '+':
-            query += " DataValue + %s " % (value)
+            query += "DataValue + ?"
 
         if operator == '-':
-            query += " DataValue - %s " % (value)
+            query += "DataValue - ?"
 
         if operator == '*':
-            query += " DataValue * %s " % (value)
+            query += "DataValue * ?"
 
         if operator == '=':
-            query += "%s " % (value)
+            query += "?"
 
-        query += "WHERE ValueID IN ("
-        for i in range(len(filtered_points) - 1):
-            query += "%s," % (filtered_points[i][0])
-        query += "%s)" % (filtered_points[-1][0])
-        self._cursor.execute(query)
+        self._execute_for_points(query, value_ids, (value,))
+        self._changed_ids.update(value_ids)
 
         self._populate_series()
         self._filter_list = tmp_filter_list
@@ -259,110 +249,145 @@ class EditService():
         query = "INSERT INTO DataValues (DataValue, ValueAccuracy, LocalDateTime, UTCOffset, DateTimeUTC, OffsetValue, OffsetTypeID, "
         query += "CensorCode, QualifierID, SampleID, SiteID, VariableID, MethodID, SourceID, QualityControlLevelID) "
         query += "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+        # SQLite numbers the new rows after the highest ValueID
+        self._cursor.execute("SELECT MAX(ValueID) FROM DataValues")
+        last_id = self._cursor.fetchone()[0] or 0
         self._cursor.executemany(query, points)
+        self._cursor.execute("SELECT ValueID FROM DataValues WHERE ValueID > ?", (last_id,))
+        self._inserted_ids.update(row[0] for row in self._cursor.fetchall())
+
         self._populate_series()
 
     def delete_points(self):
-        query = "DELETE FROM DataValues WHERE ValueID IN ("
-        filtered_points = self.get_filtered_points()
-        num_filtered_points = len(filtered_points)
-        if num_filtered_points > 0:
-            for i in range(num_filtered_points - 1):  # loop through the second-to-last active point
-                query += "%s," % (filtered_points[i][0])  # append its ID
-            query += "%s)" % (filtered_points[-1][0])  # append the final point's ID and close the set
-
-            # Delete the points from the cursor
-            self._cursor.execute(query)
+        value_ids = self._selected_ids()
+        if len(value_ids) > 0:
+            self._execute_for_points("DELETE FROM DataValues", value_ids)
+            self._mark_deleted(value_ids)
 
             self._populate_series()
 
     def interpolate(self):
-        tmp_filter_list = self._filter_list
-        groups = self.get_selection_groups()
-
-        for group in groups:
-            # determine first and last point for the interpolation
-            first_index = group[0] - 1
-            last_index = group[-1] + 1
-            # ignore this group (which is actually the whole set)
-            # if it includes the first or last point of the series
-            if first_index <= 0 or last_index == len(self._series_points):
-                continue
-
-            first_point = self._series_points[first_index]
-            last_point = self._series_points[last_index]
-            a = 0
-            c = (last_point[2] - first_point[2]).total_seconds()
-            f_a = first_point[1]
-            f_c = last_point[1]
-            update_list = []
-            for i in group:
-                b = (self._series_points[i][2] - first_point[2]).total_seconds()
-                # linear interpolation formula: f(b) = f(a) + ((b-a)/(c-a))*(f(c) - f(a))
-                new_val = f_a + ((b - a) / (c - a)) * (f_c - f_a)
-                point_id = self._series_points[i][0]
-                update_list.append((new_val, point_id))
-            query = "UPDATE DataValues SET DataValue = ? WHERE ValueID = ?"
-            self._cursor.executemany(query, update_list)
-
-        self._populate_series()
-        self._filter_list = tmp_filter_list
+        selected = np.flatnonzero(self._filter_list)
+        if not len(selected):
+            return
+
+        # First and last index of each group of consecutive selected points
+        breaks = np.flatnonzero(np.diff(selected) != 1) + 1
+        group_starts = selected[np.concatenate(([0], breaks))]
+        group_ends = selected[np.concatenate((breaks - 1, [len(selected) - 1]))]
+
+        # determine first and last point for the interpolation of each group
+        first_indices = group_starts - 1
+        last_indices = group_ends + 1
+        # ignore any group that includes the first or last point of the series
+        valid = (first_indices > 0) & (last_indices != len(self._series_points))
+
+        group_numbers = np.repeat(np.arange(len(group_starts)), group_ends - group_starts + 1)
+        in_valid_group = valid[group_numbers]
+        indices = selected[in_valid_group]
+        if not len(indices):
+            return
+        first_indices = first_indices[group_numbers][in_valid_group]
+        last_indices = last_indices[group_numbers][in_valid_group]
+
+        first_times = self._point_times[first_indices]
+        b = (self._point_times[indices] - first_times) / np.timedelta64(1, 's')
+        c = (self._point_times[last_indices] - first_times) / np.timedelta64(1, 's')
+        f_a = self._point_values[first_indices]
+        f_c = self._point_values[last_indices]
+
+        # skip any group whose surrounding points share a timestamp, which leaves nothing to interpolate over
+        spanned = c > 0
+        if not spanned.all():
+            indices, b, c, f_a, f_c = indices[spanned], b[spanned], c[spanned], f_a[spanned], f_c[spanned]
+            if not len(indices):
+                return
+
+        # linear interpolation formula: f(b) = f(a) + ((b-a)/(c-a))*(f(c) - f(a)), with a = 0
+        self._update_values(indices, f_a + (b / c) * (f_c - f_a))
 
     def drift_correction(self, gap_width):
-        tmp_filter_list = self._filter_list
         groups = self.get_selection_groups()
 
         # only perform a drift correction if there's a single group
         if len(groups) == 1:
-            group = groups[0]
-            first_index = group[0]
-            last_index = group[-1]
-            first_point = self._series_points[first_index]
-            last_point = self._series_points[last_index]
-            x_l = (last_point[2] - first_point[2]).total_seconds()
-
-            update_list = []
-            for i in group:
-                point = self._series_points[i]
-                x_i = (point[2] - first_point[2]).total_seconds()
-                # y_n = y_0 + G(x_i / x_l)
-                new_val = point[1] + gap_width * (x_i / x_l)
-                update_list.append((new_val, point[0]))
-            query = "UPDATE DataValues SET DataValue = ? WHERE ValueID = ?"
-            self._cursor.executemany(query, update_list)
+            indices = np.array(groups[0])
+            first_time = self._point_times[indices[0]]
+            x_l = (self._point_times[indices[-1]] - first_time) / np.timedelta64(1, 's')
+            x_i = (self._point_times[indices] - first_time) / np.timedelta64(1, 's')
+            # a single point, or points sharing one timestamp, give nothing to spread the drift over
+            if x_l <= 0:
+                return False
 
-            self._populate_series()
-            self._filter_list = tmp_filter_list
+            # y_n = y_0 + G(x_i / x_l)
+            self._update_values(indices, self._point_values[indices] + gap_width * (x_i / x_l))
 
             return True
         else:
             return False
 
-    def get_selection_groups(self):
-        length = len(self._series_points)
-        found_group = False
-        groups = []
-        cur_group = []
-        for i in range(length):
-            if self._filter_list[i]:
-                if not found_group:
-                    found_group = True
-                cur_group.append(i)  # Append the actual index to the point
-                if i == length - 1:
-                    groups.append(cur_group)
-            elif not self._filter_list[i] and found_group:
-                found_group = False
-                groups.append(cur_group)
-                cur_group = []
-            else:
-                continue
+    def _update_values(self, indices, new_values):
+        """
+        Sets the DataValue of the points at `indices` with a single UPDATE joined to a temporary table of the new
+        values, then patches the points in memory instead of reading the whole series again
+
+        :type indices: numpy.ndarray
+        :type new_values: numpy.ndarray
+        """
+        self._cursor.execute("DELETE FROM EditValues")
+        self._cursor.executemany("INSERT INTO EditValues (ValueID, DataValue) VALUES (?, ?)",
+                                 zip(self._point_ids[indices].tolist(), new_values.tolist()))
+        self._cursor.execute("UPDATE DataValues SET DataValue = "
+                             "(SELECT EditValues.DataValue FROM EditValues WHERE EditValues.ValueID = DataValues.ValueID) "
+                             "WHERE ValueID IN (SELECT ValueID FROM EditValues)")
+        self._cursor.execute("DELETE FROM EditValues")
+        self._changed_ids.update(self._point_ids[indices].tolist())
+
+        self._point_values[indices] = new_values
+        for index, value in zip(indices.tolist(), new_values.tolist()):
+            point = self._series_points[index]
+            self._series_points[index] = (point[0], value, point[2])
 
-        return groups
+    def get_selection_groups(self):
+        # Indices of the selected points, split wherever the next selected point isn't the next point
+        selected = np.flatnonzero(self._filter_list)
+        if not len(selected):
+            return []
+        groups = np.split(selected, np.flatnonzero(np.diff(selected) != 1) + 1)
+        return [group.tolist() for group in groups]
 
     def flag(self, qualifier_id):
-        filtered_points = self.get_filtered_points()
-        query = "UPDATE DataValues SET QualifierID = %s WHERE ValueID = ?" % (qualifier_id)
-        self._cursor.executemany(query, [(str(x[0]),) for x in filtered_points])
+        value_ids = self._selected_ids()
+        if len(value_ids) > 0:
+            self._execute_for_points("UPDATE DataValues SET QualifierID = ?", value_ids, (qualifier_id,))
+            self._changed_ids.update(value_ids)
+
+    def _selected_ids(self):
+        return self._point_ids[self._filter_list].tolist()
+
+    def _execute_for_points(self, statement, value_ids, parameters=()):
+        """
+        Runs an UPDATE or DELETE on DataValues for the points with the given ValueIDs. The ids are loaded into a
+        temporary table that the statement is joined to, so the SQL stays the same size however many points are
+        selected.
+
+        :param statement: the statement without a WHERE clause, e.g. "UPDATE DataValues SET QualifierID = ?"
+        :param parameters: values for the placeholders in `statement`
+        """
+        self._cursor.execute("DELETE FROM EditIds")
+        self._cursor.executemany("INSERT INTO EditIds (ValueID) VALUES (?)", ((value_id,) for value_id in value_ids))
+        self._cursor.execute(statement + " WHERE ValueID IN (SELECT ValueID FROM EditIds)", parameters)
+        self._cursor.execute("DELETE FROM EditIds")
+
+    def _mark_deleted(self, value_ids):
+        for value_id in value_ids:
+            self._changed_ids.discard(value_id)
+            if value_id in self._inserted_ids:
+                # Never saved, so there's nothing to delete from the database
+                self._inserted_ids.discard(value_id)
+            else:
+                self._deleted_ids.add(value_id)
 
     ###################
     # Save/Restore
@@ -370,9 +395,15 @@ class EditService():
 
     def restore(self):
         self._connection.rollback()
+        self._clear_changes()
         self._populate_series()
 
     def save(self, var=None, method=None, qcl=None, isSave=False):
+        if var is None and method is None and qcl is None:
+            # Same series: only the values that changed are written
+            self._save_changes()
+            return
+
         dvs = []
         is_new_series = False
 
@@ -433,15 +464,62 @@ class EditService():
         series.end_date_time_utc = dvs[-1].date_time_utc
         series.value_count = len(dvs)
 
-        if not is_new_series:
-            # delete old dvs
-            old_dvs = series.data_values
-            self._series_service.delete_dvs(old_dvs)
-
         series.data_values = dvs
         self._series_service.save_series(series, dvs, isSave)
            
 
+    def _save_changes(self):
+        """
+        Writes the values that were changed, added or deleted since the last save to the database in one
+        transaction, along with the new begin/end dates and value count of the series
+        """
+        if not (self._changed_ids or self._inserted_ids or self._deleted_ids):
+            return
+
+        updated_rows = self._read_rows(self._changed_ids - self._inserted_ids)
+        inserted_rows = self._read_rows(self._inserted_ids)
+        local_ids = [row.pop('ValueID') for row in inserted_rows]
+
+        series = self._series_service.get_series_by_id(self._series_id)
+        summary = {'value_count': len(self._series_points)}
+        if len(self._series_points):
+            # The points are sorted by LocalDateTime, so only the first and last are read again for their UTC time
+            first_id, last_id = self._series_points[0][0], self._series_points[-1][0]
+            self._cursor.execute("SELECT ValueID, DateTimeUTC FROM DataValues WHERE ValueID IN (?, ?)",
+                                 (first_id, last_id))
+            utc_times = dict(self._cursor.fetchall())
+            summary.update(begin_date_time=self._series_points[0][2],
+                           end_date_time=self._series_points[-1][2],
+                           begin_date_time_utc=utc_times[first_id],
+                           end_date_time_utc=utc_times[last_id])
+
+        new_ids = self._series_service.apply_value_changes(series, self._deleted_ids, updated_rows, inserted_rows,
+                                                           summary)
+
+        if len(new_ids):
+            # Give the new points the ids the database chose, going through negative ids so none of them collide
+            self._cursor.executemany("UPDATE DataValues SET ValueID = ? WHERE ValueID = ?",
+                                     [(-new_id, local_id) for new_id, local_id in zip(new_ids, local_ids)])
+            self._cursor.execute("UPDATE DataValues SET ValueID = -ValueID WHERE ValueID < 0")
+
+        self._connection.commit()
+        self._clear_changes()
+        if len(new_ids):
+            self._populate_series()
+
+    def _read_rows(self, value_ids, batch_size=500):
+        """
+        :return: the rows of the edit table with the given ValueIDs, as dicts of column names to values
+        """
+        value_ids = sorted(value_ids)
+        rows = []
+        for start in range(0, len(value_ids), batch_size):
+            batch = value_ids[start:start + batch_size]
+            self._cursor.execute("SELECT * FROM DataValues WHERE ValueID IN (%s)" % ','.join('?' * len(batch)), batch)
+            columns = [description[0] for description in self._cursor.description]
+            rows.extend(dict(zip(columns, row)) for row in self._cursor.fetchall())
+        return rows
+
     def create_qcl(self, code, definition, explanation):
         return self._series_service.create_qcl(code, definition, explanation)
 
@@ -2,6 +2,8 @@ import csv
 import xml.etree.cElementTree as ET
 import datetime
 
+from GAMUTRawData.odmdata import DataValue
+
 
 class ExportService():
     '''
@@ -18,11 +20,61 @@ class ExportService():
         if series is None:
             return False
 
-        writer = csv.writer(open(filename, 'wb'))
-        print "log_file: ", filename
-        self.write_data_header(writer, utc, site, var, offset, qual, src, qcl)
-        for dv in series.data_values:
-            self.write_data_row(writer, series, dv, utc, site, var, offset, qual, src, qcl)
+        # Columns that are the same for every value are built once
+        series_id = series.id
+        site_columns = [series.site_code]
+        if site:
+            site_columns += [series.site_name, series.site.type, series.site.latitude, series.site.longitude,
+                             series.site.spatial_ref.srs_name]
+        variable_columns = [series.variable_code]
+        if var:
+            variable_columns += [series.variable_name, series.speciation, series.variable_units_name,
+                                 series.variable.variable_unit.abbreviation, series.sample_medium]
+        series_columns = []
+        if src:
+            series_columns += [series.organization, series.source_description, series.citation]
+        if qcl:
+            series_columns += [series.quality_control_level_code, series.quality_control_level.definition,
+                               series.quality_control_level.explanation]
+
+        # A series only uses a handful of offset types and qualifiers, so they are looked up by id
+        offset_types = {}
+        if offset:
+            offset_types = dict((offset_type.id, [offset_type.description, offset_type.unit.name]) for offset_type
+                                in self._series_service.get_offset_types_by_series_id(series.id))
+        qualifiers = {}
+        if qual:
+            qualifiers = dict((qualifier.id, [qualifier.code, qualifier.description]) for qualifier
+                              in self._series_service.get_qualifiers_by_series_id(series.id))
+        missing = ['', '']
+
+        columns = [DataValue.id, DataValue.data_value, DataValue.value_accuracy, DataValue.local_date_time,
+                   DataValue.utc_offset, DataValue.date_time_utc, DataValue.offset_value, DataValue.offset_type_id,
+                   DataValue.censor_code, DataValue.qualifier_id, DataValue.sample_id]
+
+        with open(filename, 'wb') as fout:
+            writer = csv.writer(fout)
+            print "log_file: ", filename
+            self.write_data_header(writer, utc, site, var, offset, qual, src, qcl)
+            for rows in self._series_service.get_value_rows_by_series(series, columns=columns):
+                data = []
+                for value_id, data_value, value_accuracy, local_date_time, utc_offset, date_time_utc, offset_value, \
+                        offset_type_id, censor_code, qualifier_id, sample_id in rows:
+                    row = [series_id, value_id, data_value, value_accuracy, local_date_time]
+                    if utc:
+                        row += [utc_offset, date_time_utc]
+                    row += site_columns
+                    row += variable_columns
+                    row += [offset_value, offset_type_id]
+                    if offset:
+                        row += offset_types.get(offset_type_id, missing)
+                    row += [censor_code, qualifier_id]
+                    if qual:
+                        row += qualifiers.get(qualifier_id, missing)
+                    row += series_columns
+                    row.append(sample_id)
+                    data.append(row)
+                writer.writerows(data)
 
 
     def write_data_row(self, writer, series, dv, utc, site, var, offset, qual, src, qcl):
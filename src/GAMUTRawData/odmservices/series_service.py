@@ -1,8 +1,10 @@
 import logging
 import threading
+from time import time
 
 import pandas
-from sqlalchemy import distinct, func
+from sqlalchemy import BigInteger, and_, bindparam, case, cast, distinct, event, extract, func, select
+from sqlalchemy.orm import joinedload, selectinload
 
 from GAMUTRawData.odmdata import DataValue, Method, ODMVersion, OffsetType, Qualifier, QualityControlLevel, Sample, \
     Series, SessionFactory, Site, Unit, Variable
@@ -15,16 +17,166 @@ class TimeoutException(Exception):
         super(TimeoutException, self).__init__(*args)
 
 
+class StatementCounter(object):
+    """
+    Counts the SQL statements an engine sends to the database while the counter is active. Engines are shared by
+    every service connected to the same database, so statements from other threads are counted too.
+
+
+        with series_service.count_statements() as counter:
+            BuildCsvFile(series_service, series_list)
+        print counter.count
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+        self._lock = threading.Lock()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
+class CatalogCache(object):
+    """
+    Keeps the sites and variables referenced by the series catalog of each database, and its qualifiers, for `ttl`
+    seconds, so filling the GUI lists or writing another file doesn't query the database every time. Entries are
+    keyed by connection string and name.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, connection_string, name):
+        with self._lock:
+            entry = self._entries.get((connection_string, name), None)
+            if entry is None or time() - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, connection_string, name, value):
+        with self._lock:
+            self._entries[(connection_string, name)] = (time(), value)
+
+    def clear(self, connection_string=None):
+        with self._lock:
+            if connection_string is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == connection_string]:
+                del self._entries[key]
+
+
+catalog_cache = CatalogCache()
+
+# Value summaries checksum DataValue in millionths, so smaller edits go unnoticed
+VALUE_CHECKSUM_SCALE = 1000000
+# Censor codes of the ODM controlled vocabulary; any other code counts as 'nc'
+CENSOR_CODE_WEIGHTS = {'lt': 1, 'gt': 2, 'nd': 3, 'pnq': 4}
+
+
 class SeriesService():
+    # Relationships loaded together with a series, by profile name. Each entry is a loader and the path of
+    # relationships it loads, starting at Series.
+    #   catalog:         the site, variable, method, source and quality control level of the series
+    #   header:          catalog, plus everything BuildSeriesFileHeader reads (datum, variable and time units)
+    #   header_selectin: the same as header, with one extra query per relationship instead of joins, which returns
+    #                    fewer rows when many series share the same sites and variables
+    SERIES_LOAD_PROFILES = {
+        'none': [],
+        'catalog': [(joinedload, [Series.site]),
+                    (joinedload, [Series.variable]),
+                    (joinedload, [Series.method]),
+                    (joinedload, [Series.source]),
+                    (joinedload, [Series.quality_control_level])],
+        'header': [(joinedload, [Series.site, Site.spatial_ref]),
+                   (joinedload, [Series.variable, Variable.variable_unit]),
+                   (joinedload, [Series.variable, Variable.time_unit]),
+                   (joinedload, [Series.method]),
+                   (joinedload, [Series.source]),
+                   (joinedload, [Series.quality_control_level])],
+        'header_selectin': [(selectinload, [Series.site, Site.spatial_ref]),
+                            (selectinload, [Series.variable, Variable.variable_unit]),
+                            (selectinload, [Series.variable, Variable.time_unit]),
+                            (selectinload, [Series.method]),
+                            (selectinload, [Series.source]),
+                            (selectinload, [Series.quality_control_level])]
+    }
+
     # Accepts a string for creating a SessionFactory, default uses odmdata/connection.cfg
     def __init__(self, connection_string="", debug=False):
+        self._connection_string = connection_string
         self._session_factory = SessionFactory(connection_string, debug)
         self._edit_session = self._session_factory.get_session()
         self._debug = debug
 
     def reset_session(self):
+        self._edit_session.close()  # Give the connection back to the shared pool
         self._edit_session = self._session_factory.get_session()  # Reset the session in order to prevent memory leaks
 
+    def close(self):
+        """
+        Closes the session and gives its connection back to the engine's pool
+        """
+        self._edit_session.close()
+
+    def clear_catalog_cache(self):
+        """
+        Forgets the cached sites, variables and qualifiers of this database, e.g. after series were added or removed
+        """
+        catalog_cache.clear(self._connection_string)
+
+    def _get_cached_catalog(self, name, query):
+        """
+        Runs `query` unless its result is still in the catalog cache. The objects are detached from this session so
+        they can be shared with the other services connected to the same database, so the query has to load any
+        relationship the callers read.
+
+        :return: a list of the objects, or None if there are none
+        """
+        result = catalog_cache.get(self._connection_string, name)
+        if result is not None:
+            return list(result)
+
+        result = query.all()
+        if not len(result):
+            return None
+
+        for obj in result:
+            self._edit_session.expunge(obj)
+        catalog_cache.put(self._connection_string, name, result)
+        return list(result)
+
+    def count_statements(self):
+        """
+        :return: a StatementCounter for this service's engine, to be used in a `with` block
+        """
+        return StatementCounter(self._session_factory.engine)
+
+    @staticmethod
+    def _series_load_options(profile):
+        """
+        :param profile: a key of SERIES_LOAD_PROFILES
+        :return: a list of query options that load the relationships of the profile
+        """
+        options = []
+        for loader, path in SeriesService.SERIES_LOAD_PROFILES[profile]:
+            option = loader(path[0])
+            for relationship in path[1:]:
+                option = getattr(option, loader.__name__)(relationship)
+            options.append(option)
+        return options
+
     def get_db_version(self):
         return self._edit_session.query(ODMVersion).first().version_number
 
@@ -48,19 +200,13 @@ class SeriesService():
         :return: List[Sites]
         """
         try:
-            site_ids = [x[0] for x in self._edit_session.query(distinct(Series.site_id)).all()]
+            used_site_ids = self._edit_session.query(distinct(Series.site_id))
+            query = self._edit_session.query(Site).filter(Site.id.in_(used_site_ids)) \
+                .options(joinedload(Site.spatial_ref), joinedload(Site.local_spatial_ref))
+            return self._get_cached_catalog('used_sites', query)
         except:
-            site_ids = None
-
-        if not site_ids:
             return None
 
-        Sites = []
-        for site_id in site_ids:
-            Sites.append(self._edit_session.query(Site).filter_by(id=site_id).first())
-
-        return Sites
-
     def get_site_by_id(self, site_id):
         """
         return a Site object that has an id=site_id
@@ -89,23 +235,14 @@ class SeriesService():
         #get list of used variable ids
         :return: List[Variables]
         """
-
         try:
-            var_ids = [x[0] for x in self._edit_session.query(distinct(Series.variable_id)).all()]
+            used_variable_ids = self._edit_session.query(distinct(Series.variable_id))
+            query = self._edit_session.query(Variable).filter(Variable.id.in_(used_variable_ids)) \
+                .options(joinedload(Variable.variable_unit), joinedload(Variable.time_unit))
+            return self._get_cached_catalog('used_variables', query)
         except:
-            var_ids = None
-
-        if not var_ids:
             return None
 
-        Variables = []
-
-        # create list of variables from the list of ids
-        for var_id in var_ids:
-            Variables.append(self._edit_session.query(Variable).filter_by(id=var_id).first())
-
-        return Variables
-
     def get_all_variables(self):
         """
 
@@ -142,16 +279,14 @@ class SeriesService():
         :return: List[Variables]
         """
         try:
-            var_ids = [x[0] for x in self._edit_session.query(distinct(Series.variable_id)).filter_by(
-                    site_code=site_code).all()]
+            site_variable_ids = self._edit_session.query(distinct(Series.variable_id)).filter_by(site_code=site_code)
+            query = self._edit_session.query(Variable).filter(Variable.id.in_(site_variable_ids)) \
+                .options(joinedload(Variable.variable_unit), joinedload(Variable.time_unit))
+            variables = self._get_cached_catalog(u'variables_at_{}'.format(site_code), query)
         except:
-            var_ids = None
+            variables = None
 
-        variables = []
-        for var_id in var_ids:
-            variables.append(self._edit_session.query(Variable).filter_by(id=var_id).first())
-
-        return variables
+        return variables if variables is not None else []
 
     # Unit methods
     def get_all_units(self):
@@ -216,10 +351,10 @@ class SeriesService():
     def get_qualifiers_by_series_details(self, site_id, qc_id, source_id, method_id, var_ids, year=None):
         """
 
-        :param series_id:
+        :param year: only the qualifiers of values in this calendar year, if given
         :return:
         """
-        subquery = self._edit_session.query(DataValue.qualifier_id).outerjoin(
+        q = self._edit_session.query(DataValue.qualifier_id).outerjoin(
                 Series.data_values).filter(Series.site_id == site_id,
                                            DataValue.site_id == site_id,
                                            DataValue.variable_id == var_ids,
@@ -227,9 +362,24 @@ class SeriesService():
                                            DataValue.quality_control_level_id == qc_id,
                                            DataValue.source_id == source_id,
                                            DataValue.method_id == method_id,
-                                           DataValue.qualifier_id != None).distinct().subquery()
+                                           DataValue.qualifier_id != None)
+        subquery = self._filter_values_by_dates(q, year=year).distinct().subquery()
         return self._edit_session.query(Qualifier).join(subquery).distinct().all()
 
+    def get_qualifier_lookup(self):
+        """
+        Reads the whole Qualifiers table, which is small, once and keeps it in the catalog cache so every file written
+        in a run can look its qualifiers up instead of querying the values for them
+
+        :return: dict of QualifierID to [QualifierID, QualifierCode, QualifierDescription]
+        """
+        lookup = catalog_cache.get(self._connection_string, 'qualifier_lookup')
+        if lookup is None:
+            rows = self._edit_session.query(Qualifier.id, Qualifier.code, Qualifier.description).all()
+            lookup = dict((q_id, [q_id, code, description]) for q_id, code, description in rows)
+            catalog_cache.put(self._connection_string, 'qualifier_lookup', lookup)
+        return lookup
+
     # QCL methods
     def get_all_qcls(self):
         return self._edit_session.query(QualityControlLevel).all()
@@ -384,61 +534,57 @@ class SeriesService():
             print 'Unexpected error encountered during query\nType: {}\nError: {}\n\n'.format(type(e), e)
             print e
 
+    @staticmethod
+    def _filter_values_by_dates(q, year=None, starting_date=None, ending_date=None):
+        """
+        Limits a DataValues query to a calendar year and/or to values after `starting_date` and up to `ending_date`
+        """
+        if year is not None:
+            year_start = '{}-01-01 00:00:00'.format(year)
+            year_end = '{}-12-31 23:59:59'.format(year)
+            q = q.filter(DataValue.local_date_time.between(year_start, year_end))
+
+        if starting_date is not None:
+            q = q.filter(DataValue.local_date_time > starting_date)
+
+        if ending_date is not None:
+            q = q.filter(DataValue.local_date_time <= ending_date)
+
+        return q
+
+    def _get_values_by_filters_query(self, site_id, qc_id, source_id, method_ids, var_ids, year=None,
+                                     starting_date=None, ending_date=None):
+        """
+        Builds the DataValues query shared by `get_values_by_filters` and `get_value_chunks_by_filters`
+
+        :return: sqlalchemy Query
+        """
+        if qc_id != 0 or len(var_ids) == 1 or len(method_ids) == 1:
+            query_items = self._edit_session.query(DataValue.date_time_utc, DataValue.local_date_time,
+                                                   DataValue.utc_offset, DataValue.data_value,
+                                                   DataValue.qualifier_id, DataValue.censor_code, Variable.code,
+                                                   DataValue.method_id)
+        else:
+            query_items = self._edit_session.query(DataValue.date_time_utc, DataValue.local_date_time,
+                                                   DataValue.utc_offset, DataValue.data_value, Variable.code,
+                                                   DataValue.method_id)
+
+        q = query_items.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
+                               DataValue.variable_id == Variable.id,
+                               DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
+                               DataValue.method_id.in_(method_ids))
+
+        return self._filter_values_by_dates(q, year=year, starting_date=starting_date, ending_date=ending_date)
+
     def get_values_by_filters(self, site_id, qc_id, source_id, method_ids, var_ids, year=None, starting_date=None,
-                              chunk_size=250000, timeout=100000, is_retry=False):
+                              chunk_size=250000, timeout=100000, is_retry=False, ending_date=None):
         try:
-            if qc_id != 0 or len(var_ids) == 1 or len(method_ids) == 1:
-                query_items = self._edit_session.query(DataValue.date_time_utc, DataValue.local_date_time,
-                                                       DataValue.utc_offset, DataValue.data_value,
-                                                       DataValue.qualifier_id, DataValue.censor_code, Variable.code,
-                                                       DataValue.method_id)
-            else:
-                query_items = self._edit_session.query(DataValue.date_time_utc, DataValue.local_date_time,
-                                                       DataValue.utc_offset, DataValue.data_value, Variable.code,
-                                                       DataValue.method_id)
-
-            if year is None and starting_date is None:
-                q = query_items.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
-                                       DataValue.variable_id == Variable.id,
-                                       DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
-                                       DataValue.method_id.in_(method_ids))
-
-            elif year is not None and starting_date is None:
-                year_start = '{}-01-01 00:00:00'.format(year)
-                year_end = '{}-12-31 23:59:59'.format(year)
-                q = query_items.filter(DataValue.local_date_time.between(year_start, year_end),
-                                       DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
-                                       DataValue.variable_id == Variable.id,
-                                       DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
-                                       DataValue.method_id.in_(method_ids))
-
-            elif year is None and starting_date is not None:
-                q = query_items.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
-                                       DataValue.variable_id == Variable.id,
-                                       DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
-                                       DataValue.method_id.in_(method_ids),
-                                       DataValue.local_date_time > starting_date)
-
-            else:
-                year_start = '{}-01-01 00:00:00'.format(year)
-                year_end = '{}-12-31 23:59:59'.format(year)
-                q = query_items.filter(DataValue.local_date_time.between(year_start, year_end),
-                                       DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
-                                       DataValue.variable_id == Variable.id,
-                                       DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
-                                       DataValue.method_id.in_(method_ids),
-                                       DataValue.local_date_time > starting_date)
+            q = self._get_values_by_filters_query(site_id, qc_id, source_id, method_ids, var_ids, year=year,
+                                                  starting_date=starting_date, ending_date=ending_date)
 
             query = q.statement.compile(dialect=self._session_factory.engine.dialect)
 
             return pandas.read_sql_query(query, self._session_factory.engine, params=query.params, coerce_float=True)
-
-            # result = None
-            # for chunk in pandas.read_sql_query(sql=query, con=self._session_factory.engine, params=query.params,
-            #                                    coerce_float=True, chunksize=chunk_size):
-            #     result = chunk if result is None else pandas.concat([result, chunk], copy=False)
-            #
-            # return result
         except MemoryError as e:
             print 'Memory Error encountered during query!!\nError: {}\n'.format(type(e), e)
         except TimeoutException as e:
@@ -448,11 +594,108 @@ class SeriesService():
             else:
                 print 'First query timed out - retrying'
                 return self.get_values_by_filters(site_id, qc_id, source_id, method_ids, var_ids, year=year,
-                                                  chunk_size=chunk_size, timeout=timeout, is_retry=True)
+                                                  starting_date=starting_date, chunk_size=chunk_size,
+                                                  timeout=timeout, is_retry=True, ending_date=ending_date)
         except Exception as e:
             print 'Unexpected error encountered during query\nType: {}\nError: {}\n\n'.format(type(e), e)
             print e
 
+    def get_value_chunks_by_filters(self, site_id, qc_id, source_id, method_ids, var_ids, year=None,
+                                    starting_date=None, chunk_size=250000, ending_date=None):
+        """
+        Streaming version of `get_values_by_filters`. Values are ordered by LocalDateTime, UTCOffset and DateTimeUTC
+        and fetched from a server-side cursor where the driver supports it, so at most `chunk_size` rows are held in
+        memory at once.
+
+        :return: generator of pandas.DataFrame, each with at most `chunk_size` rows
+        """
+        q = self._get_values_by_filters_query(site_id, qc_id, source_id, method_ids, var_ids, year=year,
+                                              starting_date=starting_date, ending_date=ending_date)
+        q = q.order_by(DataValue.local_date_time, DataValue.utc_offset, DataValue.date_time_utc)
+
+        engine = self._session_factory.engine
+        query = q.statement.compile(dialect=engine.dialect)
+
+        connection = engine.connect().execution_options(stream_results=True)
+        try:
+            for chunk in pandas.read_sql_query(query, connection, params=query.params, coerce_float=True,
+                                               chunksize=chunk_size):
+                yield chunk
+        finally:
+            connection.close()
+
+    def get_value_summary_by_filters(self, site_id, qc_id, source_id, method_ids, var_ids, year=None,
+                                     ending_date=None):
+        """
+        Summarizes the values matching the filters for each variable and method. Incremental exports compare these
+        summaries between runs to find values inserted, removed or edited behind the last exported timestamp.
+
+        The checksums are sums that change when a DataValue, QualifierID or CensorCode is updated in place. Qualifier
+        and censor codes are weighted by ValueID, so moving one from a value to another is noticed too. They are
+        plain integer sums so every supported database gives the same result for the same values.
+
+        :return: dict of (VariableID, MethodID) -> (value count, highest ValueID, latest LocalDateTime,
+                 DataValue checksum, QualifierID checksum, CensorCode checksum)
+        """
+        row_weight = DataValue.id % 1009 + 1
+        censor_weight = case([(DataValue.censor_code == code, weight) for code, weight in CENSOR_CODE_WEIGHTS.items()],
+                             else_=0)
+        q = self._edit_session.query(DataValue.variable_id, DataValue.method_id, func.count(DataValue.id),
+                                     func.max(DataValue.id), func.max(DataValue.local_date_time),
+                                     func.sum(cast(DataValue.data_value * VALUE_CHECKSUM_SCALE, BigInteger)),
+                                     func.sum(func.coalesce(DataValue.qualifier_id, 0) * row_weight),
+                                     func.sum(censor_weight * row_weight))
+        q = q.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
+                     DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
+                     DataValue.method_id.in_(method_ids))
+        q = self._filter_values_by_dates(q, year=year, ending_date=ending_date)
+        q = q.group_by(DataValue.variable_id, DataValue.method_id)
+
+        summary = {}
+        for row in q.all():
+            variable_id, method_id, count, max_value_id, max_date = row[:5]
+            # Some drivers return the sums as Decimal
+            checksums = tuple(int(checksum) for checksum in row[5:])
+            summary[(variable_id, method_id)] = (count, max_value_id, max_date) + checksums
+        return summary
+
+    def get_value_columns_by_filters(self, site_id, qc_id, source_id, method_ids, var_ids, year=None,
+                                     starting_date=None, ending_date=None):
+        """
+        Finds the variables and methods that have values matching the filters, i.e. the columns of a file built from
+        these values, without reading the values themselves
+
+        :return: set of (VariableID, MethodID)
+        """
+        q = self._edit_session.query(DataValue.variable_id, DataValue.method_id)
+        q = q.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
+                     DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
+                     DataValue.method_id.in_(method_ids))
+        q = self._filter_values_by_dates(q, year=year, starting_date=starting_date, ending_date=ending_date)
+        q = q.group_by(DataValue.variable_id, DataValue.method_id)
+
+        return set([(variable_id, method_id) for variable_id, method_id in q.all()])
+
+    def get_value_columns_by_year(self, site_id, qc_id, source_id, method_ids, var_ids, starting_date=None,
+                                  ending_date=None):
+        """
+        `get_value_columns_by_filters` for each calendar year of LocalDateTime, from one grouped query
+
+        :return: dict of year -> set of (VariableID, MethodID)
+        """
+        value_year = extract('year', DataValue.local_date_time)
+        q = self._edit_session.query(value_year, DataValue.variable_id, DataValue.method_id)
+        q = q.filter(DataValue.site_id == site_id, DataValue.variable_id.in_(var_ids),
+                     DataValue.quality_control_level_id == qc_id, DataValue.source_id == source_id,
+                     DataValue.method_id.in_(method_ids))
+        q = self._filter_values_by_dates(q, starting_date=starting_date, ending_date=ending_date)
+        q = q.group_by(value_year, DataValue.variable_id, DataValue.method_id)
+
+        columns = {}
+        for year, variable_id, method_id in q.all():
+            columns.setdefault(int(year), set()).add((variable_id, method_id))
+        return columns
+
     def get_variables_by_site_id_qc(self, variable_id, my_site_id, qc):
         """
 
@@ -511,6 +754,124 @@ class SeriesService():
             print e
             return []
 
+    def get_series_catalog_rows(self, columns, series_ids=None, batch_size=500):
+        """
+        Reads series catalog columns as plain tuples with a Core select, without creating a Series object per row
+
+        :param columns: Series columns to read, e.g. [Series.id, Series.value_count]
+        :param series_ids: only read these SeriesIDs, `batch_size` at a time; defaults to every series
+        :return: list of tuples
+        """
+        connection = self._session_factory.engine.connect()
+        try:
+            if series_ids is None:
+                return [tuple(row) for row in connection.execute(select(columns))]
+
+            series_ids = sorted(series_ids)
+            rows = []
+            for start in range(0, len(series_ids), batch_size):
+                statement = select(columns).where(Series.id.in_(series_ids[start:start + batch_size]))
+                rows.extend(tuple(row) for row in connection.execute(statement))
+            return rows
+        finally:
+            connection.close()
+
+    def get_series_by_odm_ids(self, odm_ids, profile='header'):
+        """
+        Fetches several series in a single query, together with the relationships of a load profile, instead of
+        calling get_series_from_filter once per series
+
+        :param odm_ids: series odm_id strings ('SiteID_VariableID_MethodID_SourceID_QualityControlLevelID')
+        :param profile: a key of SERIES_LOAD_PROFILES
+        :return: dict of odm_id to Series, leaving out any id that isn't in the series catalog
+        """
+        keys = set()
+        for odm_id in odm_ids:
+            keys.add(tuple(int(part) for part in odm_id.split('_')))
+
+        if not len(keys):
+            return {}
+
+        site_ids, variable_ids, method_ids, source_ids, qc_ids = [set(ids) for ids in zip(*keys)]
+        try:
+            query_result = self._edit_session.query(Series) \
+                .filter(Series.site_id.in_(site_ids),
+                        Series.variable_id.in_(variable_ids),
+                        Series.method_id.in_(method_ids),
+                        Series.source_id.in_(source_ids),
+                        Series.quality_control_level_id.in_(qc_ids)) \
+                .options(*self._series_load_options(profile)) \
+                .order_by(Series.id).all()
+        except Exception as e:
+            print e
+            return {}
+
+        # The IN filters match every combination of the ids, so only keep the series that were asked for
+        series_dict = {}
+        for series in query_result:
+            key = (series.site_id, series.variable_id, series.method_id, series.source_id,
+                   series.quality_control_level_id)
+            if key in keys and series.odm_id not in series_dict:
+                series_dict[series.odm_id] = series
+        return series_dict
+
+    # Columns of the DataValues table, in the order of the edit tables built by EditService and MemoryDatabase
+    DATA_VALUE_ROW_COLUMNS = [DataValue.id, DataValue.data_value, DataValue.value_accuracy, DataValue.local_date_time,
+                              DataValue.utc_offset, DataValue.date_time_utc, DataValue.site_id, DataValue.variable_id,
+                              DataValue.offset_value, DataValue.offset_type_id, DataValue.censor_code,
+                              DataValue.qualifier_id, DataValue.method_id, DataValue.source_id, DataValue.sample_id,
+                              DataValue.derived_from_id, DataValue.quality_control_level_id]
+
+    def get_value_rows_by_series(self, series, columns=None, where=None, batch_size=10000):
+        """
+        Reads the values of a series as plain tuples with a Core select, without creating a DataValue object per
+        row. Rows are fetched from a server-side cursor where the driver supports it.
+
+        :param columns: DataValue columns to read; defaults to DATA_VALUE_ROW_COLUMNS
+        :param where: optional extra filter on the values
+        :return: generator of lists of at most `batch_size` tuples, ordered by LocalDateTime
+        """
+        if columns is None:
+            columns = SeriesService.DATA_VALUE_ROW_COLUMNS
+
+        criteria = and_(DataValue.site_id == series.site_id,
+                        DataValue.variable_id == series.variable_id,
+                        DataValue.method_id == series.method_id,
+                        DataValue.source_id == series.source_id,
+                        DataValue.quality_control_level_id == series.quality_control_level_id)
+        if where is not None:
+            criteria = and_(criteria, where)
+        statement = select(columns).where(criteria).order_by(DataValue.local_date_time)
+
+        connection = self._session_factory.engine.connect().execution_options(stream_results=True)
+        try:
+            result = connection.execute(statement)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+        finally:
+            connection.close()
+
+    def get_plot_value_rows(self, series, noDataValue, startDate=None, endDate=None):
+        """
+        :return: list of (DataValue, LocalDateTime, CensorCode, month, year) tuples for the values of a series that
+                 aren't `noDataValue`, within the optional dates, ordered by LocalDateTime
+        """
+        criteria = [DataValue.data_value != noDataValue]
+        if startDate is not None:
+            criteria.append(DataValue.local_date_time >= startDate)
+        if endDate is not None:
+            criteria.append(DataValue.local_date_time <= endDate)
+
+        rows = []
+        for batch in self.get_value_rows_by_series(series, [DataValue.data_value, DataValue.local_date_time,
+                                                            DataValue.censor_code], and_(*criteria)):
+            rows.extend((value, date, censor_code, date.strftime('%m'), date.strftime('%Y'))
+                        for value, date, censor_code in batch)
+        return rows
+
     # Data Value Methods
     def get_values_by_series(self, series_id):
         '''
@@ -639,12 +1000,7 @@ class SeriesService():
         """
         series = self.get_series_by_id(seriesID)
 
-        DataValues = [
-            (dv.data_value, dv.local_date_time, dv.censor_code, dv.local_date_time.strftime('%m'),
-             dv.local_date_time.strftime('%Y'))
-            for dv in series.data_values
-            if dv.data_value != noDataValue if dv.local_date_time >= startDate if dv.local_date_time <= endDate
-        ]
+        DataValues = self.get_plot_value_rows(series, noDataValue, startDate, endDate)
         data = pandas.DataFrame(DataValues, columns=["DataValue", "LocalDateTime", "CensorCode", "Month", "Year"])
         data.set_index(data['LocalDateTime'], inplace=True)
         data["Season"] = data.apply(self.calcSeason, axis=1)
@@ -679,6 +1035,7 @@ class SeriesService():
         merged_series = self._edit_session.merge(series)
         self._edit_session.add(merged_series)
         self._edit_session.commit()
+        self.clear_catalog_cache()
 
     def update_dvs(self, dv_list):
         """
@@ -690,6 +1047,55 @@ class SeriesService():
         self._edit_session.add_all(merged_dv_list)
         self._edit_session.commit()
 
+    def apply_value_changes(self, series, deleted_ids, updated_rows, inserted_rows, summary, batch_size=500):
+        """
+        Saves the changes of an edit session to an existing series in one transaction: the deleted, updated and
+        inserted values, and the new begin/end dates and value count of the series
+
+        :param deleted_ids: ValueIDs of the values to delete
+        :param updated_rows: dicts of DataValues column names to values, with the ValueID of the value to update
+        :param inserted_rows: dicts of DataValues column names to values, without a ValueID
+        :param summary: dict of Series attributes to set, e.g. {'value_count': 10, 'end_date_time': ...}
+        :param batch_size: number of ids per DELETE, kept well under the parameter limit of SQL Server
+        :return: the ValueIDs the database gave the inserted rows, in the same order
+        """
+        table = DataValue.__table__
+        session = self._edit_session
+        try:
+            deleted_ids = sorted(deleted_ids)
+            for start in range(0, len(deleted_ids), batch_size):
+                batch = deleted_ids[start:start + batch_size]
+                session.execute(table.delete().where(table.c.ValueID.in_(batch)))
+
+            if len(updated_rows):
+                # Bound parameters can't share a name with the columns they set
+                columns = [column.name for column in table.c if column.name != 'ValueID']
+                statement = table.update() \
+                    .where(table.c.ValueID == bindparam('_ValueID')) \
+                    .values(dict((name, bindparam('_' + name)) for name in columns))
+                session.execute(statement, [dict(('_' + name, value) for name, value in row.iteritems())
+                                            for row in updated_rows])
+
+            # One statement per row to get each new ValueID back; rows are only added by hand, so there are few
+            inserted_ids = []
+            for row in inserted_rows:
+                result = session.execute(table.insert().values(row))
+                inserted_ids.append(result.inserted_primary_key[0])
+
+            merged_series = session.merge(series)
+            for name, value in summary.iteritems():
+                setattr(merged_series, name, value)
+            session.commit()
+        except Exception as ex:
+            session.rollback()
+            message = "Values were not successfully saved: %s" % ex
+            print message
+            logger.error(message)
+            raise ex
+
+        self.clear_catalog_cache()
+        return inserted_ids
+
     #####################
     #
     # Create functions
@@ -739,6 +1145,7 @@ class SeriesService():
             except Exception as e:
                 self._edit_session.rollback()
                 raise e
+            self.clear_catalog_cache()
 
         logger.info("A new series was added to the database, series id: " + str(series.id))
         return True
@@ -772,6 +1179,7 @@ class SeriesService():
 
         self._edit_session.add(series)
         self._edit_session.commit()
+        self.clear_catalog_cache()
         return series
 
     def create_method(self, description, link):
@@ -894,6 +1302,7 @@ class SeriesService():
             delete_series = self._edit_session.merge(series)
             self._edit_session.delete(delete_series)
             self._edit_session.commit()
+            self.clear_catalog_cache()
         except Exception as e:
             message = "series was not successfully deleted: %s" % e
             print message
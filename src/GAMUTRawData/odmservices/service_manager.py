@@ -2,7 +2,7 @@ import sys
 import urllib
 import os
 
-from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError
 
 import utilities as util
 from series_service import SeriesService
@@ -64,13 +64,24 @@ class ServiceManager():
         self.__save_connections()
 
     def test_connection(self, conn_dict):
+        """
+        Logs in to the database and reads its ODM version, using a pooled connection when there is one
+
+        :return: True if the database answered, or if every pooled connection to it is in use
+        """
+        service = None
         try:
-            self.version = self.get_db_version(conn_dict)
-        except DBAPIError:
-            pass
-            #print e.message
+            service = SeriesService(self.__build_connection_string(conn_dict))
+            self.version = service.get_db_version()
+        except TimeoutError:
+            # The pool only fills up with connections the database accepted, so it is busy rather than unreachable
+            print('Every connection to the database is in use, it was not tested again')
+            return True
         except SQLAlchemyError:
             return False
+        finally:
+            if service is not None:
+                service.close()
         return True
 
     def delete_connection(self, conn_dict):
@@ -2,6 +2,7 @@ import datetime
 import threading
 from Queue import Queue
 import copy
+from functools import partial
 
 import wx.dataview
 import wx.grid
@@ -14,8 +15,11 @@ from Utilities.HydroShareUtility import HydroShareAccountDetails, HydroShareUtil
     HydroShareResource
 from Common import *
 from Utilities.DatasetUtilities import OdmDatasetConnection, H2OManagedResource
+from Utilities.DatasetWriters import CSV_FORMAT, DATASET_FORMATS, GetDatasetFormatDescription
 from Utilities.H2OServices import H2OService
 from Utilities.H2OSeries import H2OSeries, OdmSeriesHelper, Series
+from Utilities.SeriesCatalogCache import SeriesCatalogCache
+from Utilities.SeriesSearchIndex import SeriesSearchIndex
 from GAMUTRawData.odmservices import ServiceManager
 from EditConnectionsDialog import DatabaseConnectionDialog
 from EditAccountsDialog import HydroShareAccountDialog
@@ -23,7 +27,7 @@ from WxUtilities import WxHelper, PADDING, ALIGN
 from ResourceTemplatesDialog import HydroShareResourceTemplateDialog
 from InputValidator import *
 from GuiComponents.UIController import UIController
-from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import SQLAlchemyError
 
 service_manager = ServiceManager()
 
@@ -72,6 +76,8 @@ class VisualH2OWindow(wx.Frame):
 
         self.odm_series_dict = {}  # type: dict[str, Series]
         self.h2o_series_dict = {}  # type: dict[str, H2OSeries]
+        self._catalog_refresh_id = 0  # Refreshes started for an earlier connection are ignored when they finish
+        self.series_search_index = SeriesSearchIndex()
 
         self._resources = None  # type: dict[str, HydroShareResource]
         self.clean_resource = None
@@ -144,9 +150,21 @@ class VisualH2OWindow(wx.Frame):
         return [sub_tuple[1] for sub_tuple in subscriptions]
 
     def on_log_print(self, message=""):
-        if message is None or len(message) < 4 or message.isspace():
+        if message is None:
             return
-        self.log_message_listbox.Append('{}: {}'.format(datetime.datetime.now().strftime('%H-%M-%S'), message))
+
+        if not wx.IsMainThread():
+            wx.CallAfter(self.on_log_print, message)
+            return
+
+        # The logger sends its messages in batches, one line per message
+        time_string = datetime.datetime.now().strftime('%H-%M-%S')
+        lines = ['{}: {}'.format(time_string, line) for line in message.split('\n')
+                 if len(line) >= 4 and not line.isspace()]
+        if not len(lines):
+            return
+
+        self.log_message_listbox.AppendItems(lines)
         selections = self.log_message_listbox.GetSelections()
         for selection in selections:
             self.log_message_listbox.Deselect(selection)
@@ -238,19 +256,19 @@ class VisualH2OWindow(wx.Frame):
 
     def on_test_database_auth(self, result=None):
 
-        wait = wx.BusyCursor()
-
         if result is None:
             wx.CallAfter(pub.sendMessage, 'db_auth_test_reply', reply='An error occurred, please try again later')
             return
 
-        db_details = OdmDatasetConnection(result)
-        if db_details.VerifyConnection():
-
-            wx.CallAfter(pub.sendMessage, 'db_auth_test_reply', reply='Successfully authenticated!')
+        def on_verified(verified):
+            if verified:
+                wx.CallAfter(pub.sendMessage, 'db_auth_test_reply', reply='Successfully authenticated!')
+            else:
+                wx.CallAfter(pub.sendMessage, 'db_auth_test_reply', reply='Authentication details were not accepted')
 
-        else:
-            wx.CallAfter(pub.sendMessage, 'db_auth_test_reply', reply='Authentication details were not accepted')
+        # Test in the background so the window keeps responding while the database logs us in
+        db_details = OdmDatasetConnection(result)
+        db_details.VerifyConnectionAsync(on_verified)
 
     def on_remove_hydroshare_auth(self, result=None):
         if result is None:
@@ -349,35 +367,48 @@ class VisualH2OWindow(wx.Frame):
         result = HydroShareAccountDialog(self, self.H2OService.HydroShareConnections,
                                          self.hydroshare_account_choice.GetCurrentSelection()).ShowModal()
 
-    def set_odm_connection(self, connection):
+    def set_odm_connection(self, connection, on_loaded=None):
+        """
+        Switches the series grids to another database. The connection is tested on a background thread so an
+        unreachable server doesn't freeze the window; the series are loaded once it answers.
+
+        :param on_loaded: called on the GUI thread once the series of the database are in the grids
+        """
         self.available_series_grid.Clear()
         self.selected_series_grid.Clear()
 
+        # Results of a connection picked earlier are ignored when they arrive
+        self._catalog_refresh_id += 1
+        refresh_id = self._catalog_refresh_id
+        self.h2o_series_dict.clear()
+        self.odm_series_dict.clear()
+        self._rebuild_series_search_index()
+        self.odmSeriesUIController.DisableGrids()
+
         if connection is None:
-            self.h2o_series_dict.clear()
-            self.odm_series_dict.clear()
-            self.odmSerisingle_fileesUIController.DisableGrids()
             return
 
-        wait = wx.BusyCursor()
-        busy = wx.BusyInfo("Loading ODM series from database {}".format(connection.name), parent=self.panel)
+        self.on_log_print('Loading ODM series from database {}'.format(connection.name))
+        connection.VerifyConnectionAsync(
+            lambda verified: wx.CallAfter(self._on_odm_connection_verified, refresh_id, connection, verified,
+                                          on_loaded))
+
+    def _on_odm_connection_verified(self, refresh_id, connection, verified, on_loaded=None):
+        if refresh_id != self._catalog_refresh_id:
+            return  # Another database was picked in the meantime
 
-        if connection.VerifyConnection():
-            self.h2o_series_dict.clear()
-            self.odm_series_dict.clear()
+        if verified:
             service_manager._current_connection = connection.ToDict()
             series_service = service_manager.get_series_service()
 
-            try:
-                series_list = series_service.get_all_series()
-            except DBAPIError as e:
-                self.on_log_print('Failed to connect to database: {}'.format(e))
-                return
-
-            for series in series_list:
+            # Show the series cached the last time this database was used, then update them in the background
+            catalog = SeriesCatalogCache(connection)
+            for series in catalog.Load():
                 self.h2o_series_dict[series.odm_id] = OdmSeriesHelper.CreateH2OSeriesFromOdmSeries(series)
                 self.odm_series_dict[series.odm_id] = series
+            self._rebuild_series_search_index()
             self.reset_series_in_grid()
+            self._refresh_series_catalog(connection, catalog, series_service)
 
             # Re-enable controls for ODM series UI elements
             self.odmSeriesUIController.Enable()
@@ -390,13 +421,73 @@ class VisualH2OWindow(wx.Frame):
 
             if mnged_resource and mnged_resource.odm_db_name != current_db:
                 mnged_resource.odm_db_name = current_db
+                self.H2OService.MarkResourceChanged(mnged_resource.resource_id)
 
             self.H2OService.SaveData()
 
+            if on_loaded is not None:
+                on_loaded()
+
         else:
             self.odmSeriesUIController.DisableGrids()
             self.on_log_print('Unable to authenticate using connection {}'.format(connection.name))
 
+    def _refresh_series_catalog(self, connection, catalog, series_service):
+        """
+        Brings the cached series catalog up to date on a background thread, then updates the grids if anything
+        changed
+        """
+        self._catalog_refresh_id += 1
+        refresh_id = self._catalog_refresh_id
+
+        def refresh():
+            try:
+                changed, removed = catalog.Refresh(series_service)
+            except SQLAlchemyError as e:
+                wx.CallAfter(self.on_log_print, 'Failed to load series from database {}: {}'.format(connection.name, e))
+                return
+            finally:
+                series_service.close()
+
+            if len(changed) or len(removed):
+                wx.CallAfter(self._on_series_catalog_refreshed, refresh_id, changed, removed)
+
+        thread = threading.Thread(target=refresh)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _on_series_catalog_refreshed(self, refresh_id, changed, removed):
+        if refresh_id != self._catalog_refresh_id:
+            return  # Another database was picked in the meantime
+
+        for odm_id in removed:
+            self.h2o_series_dict.pop(odm_id, None)
+            self.odm_series_dict.pop(odm_id, None)
+        for series in changed:
+            self.h2o_series_dict[series.odm_id] = OdmSeriesHelper.CreateH2OSeriesFromOdmSeries(series)
+            self.odm_series_dict[series.odm_id] = series
+        self._rebuild_series_search_index()
+
+        # Keep whatever the user moved to the selected grid while the catalog was loading
+        selected_ids = set(self.selected_series_grid.GetSeries())
+        selected_series = [series for odm_id, series in self.odm_series_dict.iteritems() if odm_id in selected_ids]
+        available_series = [series for odm_id, series in self.odm_series_dict.iteritems() if odm_id not in selected_ids]
+
+        self.available_series_grid.Clear()
+        self.selected_series_grid.Clear()
+        self.available_series_grid.InsertSeriesList(available_series, do_sort=True)
+        self.selected_series_grid.InsertSeriesList(selected_series, do_sort=True)
+        self.remove_selected_button.Enable()
+        self.add_to_selected_button.Enable()
+
+    def _rebuild_series_search_index(self):
+        self.series_search_index.Build(self.odm_series_dict)
+        self.on_series_search()
+
+    def on_series_search(self, event=None):
+        odm_ids = self.series_search_index.Search(self.series_search_input.GetValue())
+        self.available_series_grid.SetSeriesFilter(odm_ids)
+
     def __onChangeODMDBConnection(self, data, extra=None, extra1=None):
         self.set_odm_connection(self.H2OService.DatabaseConnections[data])
         self.reset_series_in_grid()
@@ -485,21 +576,19 @@ class VisualH2OWindow(wx.Frame):
         self.add_to_selected_button.Enable()
 
     def _move_to_selected_series(self, event):
-        series_list = [self.odm_series_dict[series_odm_id] for series_odm_id in self.available_series_grid.GetSelectedSeries()]
-        self.selected_series_grid.InsertSeriesList(series_list, do_sort=True)
-        self.available_series_grid.RemoveSelectedRows()
+        self.available_series_grid.MoveSelectedRows(self.selected_series_grid)
 
         mngres = self.get_managed_resource()
         if mngres is not None:
             mngres.selected_series = self.get_selected_series()
+            self.H2OService.MarkResourceChanged(mngres.resource_id)
 
     def _move_to_available_series(self, event):
-        series_list = [self.odm_series_dict[series_omd_id] for series_omd_id in self.selected_series_grid.GetSelectedSeries()]
-        self.available_series_grid.InsertSeriesList(series_list, do_sort=True)
-        self.selected_series_grid.RemoveSelectedRows()
+        self.selected_series_grid.MoveSelectedRows(self.available_series_grid)
 
         mngres = self.get_managed_resource()
         mngres.selected_series = self.get_selected_series()
+        self.H2OService.MarkResourceChanged(mngres.resource_id)
 
     def _get_current_series_ids_from_resource(self, resource):
         if isinstance(resource, H2OManagedResource):
@@ -552,6 +641,7 @@ class VisualH2OWindow(wx.Frame):
             managed_resource = self.H2OService.ManagedResources.get(resource.id, None)  # type: H2OManagedResource
             if managed_resource:
                 managed_resource.associated_files = []
+                self.H2OService.MarkResourceChanged(resource.id)
                 self.H2OService.SaveData()
 
         else:
@@ -596,11 +686,14 @@ class VisualH2OWindow(wx.Frame):
             managed.selected_series = series
             managed.single_file = not self.chunk_by_series_checkbox.IsChecked()
             managed.chunk_years = self.chunk_by_year_checkbox.IsChecked()
+            managed.file_format = self._get_selected_file_format()
             managed.resource_id = resource.id
 
             if selected_db is not None:
                 managed.odm_db_name = selected_db
 
+            self.H2OService.MarkResourceChanged(resource.id)
+
         else:
             managed = H2OManagedResource(resource=resource,
                                          odm_series=series,
@@ -609,7 +702,8 @@ class VisualH2OWindow(wx.Frame):
                                          odm_db_name=selected_db,
                                          single_file=not self.chunk_by_series_checkbox.IsChecked(),
                                          chunk_years=self.chunk_by_year_checkbox.Value,
-                                         associated_files=[])
+                                         associated_files=[],
+                                         file_format=self._get_selected_file_format())
 
             self.H2OService.ManagedResources[resource.id] = managed
 
@@ -644,6 +738,7 @@ class VisualH2OWindow(wx.Frame):
         mngd_resource = managed_resources.get(self._get_selected_resource().id, None)  # type: H2OManagedResource
 
         self.H2OService.ManagedResources[mngd_resource.resource_id].selected_series = self.get_selected_series()
+        self.H2OService.MarkResourceChanged(mngd_resource.resource_id)
 
         #
         # for rid, resource in self.H2OService.ManagedResources.iteritems():  # type: str, H2OManagedResource
@@ -721,8 +816,8 @@ class VisualH2OWindow(wx.Frame):
 
             if managed_resource.odm_db_name in self.H2OService.DatabaseConnections:
                 self.database_connection_choice.SetStringSelection(managed_resource.odm_db_name)
-                self.set_odm_connection(self.H2OService.DatabaseConnections[managed_resource.odm_db_name])
-                self.reset_series_grid_with_resource(managed_resource)
+                self.set_odm_connection(self.H2OService.DatabaseConnections[managed_resource.odm_db_name],
+                                        on_loaded=partial(self.reset_series_grid_with_resource, managed_resource))
 
                 # self.chunk_by_series_checkbox.SetValue(wx.CHK_CHECKED if not managed_resource.single_file else wx.CHK_UNCHECKED)
                 # self.chunk_by_year_checkbox.Value = managed_resource.chunk_years
@@ -744,12 +839,22 @@ class VisualH2OWindow(wx.Frame):
             # clear checkboxes if resource isn't managed yet and there's no file options
             self.chunk_by_series_checkbox.SetValue(wx.CHK_UNCHECKED)
             self.chunk_by_year_checkbox.SetValue(wx.CHK_UNCHECKED)
+            self.file_format_choice.SetSelection(DATASET_FORMATS.index(CSV_FORMAT))
             return
 
         # update checkboxes with managed resource file options.
         self.chunk_by_series_checkbox.SetValue(wx.CHK_CHECKED if not managed_resource.single_file else wx.CHK_UNCHECKED)
         self.chunk_by_year_checkbox.SetValue(wx.CHK_CHECKED if managed_resource.chunk_years else wx.CHK_UNCHECKED)
 
+        file_format = getattr(managed_resource, 'file_format', CSV_FORMAT)
+        if file_format not in DATASET_FORMATS:
+            file_format = CSV_FORMAT
+        self.file_format_choice.SetSelection(DATASET_FORMATS.index(file_format))
+
+    def _get_selected_file_format(self):
+        selection = self.file_format_choice.GetSelection()
+        return DATASET_FORMATS[selection] if selection != wx.NOT_FOUND else CSV_FORMAT
+
 
 
     def _change_resource(self, event):
@@ -962,6 +1067,15 @@ class VisualH2OWindow(wx.Frame):
                                                             "files (by default, series are uploaded\n"
                                                             "as a single file)."))
 
+        self.file_format_choice = WxHelper.GetChoice(self, self.panel, [GetDatasetFormatDescription(file_format)
+                                                                        for file_format in DATASET_FORMATS])
+        self.file_format_choice.SetSelection(DATASET_FORMATS.index(CSV_FORMAT))
+        self.file_format_choice.SetToolTip(wx.ToolTip("Format of the dataset files. Parquet and NetCDF\n"
+                                                      "files need the pyarrow or netCDF4 package, and\n"
+                                                      "only CSV files are updated incrementally."))
+
+        odm_series_sizer.Add(self.create_gui_label(u'File format: '), pos=(row, 5), span=(1, 1), flag=text_flags)
+        odm_series_sizer.Add(self.file_format_choice, pos=(row, 6), span=(1, 2), flag=ALIGN.LEFT)
         odm_series_sizer.Add(self.create_gui_label(u'File options: '), pos=(row+1, 5), span=(1, 1), flag=text_flags)
         odm_series_sizer.Add(self.chunk_by_series_checkbox, pos=(row+1, 6), span=(1, 1), flag=text_flags)
         odm_series_sizer.Add(self.chunk_by_year_checkbox, pos=(row+1, 7), span=(1, 1), flag=text_flags)
@@ -971,8 +1085,16 @@ class VisualH2OWindow(wx.Frame):
 
         # Series selection controls
         odm_series_sizer.Add(self.create_gui_label(u'Available Series', font=self.MONOSPACE.Bold()), pos=(row + 2, 0),
-                             span=(1, 4),
+                             span=(1, 2),
                              flag=wx.ALIGN_CENTER)
+
+        self.series_search_input = WxHelper.GetTextInput(self.panel, '')
+        self.series_search_input.SetHint(u'Search, e.g. site:LR var:Temp qc:1')
+        self.series_search_input.SetToolTip(wx.ToolTip("Shows the series whose site or variable code starts with\n"
+                                                       "each word. Use site:, var:, qc:, source: or method:\n"
+                                                       "to search a single column."))
+        self.Bind(wx.EVT_TEXT, self.on_series_search, self.series_search_input)
+        odm_series_sizer.Add(self.series_search_input, pos=(row + 2, 2), span=(1, 2), flag=wx.EXPAND)
         odm_series_sizer.Add(self.create_gui_label(u'Selected Series', font=self.MONOSPACE.Bold()), pos=(row + 2, 5),
                              span=(1, 4),
                              flag=wx.ALIGN_CENTER)
@@ -1022,7 +1144,7 @@ class VisualH2OWindow(wx.Frame):
             self.run_script_button,
             self.stop_script_button
         ],
-            dropdowns=[self.database_connection_choice],
+            dropdowns=[self.database_connection_choice, self.file_format_choice],
             checkboxes=[self.chunk_by_series_checkbox, self.chunk_by_year_checkbox],
             grids=[self.selected_series_grid, self.available_series_grid]
         )
@@ -1273,6 +1395,7 @@ class VisualH2OWindow(wx.Frame):
                 res = self.H2OService.ActiveHydroshare.updateKeywords(resource, self.keywords_input.GetValue().split(','))
 
                 resource.subjects = []
+                self.H2OService.MarkResourceChanged(resource.id)
 
                 for value in res.get('subjects', []):
                     if isinstance(value, dict):
@@ -17,6 +17,101 @@ class GRID_SELECTION_MODES:
     ROWS_OR_COLUMNS = 3
 
 
+class SeriesGridTable(wx.grid.GridTableBase):
+    """
+    Holds the rows of a SeriesGrid as one list per column and gives the grid only the cells it draws. `order` lists
+    positions in those lists in sorted order, and `shown` is the part of `order` that passes the filter, one entry per
+    grid row. Sorting, filtering and removing rows only rearrange indices.
+    """
+    def __init__(self, labels):
+        wx.grid.GridTableBase.__init__(self)
+        self.labels = labels
+        self.columns = [[] for _ in labels]  # type: list[list[unicode]]
+        self.order = []  # type: list[int]
+        self.shown = []  # type: list[int]
+        self.filter_ids = None  # type: set[unicode]
+
+    @staticmethod
+    def CellText(value):
+        return value if isinstance(value, unicode) else unicode(value)
+
+    def GetNumberRows(self):
+        return len(self.shown)
+
+    def GetNumberCols(self):
+        return len(self.labels)
+
+    def GetColLabelValue(self, col):
+        return self.labels[col]
+
+    def GetValue(self, row, col):
+        return self.columns[col][self.shown[row]]
+
+    def SetValue(self, row, col, value):
+        self.columns[col][self.shown[row]] = value
+
+    def IsEmptyCell(self, row, col):
+        return False
+
+    def GetColumn(self, col):
+        """
+        :return: the values of a column for every row, including the ones the filter hides
+        """
+        column = self.columns[col]
+        return [column[index] for index in self.order]
+
+    def GetRows(self, rows):
+        return [[column[self.shown[row]] for column in self.columns] for row in rows]
+
+    def SetFilter(self, filter_ids):
+        """
+        :param filter_ids: values of the first column of the rows to show, or None to show every row
+        """
+        self.filter_ids = filter_ids
+        self._UpdateShown()
+
+    def _UpdateShown(self):
+        if self.filter_ids is None:
+            self.shown = list(self.order)
+        else:
+            ids = self.columns[0]
+            self.shown = [index for index in self.order if ids[index] in self.filter_ids]
+
+    def AddRows(self, rows):
+        """
+        :param rows: one list of unicode cell values per row
+        """
+        if not len(rows):
+            return
+        start = len(self.columns[0])
+        for column, values in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        self.order.extend(range(start, start + len(rows)))
+        self._UpdateShown()
+
+    def RemoveRows(self, rows):
+        removed = set(self.shown[row] for row in rows)
+        self.order = [index for index in self.order if index not in removed]
+
+        # Drop the values nothing points to once they outnumber the rows that are left
+        if len(self.columns[0]) > 2 * len(self.order):
+            self.columns = [[column[index] for index in self.order] for column in self.columns]
+            self.order = range(len(self.order))
+        self._UpdateShown()
+
+    def SortRows(self, col, reverse=False):
+        # Numbers sort as numbers, and before any text
+        keys = [int(value) if value.isdigit() else value for value in self.columns[col]]
+        self.order.sort(key=lambda index: keys[index], reverse=reverse)
+        self._UpdateShown()
+
+    def Reset(self):
+        # The filter is kept, so it applies to the rows added next
+        self.columns = [[] for _ in self.labels]
+        self.order = []
+        self.shown = []
+
+
 class WxHelper:
 
     def __init__(self):
@@ -46,7 +141,9 @@ class WxHelper:
                 self.CacheBestSize(size)
                 self.SetSizeHints(size)
 
-            self.CreateGrid(0, len(WxHelper.SeriesGrid.LABELS))
+            # Keep a reference: the grid doesn't keep the Python side of the table alive
+            self._table = SeriesGridTable([label for label, _ in WxHelper.SeriesGrid.LABELS])
+            self.SetTable(self._table, takeOwnership=True)
             self.EnableEditing(False)
             self.EnableCellEditControl(False)
             self.EnableScrolling(True, True)
@@ -66,7 +163,6 @@ class WxHelper:
             self.prev_sort_by_index = 0
 
             for i in range(0, len(WxHelper.SeriesGrid.LABELS)):
-                self.SetColLabelValue(i, WxHelper.SeriesGrid.LABELS[i][0])
                 self.SetColSize(i, WxHelper.SeriesGrid.LABELS[i][1])
 
             self.EnableDragColMove(True)
@@ -104,15 +200,8 @@ class WxHelper:
             :param reverse: boolean value to indicate whether to reverse the sort order
             :return: None
             """
-            series = []
-            for index in range(0, self.NumberRows):
-                serie = [self.GetCellValue(index, i) for i in range(0, self.GetNumberCols())]
-                series.append(map(lambda x: int(x) if x.isdigit() else x, serie))
-
-            series.sort(key=lambda row: row[col], reverse=reverse)
-
-            for i in range(0, len(series)):
-                self.SetRowValue(i, series[i])
+            self._table.SortRows(col, reverse)
+            self.ForceRefresh()
 
         def SetRowValue(self, row, values):  # type: (int, list) -> None
             """
@@ -122,33 +211,50 @@ class WxHelper:
             :return: None
             """
             for col in range(0, len(values)):
-                value = values[col]
-                if not isinstance(value, unicode):
-                    value = unicode(value)
-
-                self.SetCellValue(row, col, value)
+                self._table.SetValue(row, col, SeriesGridTable.CellText(values[col]))
+            self.ForceRefresh()
 
         def GetValuesForRow(self, row_number):
             return [self.GetCellValue(row_number, column_number) for column_number in range(0, self.NumberCols)]
 
+        def _UpdateRowCount(self, previous_count):
+            """
+            Tells the grid how many rows the table has now; cells are read from the table when they are drawn
+            """
+            count = self._table.GetNumberRows()
+            if count < previous_count:
+                self.ProcessTableMessage(wx.grid.GridTableMessage(
+                    self._table, wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, count, previous_count - count))
+            elif count > previous_count:
+                self.ProcessTableMessage(wx.grid.GridTableMessage(
+                    self._table, wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED, count - previous_count))
+            self.ForceRefresh()
+
+        def AddGridRows(self, rows):
+            """
+            :type rows: list[list[object]]
+            """
+            previous_count = self._table.GetNumberRows()
+            self._table.AddRows([[SeriesGridTable.CellText(value) for value in values] for values in rows])
+            self._UpdateRowCount(previous_count)
+
         def AddGridRow(self, values):
             """
             :type values: list[object]
             """
-            self.AppendRows(1)
+            self.AddGridRows([values])
 
-            row_pos = self.GetNumberRows() - 1
-            self.SetRowValue(row_pos, values)
+        @staticmethod
+        def _SeriesRow(series):
+            return [series.odm_id, series.site_code, series.site_name, series.variable_name,
+                    series.variable_code, series.quality_control_level_code,
+                    series.source_description, series.method_description]
 
         def AppendSeries(self, series):
-            values = [series.odm_id, series.site_code, series.site_name, series.variable_name,
-                      series.variable_code, series.quality_control_level_code,
-                      series.source_description, series.method_description]
-            self.AddGridRow(values)
+            self.AddGridRow(self._SeriesRow(series))
 
         def InsertSeriesList(self, series_list, do_sort=True):
-            for series in series_list:
-                self.AppendSeries(series)
+            self.AddGridRows([self._SeriesRow(series) for series in series_list])
             if do_sort:
                 self.ApplyLastSort()
 
@@ -158,22 +264,49 @@ class WxHelper:
                 self.ApplyLastSort()
 
         def RemoveSelectedRows(self):
-            for i in range(0, self.NumberRows):
-                while i in self.GetSelectedRows():
-                    self.DeleteRows(i)
+            rows = self.GetSelectedRows()
+            self.ClearSelection()
+            previous_count = self._table.GetNumberRows()
+            self._table.RemoveRows(rows)
+            self._UpdateRowCount(previous_count)
+
+        def MoveSelectedRows(self, target_grid, do_sort=True):
+            """
+            Moves the selected rows to another SeriesGrid, copying their cell values instead of rebuilding them from
+            the series
+
+            :type target_grid: WxHelper.SeriesGrid
+            """
+            rows = self.GetSelectedRows()
+            previous_count = target_grid._table.GetNumberRows()
+            target_grid._table.AddRows(self._table.GetRows(rows))
+            target_grid._UpdateRowCount(previous_count)
+            if do_sort:
+                target_grid.ApplyLastSort()
+            self.RemoveSelectedRows()
+
+        def SetSeriesFilter(self, odm_ids):
+            """
+            Shows only the series with these odm_ids, or every series if `odm_ids` is None
+            """
+            previous_count = self._table.GetNumberRows()
+            self.ClearSelection()
+            self._table.SetFilter(odm_ids)
+            self._UpdateRowCount(previous_count)
 
         def GetSelectedSeries(self):
             return [self.GetCellValue(row, 0) for row in self.GetSelectedRows()]
 
         def GetSeries(self):
-            series = []
-            for row in range(0, self.NumberRows):
-                series.append(self.GetCellValue(row, 0))
-            return series
+            return self._table.GetColumn(0)
 
         def Clear(self):
-            if self.NumberRows > 0:
-                self.DeleteRows(0, self.NumberRows)
+            # The filter may hide every row, so the table is reset even when the grid shows none
+            previous_count = self._table.GetNumberRows()
+            self._table.Reset()
+            if previous_count > 0:
+                self.ClearSelection()
+                self._UpdateRowCount(previous_count)
 
         def OnCellRightClick(self, event):
             """
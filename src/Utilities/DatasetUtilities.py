@@ -1,17 +1,22 @@
 import base64
 import hashlib
+import itertools
+import json
 from collections import defaultdict
 import datetime
-from multiprocessing import Process, Queue
-from time import sleep
+from threading import Event, Lock, Thread
+from time import time
 
+import dateutil.parser
 from pubsub import pub
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
 from Common import *
 from GAMUTRawData.odmdata import QualityControlLevel, Series, Site, Source, Qualifier, Variable, Method
 from GAMUTRawData.odmservices import SeriesService, ServiceManager
+from Utilities.DatasetWriters import CSV_FORMAT, GetDatasetFileExtension, GetDatasetWriter
 
 this_file = os.path.realpath(__file__)
 directory = os.path.dirname(os.path.dirname(this_file))
@@ -40,9 +45,99 @@ class FileDetails(object):
         return fd_str.format(site=self.site_code, s_name=self.site_name, f_name=self.file_name)
 
 
+class CsvFileManifest(object):
+    """
+    Sidecar file recording what has already been written to a dataset file, so later runs only need to query and
+    append the values newer than `watermark`.
+    """
+    VERSION = 2
+    EXTENSION = '.manifest'
+
+    def __init__(self, csv_path, watermark=None, columns=None, qualifier_ids=None, value_summary=None, file_size=0):
+        self.csv_path = csv_path
+        self.watermark = watermark  # type: datetime.datetime
+        self.columns = columns if columns is not None else []  # type: list
+        self.qualifier_ids = qualifier_ids if qualifier_ids is not None else []  # type: list[int]
+        # (VariableID, MethodID) -> (value count, highest ValueID, DataValue, QualifierID and CensorCode checksums)
+        self.value_summary = value_summary if value_summary is not None else {}  # type: dict[tuple, tuple]
+        self.file_size = file_size  # type: int
+
+    @staticmethod
+    def GetPath(csv_path):
+        return csv_path + CsvFileManifest.EXTENSION
+
+    @staticmethod
+    def Load(csv_path):  # type: (str) -> CsvFileManifest | None
+        manifest_path = CsvFileManifest.GetPath(csv_path)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'r') as fin:
+                data = json.load(fin)
+
+            if data.get('version') != CsvFileManifest.VERSION:
+                return None
+
+            columns = [tuple(column) if isinstance(column, list) else column for column in data['columns']]
+            value_summary = {}
+            for summary in data['value_summary']:
+                value_summary[(summary[0], summary[1])] = tuple(summary[2:])
+
+            return CsvFileManifest(csv_path, watermark=dateutil.parser.parse(data['watermark']), columns=columns,
+                                   qualifier_ids=data['qualifier_ids'], value_summary=value_summary,
+                                   file_size=data['file_size'])
+        except (ValueError, KeyError, TypeError) as e:
+            print('Ignoring unreadable manifest {}: {}'.format(manifest_path, e))
+            return None
+
+    @staticmethod
+    def Remove(csv_path):
+        manifest_path = CsvFileManifest.GetPath(csv_path)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def IsCurrent(self, value_summary):
+        """
+        Checks that the file on disk is the one this manifest describes, and that the values at or before the
+        watermark are still the ones that were exported (none inserted, removed, deleted and re-inserted, or edited).
+
+        :param value_summary: result of `SeriesService.get_value_summary_by_filters` up to the watermark
+        """
+        if not os.path.exists(self.csv_path) or os.path.getsize(self.csv_path) != self.file_size:
+            return False
+
+        return CsvFileManifest.SummaryEntries(value_summary) == self.value_summary
+
+    @staticmethod
+    def SummaryEntries(value_summary):
+        """
+        :return: the parts of a `SeriesService.get_value_summary_by_filters` result that a manifest keeps - all but
+                 the latest LocalDateTime, which the watermark already records
+        """
+        entries = {}
+        for key, summary in value_summary.iteritems():
+            entries[key] = tuple(summary[:2]) + tuple(summary[3:])
+        return entries
+
+    def Save(self):
+        columns = [[column[0], int(column[1])] if isinstance(column, tuple) else column for column in self.columns]
+        value_summary = [[variable_id, method_id] + [int(entry) for entry in summary]
+                         for (variable_id, method_id), summary in self.value_summary.iteritems()]
+
+        data = {'version': CsvFileManifest.VERSION,
+                'watermark': self.watermark.isoformat(),
+                'columns': columns,
+                'qualifier_ids': [int(q_id) for q_id in self.qualifier_ids],
+                'value_summary': value_summary,
+                'file_size': os.path.getsize(self.csv_path)}
+
+        with open(CsvFileManifest.GetPath(self.csv_path), 'w') as fout:
+            json.dump(data, fout)
+
+
 class H2OManagedResource:
     def __init__(self, resource=None, odm_series=None, resource_id='', hs_account_name='', odm_db_name='',
-                 single_file=False, chunk_years=False, associated_files=None):
+                 single_file=False, chunk_years=False, associated_files=None, file_format=CSV_FORMAT):
         self.resource_id = resource_id  # type: str
         self.resource = resource  # type: HydroShareResource
         self.selected_series = odm_series if odm_series is not None else {}  # type: dict[int, H2OSeries]
@@ -51,6 +146,7 @@ class H2OManagedResource:
         self.single_file = single_file  # type: bool
         self.chunk_years = chunk_years  # type: bool
         self.associated_files = associated_files if associated_files is not None else []  # type: list[str]
+        self.file_format = file_format  # type: str
 
     @property
     def public(self):
@@ -75,7 +171,8 @@ class H2OManagedResource:
         return {'resource': self.resource, 'selected_series': self.selected_series,
                 'hs_account_name': self.hs_account_name, 'resource_id': self.resource_id,
                 'single_file': self.single_file, 'chunk_years': self.chunk_years,
-                'odm_db_name': self.odm_db_name, 'associated_files': self.associated_files}
+                'odm_db_name': self.odm_db_name, 'associated_files': self.associated_files,
+                'file_format': self.file_format}
 
     def to_dict(self):
         return self.__dict__()
@@ -87,12 +184,35 @@ class H2OManagedResource:
             return 'Managed resource with ID {} and {} series'.format(self.resource_id, len(self.selected_series))
 
 
-def _OdmDatabaseConnectionTestTimed(queue):
-    db_auth = queue.get(True)
-    if service_manager.test_connection(db_auth):
-        queue.put(True)
-    else:
-        queue.put(False)
+_verified_connections = {}  # type: dict[tuple, float]
+_verified_connections_lock = Lock()
+
+
+def _TestOdmDatabaseConnection(connection_details, callback):
+    """
+    Tests the connection and calls `callback` with the result. Successful tests are remembered for
+    APP_SETTINGS.CONNECTION_VERIFY_TTL seconds so switching back and forth between databases doesn't test them again.
+    """
+    key = tuple(sorted(connection_details.items()))
+    with _verified_connections_lock:
+        verified_at = _verified_connections.get(key, None)
+
+    if verified_at is not None and time() - verified_at < APP_SETTINGS.CONNECTION_VERIFY_TTL:
+        callback(True)
+        return
+
+    try:
+        result = service_manager.test_connection(connection_details)
+    except Exception as exc:
+        print(exc)
+        result = False
+
+    with _verified_connections_lock:
+        if result:
+            _verified_connections[key] = time()
+        else:
+            _verified_connections.pop(key, None)
+    callback(result)
 
 
 class OdmDatasetConnection:
@@ -117,22 +237,33 @@ class OdmDatasetConnection:
     def __str__(self):
         return 'Dataset connection details {}'.format(self.name)
 
-    def VerifyConnection(self):
-        queue = Queue()
-        result = False
-        process = Process(target=_OdmDatabaseConnectionTestTimed, args=(queue,))
-        try:
-            process.start()
-            queue.put(self.ToDict())
-            sleep(2)
-            result = queue.get(True, 8)
-        except Exception as exc:
-            print(exc)
-
-        if process.is_alive():
-            process.terminate()
-            process.join()
-        return result
+    def VerifyConnection(self, timeout=None):
+        """
+        Returns as soon as the database answers, or False if it hasn't after `timeout` seconds (defaults to
+        APP_SETTINGS.DB_CONNECT_TIMEOUT)
+        """
+        timeout = timeout if timeout is not None else APP_SETTINGS.DB_CONNECT_TIMEOUT
+        done = Event()
+        result = []
+
+        def on_result(verified):
+            result.append(verified)
+            done.set()
+
+        self.VerifyConnectionAsync(on_result)
+        if not done.wait(timeout):
+            print('Connection {} did not answer within {} seconds'.format(self.name, timeout))
+            return False
+        return result[0]
+
+    def VerifyConnectionAsync(self, callback):
+        """
+        Tests the connection on a background thread, then calls `callback` with True or False from that thread. GUI
+        callers should hand the result back to the GUI thread themselves (e.g. with wx.CallAfter).
+        """
+        thread = Thread(target=_TestOdmDatabaseConnection, args=(self.ToDict(), callback))
+        thread.setDaemon(True)
+        thread.start()
 
     def ToDict(self):
         return {'engine': self.engine, 'user': self.user, 'password': self.password, 'address': self.address,
@@ -142,6 +273,17 @@ class OdmDatasetConnection:
 DELIMITER = '# {}'.format('-' * 90)
 
 
+def GetFileHash(file_path, block_size=1048576):
+    """
+    Returns the MD5 hex digest of a file, reading it in blocks so large files are never fully loaded into memory
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def createFile(filepath):
     try:
         print('Creating new file {}'.format(filepath))
@@ -151,22 +293,104 @@ def createFile(filepath):
         return None
 
 
+def JoinSeriesColumns(dataframe, columns=None):
+    """
+    Turns values with one row per value into one row per timestamp and one column per (VariableCode, MethodID).
+    Gives the same result as `pd.pivot_table(..., values='DataValue')`, but instead of grouping and averaging, the
+    values are ordered by timestamp and placed directly into their row and column, so memory only holds the input
+    and the wide output. Falls back to `pd.pivot_table` if a timestamp has more than one value for a column.
+
+    :param columns: MultiIndex of the output columns; defaults to the (VariableCode, MethodID) pairs with values
+    :return: DataFrame indexed by LocalDateTime, UTCOffset and DateTimeUTC, with NaN where a column has no value
+    """
+    index_names = ["LocalDateTime", "UTCOffset", "DateTimeUTC"]
+
+    # pivot_table leaves out missing values, and so any row or column left with nothing but missing values
+    dataframe = dataframe[dataframe['DataValue'].notnull()]
+
+    if columns is None:
+        columns = pd.MultiIndex.from_tuples(sorted(set(zip(dataframe['VariableCode'], dataframe['MethodID']))),
+                                            names=['VariableCode', 'MethodID'])
+
+    local_times = dataframe['LocalDateTime'].values
+    utc_offsets = dataframe['UTCOffset'].values
+    utc_times = dataframe['DateTimeUTC'].values
+
+    order = np.lexsort((utc_times, utc_offsets, local_times))
+    local_times = local_times[order]
+    utc_offsets = utc_offsets[order]
+    utc_times = utc_times[order]
+
+    new_row = np.ones(len(order), dtype=bool)
+    new_row[1:] = (local_times[1:] != local_times[:-1]) | (utc_offsets[1:] != utc_offsets[:-1]) | \
+                  (utc_times[1:] != utc_times[:-1])
+    row_positions = np.cumsum(new_row) - 1
+
+    value_columns = pd.MultiIndex.from_arrays([dataframe['VariableCode'].values[order],
+                                               dataframe['MethodID'].values[order]])
+    column_positions = columns.get_indexer(value_columns)
+
+    in_columns = column_positions >= 0
+    cells = row_positions[in_columns] * len(columns) + column_positions[in_columns]
+    if len(pd.unique(cells)) != len(cells):
+        table = pd.pivot_table(dataframe, index=index_names, columns=['VariableCode', 'MethodID'], values='DataValue')
+        return table.reindex(columns=columns)
+
+    table_values = np.empty((int(new_row.sum()), len(columns)), dtype=np.float64)
+    table_values.fill(np.nan)
+    table_values[row_positions[in_columns], column_positions[in_columns]] = \
+        dataframe['DataValue'].values[order][in_columns]
+
+    index = pd.MultiIndex.from_arrays([local_times[new_row], utc_offsets[new_row], utc_times[new_row]],
+                                      names=index_names)
+
+    return DataFrame(table_values, index=index, columns=columns)
+
+
+def _QualifierCodes(qualifier_lookup, qualifier_ids):
+    """
+    :return: the [QualifierID, QualifierCode, QualifierDescription] of each qualifier, ordered by id
+    """
+    return [qualifier_lookup[q_id] for q_id in sorted(set(qualifier_ids)) if q_id in qualifier_lookup]
+
+
+def _UsedQualifierIds(dataframe):
+    return [int(q_id) for q_id in dataframe['QualifierID'].dropna().unique()]
+
+
+def _ShapeQualifiedValues(dataframe, qualifier_codes, colmapper):
+    """
+    Turns the values of a single series into the file's columns: the value, its censor code and its qualifier code,
+    looked up by QualifierID instead of merged from a qualifier DataFrame
+
+    :param qualifier_codes: dict of QualifierID to QualifierCode
+    """
+    dataframe['QualifierCode'] = dataframe['QualifierID'].map(qualifier_codes)
+
+    csv_table = dataframe.set_index(["LocalDateTime", "UTCOffset", "DateTimeUTC"])
+    csv_table = csv_table[[column for column in csv_table.columns.tolist()
+                           if column in ["DataValue", "CensorCode", "QualifierCode"]]]
+
+    return csv_table.rename(columns=colmapper)
+
+
 def GetTimeSeriesDataframe(series_service, series_list, site_id, qc_id, source_id, methods, variables, starting_date,
-                           year=None):
+                           year=None, ending_date=None):
     q_list = []
     censor_list = []
 
     dataframe = series_service.get_values_by_filters(site_id, qc_id, source_id, methods, variables, year,
                                                      starting_date=starting_date,
                                                      chunk_size=APP_SETTINGS.QUERY_CHUNK_SIZE,
-                                                     timeout=APP_SETTINGS.DATAVALUES_TIMEOUT)
+                                                     timeout=APP_SETTINGS.DATAVALUES_TIMEOUT,
+                                                     ending_date=ending_date)
+
+    if dataframe is None or dataframe.empty:
+        return None, q_list, censor_list
 
     if qc_id == 0 or len(variables) != 1 or len(methods) != 1:
 
-        csv_table = pd.pivot_table(dataframe,
-                                   index=["LocalDateTime", "UTCOffset", "DateTimeUTC"],
-                                   columns=['VariableCode', 'MethodID'],
-                                   values='DataValue')
+        csv_table = JoinSeriesColumns(dataframe)
 
         nodata_values = {}
         for series in series_list:
@@ -175,27 +399,15 @@ def GetTimeSeriesDataframe(series_service, series_list, site_id, qc_id, source_i
         csv_table.fillna(value=nodata_values, inplace=True)
 
     else:
-        method = next(iter(methods))
-        variable = next(iter(variables))
-
         dataframe.fillna(value={'DataValue': series_list[0].variable.no_data_value}, inplace=True)
 
-        q_list = [[q.id, q.code, q.description] for q in
-                  series_service.get_qualifiers_by_series_details(site_id, qc_id, source_id, method, variable)]
-
-        # Get the qualifiers that we use in this series, merge it with our DataValue set
-        q_df = DataFrame(data=q_list, columns=["QualifierID", "QualifierCode", "QualifierDescription"])
-
-        csv_table = dataframe.merge(q_df, how='left', on="QualifierID")  # type: DataFrame
-
-        csv_table.set_index(["LocalDateTime", "UTCOffset", "DateTimeUTC"], inplace=True)
-        for column in csv_table.columns.tolist():
-
-            if column not in ["DataValue", "CensorCode", "QualifierCode"]:
-                csv_table.drop(column, axis='columns', inplace=True)
+        # The qualifiers used are read from the values themselves, so the values are only scanned once
+        qualifier_lookup = series_service.get_qualifier_lookup()
+        q_list = _QualifierCodes(qualifier_lookup, _UsedQualifierIds(dataframe))
+        qualifier_codes = dict((q_id, qualifier[1]) for q_id, qualifier in qualifier_lookup.iteritems())
 
         colmapper = {'DataValue': (series_list[0].variable_code, series_list[0].method_id)}
-        csv_table.rename(columns=colmapper, inplace=True)
+        csv_table = _ShapeQualifiedValues(dataframe, qualifier_codes, colmapper)
 
         if 'CensorCode' in csv_table:
             censor_list = set(csv_table['CensorCode'].tolist())
@@ -205,84 +417,386 @@ def GetTimeSeriesDataframe(series_service, series_list, site_id, qc_id, source_i
     return csv_table, q_list, censor_list  # don't ask questions... just let it happen
 
 
-def BuildCsvFile(series_service, series_list, year=None, failed_files=None):  # type: (SeriesService, list[Series], int, list[tuple(str)]) -> str | None
+def _AlignChunksOnTimestamp(value_chunks):
+    """
+    Re-cuts a stream of DataValue chunks (ordered by LocalDateTime) so that every row sharing a LocalDateTime lands
+    in the same chunk. Without this, a pivoted row could be split in two across a chunk boundary.
+    """
+    carry = None
+    for chunk in value_chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
 
-    if failed_files is None:
-        failed_files = list()
+        if chunk.empty:
+            continue
 
-    try:
-        if len(series_list) == 0:
-            print('Cannot generate a file for no series')
-            return None
-        variables = set([series.variable_id for series in series_list if series is not None])
-        variable_codes = set([series.variable_code for series in series_list if series is not None])
-        methods = set([series.method_id for series in series_list if series is not None])
-        qc_ids = set([series.quality_control_level_id for series in series_list if series is not None])
-        site_ids = set([series.site_id for series in series_list if series is not None])
-        source_ids = set([series.source_id for series in series_list if series is not None])
-
-        if len(qc_ids) == 0 or len(site_ids) == 0 or len(source_ids) == 0:
-            print('Series provided are empty or invalid')
-        elif len(qc_ids) > 1 or len(site_ids) > 1 or len(source_ids) > 1:
-            print('Cannot create a file that contains multiple QC, Site, or Source IDs')
-            print('{}: {}'.format(varname(qc_ids), qc_ids))
-            print('{}: {}'.format(varname(site_ids), site_ids))
-            print('{}: {}\n'.format(varname(source_ids), source_ids))
-        elif len(variables) == 0 or len(methods) == 0:
-            print('Cannot generate series with no {}'.format(varname(variables if len(variables) == 0 else methods)))
+        last_timestamp = chunk['LocalDateTime'] == chunk['LocalDateTime'].iloc[-1]
+        carry = chunk[last_timestamp]
+
+        if not last_timestamp.all():
+            yield chunk[~last_timestamp]
+
+    if carry is not None and not carry.empty:
+        yield carry
+
+
+def GetTimeSeriesDataframeChunks(series_service, series_list, site_id, qc_id, source_id, methods, variables,
+                                 starting_date, year=None, ending_date=None):
+    """
+    Streaming version of `GetTimeSeriesDataframe` - values are queried in pieces of `APP_SETTINGS.QUERY_CHUNK_SIZE`
+    rows and shaped one piece at a time, so memory use depends on the chunk size rather than on the series length.
+
+    Multi-column chunks contain the same columns `GetTimeSeriesDataframe` gives for these values, one for each
+    variable and method with values, even if a piece has no values for some of them.
+
+    :return: a tuple of (generator of DataFrames, qualifier list, censor code set). The qualifier list and censor
+             code set are read from the values as the generator is consumed, and are complete once it is exhausted.
+    """
+    q_list = []
+    censor_list = set()
+
+    pieces = _ShapeValueChunks(series_service, series_list, site_id, qc_id, source_id, methods, variables,
+                               starting_date, year, ending_date, value_codes={None: (q_list, censor_list)})
+    chunks = (chunk for _, chunk in pieces)
+
+    return chunks, q_list, censor_list
+
+
+def _RenameDuplicateVariableColumns(dataframe):
+    """
+    Appends a sequential number to duplicate variable codes in the columns of `dataframe`. The columns are left as
+    `(<variable name>, <method ID>)` tuples so they can still be mapped to their series when building the header.
+    """
+    # `varheaders` and `duplicatevarcounter` are used in `preheader_column_mapper()`
+    # to determine which number to append to duplicate variable codes
+    varheaders = [x[0] if not isinstance(x, str) else x for x in dataframe.columns]
+    duplicatevarcounter = defaultdict(lambda: 0)
+    for col in dataframe.columns:
+        # look for variable codes that appear more than once in the columns
+        # of `dataframe`, and add those to `duplicatevarcounter`
+        try:
+            var, _ = col
+            if varheaders.count(var) > 1:
+                duplicatevarcounter[var] += 1
+        except ValueError:
+            continue
+
+    def preheader_column_mapper(col):
+        """
+        Used to rename columns of `dataframe`. Columns of `dataframe` are
+        tuples in the form of `(<variable name>, <method ID>)`. Appends a
+        number to duplicate variable codes in a sequential order.
+
+        i.e., the columns: `[("Temp", 5), ("Temp", 6), ("DO", 9)]`
+        become -> [("Temp-1", 5), ("Temp-2", 6), ("DO", 9)]`
+
+        :param col: a column of `dataframe`
+        :return: tuple(str, int)
+        """
+        try:
+            var, methid = col
+            if var in duplicatevarcounter:
+                varheaders.pop(varheaders.index(var))
+                dup_count = duplicatevarcounter.get(var) - varheaders.count(var)
+                newvar = '%s-%s' % (var, dup_count)
+                return newvar, methid
+        except ValueError:
+            # If one column name is a tuple, all column names must be tuples
+            return col, None
+
+        return col
+
+    # call set_axis to rename duplicate column names
+    dataframe.set_axis('columns', dataframe.columns.map(preheader_column_mapper))
+
+
+def _ConformChunks(chunks, columns):
+    """
+    Sorts each remaining chunk and gives it the (already renamed) columns of the first chunk
+    """
+    for chunk in chunks:
+        chunk.sort_index(inplace=True)
+        chunk.columns = columns
+        yield chunk
+
+
+def _ConformToManifest(dataframe, manifest, series_list):
+    """
+    Arranges newly queried values in the column layout of the file they are appended to.
+
+    :return: the arranged dataframe, or None if the values don't fit the existing layout
+    """
+    if not set(dataframe.columns).issubset(set(manifest.columns)):
+        return None
+
+    if isinstance(dataframe.columns, pd.MultiIndex):
+        columns = pd.MultiIndex.from_tuples(manifest.columns, names=dataframe.columns.names)
+
+        nodata_values = {}
+        for series in series_list:
+            nodata_values[(series.variable_code, series.method_id)] = series.variable.no_data_value
+
+        dataframe = dataframe.reindex(columns=columns)
+        dataframe.fillna(value=nodata_values, inplace=True)
+
+    elif list(dataframe.columns) != list(manifest.columns):
+        return None
+
+    return dataframe
+
+
+def _SplitChunksByYear(value_chunks):
+    """
+    Cuts DataValue chunks (ordered by LocalDateTime) where a new calendar year starts
+
+    :return: generator of (year, chunk) tuples
+    """
+    for chunk in value_chunks:
+        years = pd.DatetimeIndex(chunk['LocalDateTime']).year
+        for year in sorted(set(years)):
+            yield year, chunk[years == year]
+
+
+def _ShapeValueChunks(series_service, series_list, site_id, qc_id, source_id, methods, variables, starting_date,
+                      year=None, ending_date=None, by_year=False, value_codes=None):
+    """
+    Queries values in pieces of `APP_SETTINGS.QUERY_CHUNK_SIZE` rows and shapes each piece into the columns of a
+    file. Multi-column pieces have the columns `GetTimeSeriesDataframe` gives for the same values: one for each
+    variable and method with values (in the piece's year, with `by_year`), even if the piece has none for some.
+
+    :param by_year: cut the pieces where a new year starts, and give each year its own columns
+    :param value_codes: dict that is filled in with year (None unless `by_year`) -> (qualifier list, censor code
+                        set). The entry of a year is complete once the generator has moved on to the next year.
+    :return: generator of (year, DataFrame) tuples
+    """
+    if value_codes is None:
+        value_codes = {}
+
+    value_chunks = series_service.get_value_chunks_by_filters(site_id, qc_id, source_id, methods, variables, year,
+                                                              starting_date=starting_date,
+                                                              chunk_size=APP_SETTINGS.QUERY_CHUNK_SIZE,
+                                                              ending_date=ending_date)
+
+    if qc_id == 0 or len(variables) != 1 or len(methods) != 1:
+
+        # The columns are found before streaming, since each piece may only hold some of them
+        if by_year:
+            value_columns = series_service.get_value_columns_by_year(site_id, qc_id, source_id, methods, variables,
+                                                                     starting_date=starting_date,
+                                                                     ending_date=ending_date)
         else:
-            try:
-                site = series_list[0].site  # type: Site
-            except Exception:
-                site = Site(site_code=series_list[0].site_code, site_name=series_list[0].site_name)
+            value_columns = {None: series_service.get_value_columns_by_filters(site_id, qc_id, source_id, methods,
+                                                                               variables, year,
+                                                                               starting_date=starting_date,
+                                                                               ending_date=ending_date)}
+
+        variable_codes = dict((series.variable_id, series.variable_code) for series in series_list)
+        columns = {}
+        for key, pairs in value_columns.iteritems():
+            columns[key] = pd.MultiIndex.from_tuples(sorted(set([(variable_codes[variable_id], method_id)
+                                                                 for variable_id, method_id in pairs])),
+                                                     names=['VariableCode', 'MethodID'])
+
+        nodata_values = {}
+        for series in series_list:
+            nodata_values[(series.variable_code, series.method_id)] = series.variable.no_data_value
+
+        def shape_chunk(key, dataframe):
+            # Values of a year that had none when the columns were found get the columns they have
+            csv_table = JoinSeriesColumns(dataframe, columns.get(key, None))
+            csv_table.fillna(value=nodata_values, inplace=True)
+            return csv_table
+
+        def finish(key):
+            pass
+
+        value_chunks = _AlignChunksOnTimestamp(value_chunks)
+
+    else:
+        nodata_value = series_list[0].variable.no_data_value
+
+        qualifier_lookup = series_service.get_qualifier_lookup()
+        qualifier_codes = dict((q_id, qualifier[1]) for q_id, qualifier in qualifier_lookup.iteritems())
+        qualifier_ids = {}
+
+        colmapper = {'DataValue': (series_list[0].variable_code, series_list[0].method_id)}
+
+        def shape_chunk(key, dataframe):
+            dataframe.fillna(value={'DataValue': nodata_value}, inplace=True)
+            qualifier_ids.setdefault(key, set()).update(_UsedQualifierIds(dataframe))
+
+            csv_table = _ShapeQualifiedValues(dataframe, qualifier_codes, colmapper)
 
+            if 'CensorCode' in csv_table:
+                value_codes[key][1].update(csv_table['CensorCode'].tolist())
 
-            source = series_list[0].source  # type: Source
-            qc = series_list[0].quality_control_level  # type: QualityControlLevel
-            variables = list(variables)
-            variable_codes = list(variable_codes)
-            methods = list(methods)
+            return csv_table
 
+        def finish(key):
+            value_codes[key][0][:] = _QualifierCodes(qualifier_lookup, qualifier_ids.pop(key, []))
 
-            fname_components = [site.code]
+    if by_year:
+        keyed_chunks = _SplitChunksByYear(value_chunks)
+    else:
+        keyed_chunks = ((None, chunk) for chunk in value_chunks)
+
+    current_key = None
+    started = False
+    for key, chunk in keyed_chunks:
+        if started and key != current_key:
+            finish(current_key)
+        if key not in value_codes:
+            value_codes[key] = ([], set())
+        started, current_key = True, key
+        yield key, shape_chunk(key, chunk)
+
+    if started:
+        finish(current_key)
+
+
+def _GetSeriesListDetails(series_list):
+    """
+    Checks that a list of series can be written to the same file
+
+    :return: a tuple of (site, source, qc, variable IDs, variable codes, method IDs), or None if the list is invalid
+    """
+    if len(series_list) == 0:
+        print('Cannot generate a file for no series')
+        return None
+    variables = set([series.variable_id for series in series_list if series is not None])
+    variable_codes = set([series.variable_code for series in series_list if series is not None])
+    methods = set([series.method_id for series in series_list if series is not None])
+    qc_ids = set([series.quality_control_level_id for series in series_list if series is not None])
+    site_ids = set([series.site_id for series in series_list if series is not None])
+    source_ids = set([series.source_id for series in series_list if series is not None])
+
+    if len(qc_ids) == 0 or len(site_ids) == 0 or len(source_ids) == 0:
+        print('Series provided are empty or invalid')
+    elif len(qc_ids) > 1 or len(site_ids) > 1 or len(source_ids) > 1:
+        print('Cannot create a file that contains multiple QC, Site, or Source IDs')
+        print('{}: {}'.format(varname(qc_ids), qc_ids))
+        print('{}: {}'.format(varname(site_ids), site_ids))
+        print('{}: {}\n'.format(varname(source_ids), source_ids))
+    elif len(variables) == 0 or len(methods) == 0:
+        print('Cannot generate series with no {}'.format(varname(variables if len(variables) == 0 else methods)))
+    else:
+        try:
+            site = series_list[0].site  # type: Site
+        except Exception:
+            site = Site(site_code=series_list[0].site_code, site_name=series_list[0].site_name)
+
+        source = series_list[0].source  # type: Source
+        qc = series_list[0].quality_control_level  # type: QualityControlLevel
+
+        return site, source, qc, list(variables), list(variable_codes), list(methods)
 
-            if len(variable_codes) == 1:
-                fname_components.append(variable_codes[0])
+    return None
+
+
+def GetDatasetFilePath(site, source, qc, variable_codes, year=None, file_format=CSV_FORMAT):
+    fname_components = [site.code]
+
+    if len(variable_codes) == 1:
+        fname_components.append(variable_codes[0])
+
+    # not sure why it was writing the method id in the file name. leaving it here just in case.
+    # if len(methods) == 1:
+    #     fname_components.append('MethodID_%s' % methods[0])
+
+    fname_components.append('SourceID_%s' % source.id)
+    fname_components.append('QC_%s' % qc.code)
+
+    if year is not None:
+        fname_components.append('Year_%s' % year)
+
+    file_name = '%s.%s' % ('_'.join(fname_components), GetDatasetFileExtension(file_format))
+
+    return os.path.join(APP_SETTINGS.DATASET_DIR, file_name)
+
+
+def BuildCsvFile(series_service, series_list, year=None, failed_files=None, streaming=None, incremental=None,
+                 file_format=CSV_FORMAT):  # type: (SeriesService, list[Series], int, list[tuple(str)], bool, bool, str) -> str | None
+
+    if failed_files is None:
+        failed_files = list()
 
-            # not sure why it was writing the method id in the file name. leaving it here just in case.
-            # if len(methods) == 1:
-            #     fname_components.append('MethodID_%s' % methods[0])
+    if streaming is None:
+        streaming = APP_SETTINGS.STREAM_QUERIES
 
-            fname_components.append('SourceID_%s' % source.id)
-            fname_components.append('QC_%s' % qc.code)
+    if incremental is None:
+        incremental = APP_SETTINGS.INCREMENTAL_EXPORT
 
-            if year is not None:
-                fname_components.append('Year_%s' % year)
+    if file_format != CSV_FORMAT:
+        incremental = False  # Only plain CSV files can be appended to
 
-            file_name = '%s.csv' % '_'.join(fname_components)
+    try:
+        details = _GetSeriesListDetails(series_list)
+        if details is not None:
+            site, source, qc, variables, variable_codes, methods = details
 
-            fpath = os.path.join(APP_SETTINGS.DATASET_DIR, file_name)
+            fpath = GetDatasetFilePath(site, source, qc, variable_codes, year, file_format)
 
             """
-            This used to check if the file already existed on disk and
-            wouldn't upload the file if true. I commented this out
-            because it was causing inconsistent behaviour. Leaving it
-            here as a reference in case something pops up later.
+            This used to check if the file already existed on disk by parsing
+            the last line of the CSV file. It is now done with a sidecar
+            manifest (see `CsvFileManifest`) when incremental exports are on.
             """
-            # if os.path.exists(fpath):
-            #     csv_data = parseCSVData(fpath)
-            #     csv_end_datetime = csv_data.localDateTime
-            # else:
-            #     csv_end_datetime = None
             csv_end_datetime = None
+            watermark = None
+            value_summary = {}
+
+            if incremental:
+                # Summarize before querying so values inserted while this file is written are caught by the next run
+                value_summary = series_service.get_value_summary_by_filters(site.id, qc.id, source.id, methods,
+                                                                            variables, year)
+                if len(value_summary):
+                    watermark = max([summary[2] for summary in value_summary.itervalues()])
+
+                manifest = CsvFileManifest.Load(fpath)
+                if manifest is not None:
+                    exported_summary = series_service.get_value_summary_by_filters(site.id, qc.id, source.id, methods,
+                                                                                   variables, year,
+                                                                                   ending_date=manifest.watermark)
+                    if manifest.IsCurrent(exported_summary):
+                        csv_end_datetime = manifest.watermark
+                    else:
+                        print('Values before {} changed since the last export - regenerating file {}'.format(
+                            manifest.watermark, fpath))
+            else:
+                manifest = None
+                CsvFileManifest.Remove(fpath)
+
+            if csv_end_datetime is not None and csv_end_datetime == watermark:
+                print('File exists but there are no new data values to write')
+                return fpath
+
+            def query_values(starting_date):
+                if streaming and starting_date is None:
+                    chunks, q_codes, c_codes = GetTimeSeriesDataframeChunks(series_service, series_list, site.id, qc.id, source.id, methods, variables, starting_date, year, ending_date=watermark)
+                    return next(chunks, None), chunks, q_codes, c_codes
 
+                frame, q_codes, c_codes = GetTimeSeriesDataframe(series_service, series_list, site.id, qc.id, source.id, methods, variables, starting_date, year, ending_date=watermark)
+                return frame, None, q_codes, c_codes
 
             stopwatch_timer = None
             if APP_SETTINGS.VERBOSE:
                 stopwatch_timer = datetime.datetime.now()
                 print('Querying values for file {}'.format(fpath))
 
-            dataframe, qualifier_codes, censorcodes = GetTimeSeriesDataframe(series_service, series_list, site.id, qc.id, source.id, methods, variables, csv_end_datetime, year)
+            dataframe, dataframe_chunks, qualifier_codes, censorcodes = query_values(csv_end_datetime)
+
+            if csv_end_datetime is not None and dataframe is not None:
+                # Only the new values were read, so the header is still right if they use no new qualifiers
+                qualifier_ids = set([q_code[0] for q_code in qualifier_codes])
+                if qualifier_ids.issubset(manifest.qualifier_ids):
+                    dataframe = _ConformToManifest(dataframe, manifest, series_list)
+                else:
+                    dataframe = None
+
+                if dataframe is None:
+                    print('Column layout of file {} changed - regenerating the whole file'.format(fpath))
+                    csv_end_datetime = None
+                    dataframe, dataframe_chunks, qualifier_codes, censorcodes = query_values(csv_end_datetime)
 
             if APP_SETTINGS.VERBOSE:
                 print('Query execution took {}'.format(datetime.datetime.now() - stopwatch_timer))
@@ -292,70 +806,47 @@ def BuildCsvFile(series_service, series_list, year=None, failed_files=None):  #
                 if csv_end_datetime is None:
                     dataframe.sort_index(inplace=True)
 
-                    # `varheaders` and `duplicatevarcounter` are used in `preheader_column_mapper()`
-                    # to determine which number to append to duplicate variable codes
-                    varheaders = [x[0] if not isinstance(x, str) else x for x in dataframe.columns]
-                    duplicatevarcounter = defaultdict(lambda: 0)
-                    for col in dataframe.columns:
-                        # look for variable codes that appear more than once in the columns
-                        # of `dataframe`, and add those to `duplicatevarcounter`
-                        try:
-                            var, _ = col
-                            if varheaders.count(var) > 1:
-                                duplicatevarcounter[var] += 1
-                        except ValueError:
-                            continue
-
-                    def preheader_column_mapper(col):
-                        """
-                        Used to rename columns of `dataframe`. Columns of `dataframe` are
-                        tuples in the form of `(<variable name>, <method ID>)`. Appends a
-                        number to duplicate variable codes in a sequential order.
-
-                        i.e., the columns: `[("Temp", 5), ("Temp", 6), ("DO", 9)]`
-                        become -> [("Temp-1", 5), ("Temp-2", 6), ("DO", 9)]`
-
-                        :param col: a column of `dataframe`
-                        :return: tuple(str, int)
-                        """
-                        try:
-                            var, methid = col
-                            if var in duplicatevarcounter:
-                                varheaders.pop(varheaders.index(var))
-                                dup_count = duplicatevarcounter.get(var) - varheaders.count(var)
-                                newvar = '%s-%s' % (var, dup_count)
-                                return newvar, methid
-                        except ValueError:
-                            # If one column name is a tuple, all column names must be tuples
-                            return col, None
-
-                        return col
-
-                    # call set_axis to rename duplicate column names
-                    dataframe.set_axis('columns', dataframe.columns.map(preheader_column_mapper))
-
-                    # build the headers
-                    headers = BuildSeriesFileHeader(series_list, site, source, qualifier_codes, censorcodes, dataframe=dataframe)
+                    columns = list(dataframe.columns)
+
+                    _RenameDuplicateVariableColumns(dataframe)
+                    header_columns = dataframe.columns
+
+                    def build_headers():
+                        return BuildSeriesFileHeader(series_list, site, source, qualifier_codes, censorcodes,
+                                                     columns=header_columns)
+
+                    # Streamed values only know their qualifiers and censor codes once they were all written
+                    headers = build_headers if dataframe_chunks is not None else build_headers()
 
                     # call set_axis again to remove multi-level column names and get the expected CSV output
                     dataframe.set_axis('columns', dataframe.columns.map(lambda x: x[0] if len(x) > 1 else x))  #
 
-                    if WriteSeriesToFile(fpath, dataframe, headers):
-                        return fpath
+                    if dataframe_chunks is not None:
+                        dataframe_chunks = _ConformChunks(dataframe_chunks, dataframe.columns)
+
+                    if WriteSeriesToFile(fpath, dataframe, headers, dataframe_chunks, file_format):
+                        manifest = None
+                        if incremental and watermark is not None:
+                            manifest = CsvFileManifest(fpath, watermark=watermark, columns=columns,
+                                                       qualifier_ids=sorted([q_code[0] for q_code in qualifier_codes]))
+                        return _SaveManifest(fpath, manifest, value_summary)
                     else:
                         print('Unable to write series to file {}'.format(fpath))
                         failed_files.append((fpath, 'Unable to write series to file'))
 
                 else:
+                    dataframe.sort_index(inplace=True)
                     if AppendSeriesToFile(fpath, dataframe):
-                        return fpath
+                        manifest.watermark = watermark
+                        return _SaveManifest(fpath, manifest, value_summary)
                     else:
                         print('Unable to append series to file {}'.format(fpath))
                         failed_files.append((fpath, 'Unable to append series to file'))
 
             elif dataframe is None and csv_end_datetime is not None:
                 print('File exists but there are no new data values to write')
-                # return fpath
+                manifest.watermark = watermark
+                return _SaveManifest(fpath, manifest, value_summary)
             else:
                 print('No data values exist for this dataset')
                 failed_files.append((fpath, 'No data values found for file'))
@@ -364,6 +855,122 @@ def BuildCsvFile(series_service, series_list, year=None, failed_files=None):  #
     return None
 
 
+def _SaveManifest(fpath, manifest, value_summary):
+    """
+    Records the state of a file that was just written or appended to, if incremental exports are being tracked
+    """
+    if manifest is None:
+        CsvFileManifest.Remove(fpath)
+    else:
+        manifest.value_summary = CsvFileManifest.SummaryEntries(value_summary)
+        manifest.Save()
+    return fpath
+
+
+def BuildYearlyCsvFiles(series_service, series_list, failed_files=None, file_format=CSV_FORMAT):  # type: (SeriesService, list[Series], list[tuple(str)], str) -> list[str]
+    """
+    Writes one file per calendar year from a single pass over the values of `series_list`, ordered by time, instead
+    of querying the values (and qualifiers) again for every year. Years without values don't get a file.
+
+    Each file has the columns, qualifiers and censor codes of its own year, as if its values had been queried alone.
+    A year's header is only known once all of its values were read, so it is written when the file is closed.
+
+    :return: list of the files that were written
+    """
+    if failed_files is None:
+        failed_files = list()
+
+    written_files = []
+
+    try:
+        details = _GetSeriesListDetails(series_list)
+        if details is None:
+            return written_files
+
+        site, source, qc, variables, variable_codes, methods = details
+
+        stopwatch_timer = None
+        if APP_SETTINGS.VERBOSE:
+            stopwatch_timer = datetime.datetime.now()
+            print('Querying values for yearly files of {}'.format(GetDatasetFilePath(site, source, qc, variable_codes,
+                                                                                     file_format=file_format)))
+
+        value_codes = {}
+        pieces = _ShapeValueChunks(series_service, series_list, site.id, qc.id, source.id, methods, variables, None,
+                                   by_year=True, value_codes=value_codes)
+        first_piece = next(pieces, None)
+
+        if APP_SETTINGS.VERBOSE:
+            print('Query execution took {}'.format(datetime.datetime.now() - stopwatch_timer))
+
+        if first_piece is None:
+            print('No data values exist for this dataset')
+            failed_files.append((GetDatasetFilePath(site, source, qc, variable_codes, file_format=file_format),
+                                 'No data values found for file'))
+            return written_files
+
+        writer = None
+        fpath = None
+        current_year = None
+        header_columns = None
+        file_columns = None
+
+        def close_year():
+            qualifier_codes, censorcodes = value_codes[current_year]
+            headers = BuildSeriesFileHeader(series_list, site, source, qualifier_codes, censorcodes,
+                                            columns=header_columns)
+            if writer.Close(headers):
+                written_files.append(fpath)
+            else:
+                print('Unable to write series to file {}'.format(fpath))
+                failed_files.append((fpath, 'Unable to write series to file'))
+
+        try:
+            for year, chunk in itertools.chain([first_piece], pieces):
+                chunk.sort_index(inplace=True)
+
+                if year != current_year:
+                    if writer is not None:
+                        close_year()
+                        writer = None
+
+                    current_year = year
+                    fpath = GetDatasetFilePath(site, source, qc, variable_codes, year, file_format)
+
+                    # Files written here are complete rewrites - drop any incremental export state
+                    CsvFileManifest.Remove(fpath)
+
+                    _RenameDuplicateVariableColumns(chunk)
+                    header_columns = chunk.columns
+                    file_columns = chunk.columns.map(lambda x: x[0] if len(x) > 1 else x)
+
+                    writer = GetDatasetWriter(file_format)
+                    if not writer.Open(fpath):
+                        writer = None
+                        print('Unable to write series to file {}'.format(fpath))
+                        failed_files.append((fpath, 'Unable to write series to file'))
+                        return written_files
+
+                    print('Writing datasets to file: {}'.format(fpath))
+                    pub.sendMessage('logger', message='Creating dataset file: %s' % os.path.basename(fpath))
+
+                # Every piece of a year has the same columns
+                chunk.columns = file_columns
+                writer.Write(chunk)
+
+            if writer is not None:
+                close_year()
+                writer = None
+        finally:
+            if writer is not None:
+                writer.Discard()
+
+    except TypeError as e:
+        print('Exception encountered while building yearly csv files: {}'.format(e))
+
+    return written_files
+
+
 def AppendSeriesToFile(csv_name, dataframe):
     if dataframe is None and not APP_SETTINGS.SKIP_QUERIES:
         print('No dataframe is available to write to file {}'.format(csv_name))
@@ -384,7 +991,10 @@ def AppendSeriesToFile(csv_name, dataframe):
     return True
 
 
-def WriteSeriesToFile(csv_name, dataframe, headers):
+def WriteSeriesToFile(csv_name, dataframe, headers, chunks=None, file_format=CSV_FORMAT):
+    """
+    :param headers: the file header, or a function that builds it once `dataframe` and `chunks` were written
+    """
     if dataframe is None and not APP_SETTINGS.SKIP_QUERIES:
         print('No dataframe is available to write to file {}'.format(csv_name))
         return False
@@ -392,18 +1002,25 @@ def WriteSeriesToFile(csv_name, dataframe, headers):
         print('Writing test datasets to file: {}'.format(csv_name))
 
         return True
-    file_out = createFile(csv_name)
-    if file_out is None:
+    build_headers = headers if callable(headers) else None
+    writer = GetDatasetWriter(file_format)
+    if not writer.Open(csv_name, None if build_headers is not None else headers):
         print('Unable to create output file {}'.format(csv_name))
         return False
     else:
-        # Write data to CSV file
+        # Write data to the file in the chosen format
         print('Writing datasets to file: {}'.format(csv_name))
         pub.sendMessage('logger', message='Creating dataset file: %s' % os.path.basename(csv_name))
-        file_out.write(headers)
-        dataframe.to_csv(file_out)
-        file_out.close()
-    return True
+        try:
+            writer.Write(dataframe)
+            if chunks is not None:
+                # Any further pieces of a streamed query follow the first one
+                for chunk in chunks:
+                    writer.Write(chunk)
+        except Exception:
+            writer.Discard()
+            raise
+    return writer.Close(build_headers() if build_headers is not None else None)
 
 
 def GetSeriesYearRange(series_list):
@@ -417,7 +1034,8 @@ def GetSeriesYearRange(series_list):
     return range(start_date.year, end_date.year + 1)
 
 
-def BuildSeriesFileHeader(series_list, site, source, qualifier_codes=None, censorcodes=None, dataframe=None):
+def BuildSeriesFileHeader(series_list, site, source, qualifier_codes=None, censorcodes=None, dataframe=None,
+                          columns=None):
     """
     Creates a file header for CSV files
 
@@ -426,6 +1044,7 @@ def BuildSeriesFileHeader(series_list, site, source, qualifier_codes=None, censo
     :param source:
     :param qualifier_codes:
     :param censorcodes:
+    :param columns: the (column name, MethodID) columns of the file, if `dataframe` isn't given
     :return: a tuple containing the header and a list of the column names for a dataframe
     """
 
@@ -443,7 +1062,7 @@ def BuildSeriesFileHeader(series_list, site, source, qualifier_codes=None, censo
         var_data = CompactVariableData()
 
         mapped = []  # [(column_name, series), ...]
-        for column in dataframe.columns:
+        for column in (columns if columns is not None else dataframe.columns):
             colname, methid = column
             for series in series_list:
                 if series.method_id == methid:
@@ -0,0 +1,406 @@
+import datetime
+import gzip
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+__title__ = 'Dataset Writers'
+
+CSV_FORMAT = 'csv'
+INDEX_COLUMNS = ["LocalDateTime", "UTCOffset", "DateTimeUTC"]
+PART_EXTENSION = '.part'  # Rows written before the header is known
+COPY_BUFFER_SIZE = 1048576
+
+
+def _IsTextColumn(dataframe, column):
+    """
+    Value columns are filled with the no-data value, so a column with nothing but missing values is a qualifier or
+    censor code column that has no codes in this piece of the file
+    """
+    return dataframe[column].dtype == object or dataframe[column].isnull().all()
+
+
+def _TextValues(series):
+    return np.array([None if pd.isnull(value) else unicode(value) for value in series], dtype=object)
+
+
+class DatasetWriter(object):
+    """
+    Writes a dataset file one piece of values at a time, so a streamed query never has to be held in memory:
+
+        writer = GetDatasetWriter('csv.gz')
+        if writer.Open(file_path, headers):
+            for dataframe in chunks:
+                writer.Write(dataframe)
+            writer.Close()
+
+    Every piece has the same columns, indexed by LocalDateTime, UTCOffset and DateTimeUTC. `headers` is the comment
+    header built by BuildSeriesFileHeader. When the header depends on the values being written, it can be left out
+    of `Open` and given to `Close` instead; the rows are then kept aside until the header is known.
+    """
+    FORMAT = None
+    EXTENSION = None
+    DESCRIPTION = None
+
+    @classmethod
+    def IsAvailable(cls):
+        return True
+
+    def Open(self, file_path, headers=None):
+        """
+        :return: True if the file was created
+        """
+        raise NotImplementedError()
+
+    def Write(self, dataframe):
+        raise NotImplementedError()
+
+    def Close(self, headers=None):
+        """
+        :param headers: the header, if it wasn't given to `Open`
+        :return: True if the file was completed
+        """
+        raise NotImplementedError()
+
+    def Discard(self):
+        """
+        Stops writing and removes the unfinished file
+        """
+        raise NotImplementedError()
+
+
+def _RemoveFile(file_path):
+    if file_path is not None and os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class CsvWriter(DatasetWriter):
+    FORMAT = CSV_FORMAT
+    EXTENSION = 'csv'
+    DESCRIPTION = 'CSV'
+
+    def __init__(self):
+        self._file_path = None
+        self._body_path = None
+        self._file = None
+        self._write_column_names = True
+
+    def _OpenFile(self, file_path):
+        return open(file_path, 'w')
+
+    def Open(self, file_path, headers=None):
+        self._file_path = file_path
+        self._body_path = None if headers is not None else file_path + PART_EXTENSION
+        self._write_column_names = True
+        try:
+            print('Creating new file {}'.format(file_path))
+            if self._body_path is None:
+                self._file = self._OpenFile(file_path)
+                self._file.write(headers)
+            else:
+                self._file = open(self._body_path, 'w')
+        except Exception as e:
+            print('---\nIssue encountered while creating a new file: \n{}\n---'.format(e))
+            return False
+        return True
+
+    def Write(self, dataframe):
+        # Pieces after the first one don't repeat the column names
+        dataframe.to_csv(self._file, header=self._write_column_names)
+        self._write_column_names = False
+
+    def Close(self, headers=None):
+        if self._file is None:
+            return False
+        self._file.close()
+        self._file = None
+
+        if self._body_path is None:
+            return True
+
+        # Put the header in front of the rows
+        body_path, self._body_path = self._body_path, None
+        try:
+            with open(body_path, 'r') as body:
+                file_out = self._OpenFile(self._file_path)
+                try:
+                    file_out.write(headers)
+                    shutil.copyfileobj(body, file_out, COPY_BUFFER_SIZE)
+                finally:
+                    file_out.close()
+        except (IOError, OSError) as e:
+            print('---\nIssue encountered while writing file {}: \n{}\n---'.format(self._file_path, e))
+            return False
+        finally:
+            _RemoveFile(body_path)
+        return True
+
+    def Discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        _RemoveFile(self._body_path if self._body_path is not None else self._file_path)
+        self._body_path = None
+
+
+class GzipCsvWriter(CsvWriter):
+    """
+    The same text as CsvWriter, compressed as it is written
+    """
+    FORMAT = 'csv.gz'
+    EXTENSION = 'csv.gz'
+    DESCRIPTION = 'CSV (gzip)'
+    COMPRESS_LEVEL = 6  # Most of the size reduction of level 9, in far less time
+
+    def _OpenFile(self, file_path):
+        return gzip.open(file_path, 'wb', GzipCsvWriter.COMPRESS_LEVEL)
+
+
+class ParquetWriter(DatasetWriter):
+    """
+    One row group per piece of values. The index becomes the first three columns, and the comment header is kept in
+    the file's key/value metadata under 'h2o_header'. A header given to `Close` is only known after the row groups
+    were written, so they are then copied into the final file.
+    """
+    FORMAT = 'parquet'
+    EXTENSION = 'parquet'
+    DESCRIPTION = 'Parquet'
+
+    def __init__(self):
+        self._file_path = None
+        self._body_path = None
+        self._headers = None
+        self._writer = None
+        self._schema = None
+
+    @classmethod
+    def IsAvailable(cls):
+        return pyarrow is not None
+
+    def Open(self, file_path, headers=None):
+        if pyarrow is None:
+            print('Unable to write {}: the pyarrow package is not installed'.format(file_path))
+            return False
+
+        print('Creating new file {}'.format(file_path))
+        self._file_path = file_path
+        self._body_path = None if headers is not None else file_path + PART_EXTENSION
+        self._headers = headers
+        return True
+
+    def _Metadata(self, headers):
+        return {'h2o_header': headers, 'h2o_created': datetime.datetime.utcnow().isoformat()}
+
+    def _CreateWriter(self, dataframe):
+        # The schema comes from the first piece; every following piece is converted to it
+        fields = [pyarrow.field(INDEX_COLUMNS[0], pyarrow.timestamp('ms')),
+                  pyarrow.field(INDEX_COLUMNS[1], pyarrow.float64()),
+                  pyarrow.field(INDEX_COLUMNS[2], pyarrow.timestamp('ms'))]
+        for column in dataframe.columns:
+            field_type = pyarrow.string() if _IsTextColumn(dataframe, column) else pyarrow.float64()
+            fields.append(pyarrow.field(unicode(column), field_type))
+
+        self._schema = pyarrow.schema(fields)
+        if self._body_path is None:
+            self._schema = self._schema.with_metadata(self._Metadata(self._headers))
+        self._writer = pyarrow.parquet.ParquetWriter(self._body_path or self._file_path, self._schema)
+
+    def Write(self, dataframe):
+        if self._writer is None:
+            self._CreateWriter(dataframe)
+
+        arrays = []
+        for field, column in zip(self._schema, range(-len(INDEX_COLUMNS), len(dataframe.columns))):
+            if column < 0:
+                values = dataframe.index.get_level_values(column + len(INDEX_COLUMNS)).values
+                if field.type != pyarrow.float64():
+                    values = values.astype('datetime64[ms]')
+            else:
+                values = dataframe.iloc[:, column]
+                values = _TextValues(values) if field.type == pyarrow.string() else values.values.astype(np.float64)
+            arrays.append(pyarrow.array(values, type=field.type))
+
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+    def Close(self, headers=None):
+        if self._writer is None:
+            print('Unable to write {}: no values were written to it'.format(self._file_path))
+            self.Discard()
+            return False
+        self._writer.close()
+        self._writer = None
+
+        if self._body_path is None:
+            return True
+
+        body_path, self._body_path = self._body_path, None
+        try:
+            metadata = self._Metadata(headers)
+            body = pyarrow.parquet.ParquetFile(body_path)
+            writer = pyarrow.parquet.ParquetWriter(self._file_path, self._schema.with_metadata(metadata))
+            try:
+                for row_group in range(body.num_row_groups):
+                    writer.write_table(body.read_row_group(row_group).replace_schema_metadata(metadata))
+            finally:
+                writer.close()
+        except Exception as e:
+            print('---\nIssue encountered while writing file {}: \n{}\n---'.format(self._file_path, e))
+            return False
+        finally:
+            _RemoveFile(body_path)
+        return True
+
+    def Discard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        _RemoveFile(self._body_path if self._body_path is not None else self._file_path)
+        self._body_path = None
+
+
+class NetCdfWriter(DatasetWriter):
+    """
+    A CF-style time series: an unlimited `time` dimension from DateTimeUTC, the local time and UTC offset as
+    auxiliary variables, and one variable per file column. The comment header is kept in the global attributes,
+    which can still be set after the values were written.
+    """
+    FORMAT = 'netcdf'
+    EXTENSION = 'nc'
+    DESCRIPTION = 'NetCDF'
+    TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+    def __init__(self):
+        self._file_path = None
+        self._dataset = None
+        self._variables = None  # type: list[tuple]
+
+    @classmethod
+    def IsAvailable(cls):
+        return netCDF4 is not None
+
+    def Open(self, file_path, headers=None):
+        if netCDF4 is None:
+            print('Unable to write {}: the netCDF4 package is not installed'.format(file_path))
+            return False
+
+        try:
+            print('Creating new file {}'.format(file_path))
+            self._file_path = file_path
+            self._dataset = netCDF4.Dataset(file_path, 'w', format='NETCDF4')
+        except Exception as e:
+            print('---\nIssue encountered while creating a new file: \n{}\n---'.format(e))
+            return False
+
+        self._dataset.Conventions = 'CF-1.6'
+        self._dataset.featureType = 'timeSeries'
+        self._dataset.history = 'Created {} by the H2O Utility'.format(datetime.datetime.utcnow().isoformat())
+        if headers is not None:
+            self._dataset.h2o_header = headers
+
+        self._dataset.createDimension('time', None)
+        time = self._dataset.createVariable('time', 'f8', ('time',))
+        time.standard_name = 'time'
+        time.units = NetCdfWriter.TIME_UNITS
+        time.calendar = 'standard'
+
+        local_time = self._dataset.createVariable('local_time', 'f8', ('time',))
+        local_time.long_name = 'LocalDateTime'
+        local_time.units = NetCdfWriter.TIME_UNITS
+        local_time.comment = 'Local time of the values; subtract utc_offset hours to get UTC'
+
+        utc_offset = self._dataset.createVariable('utc_offset', 'f8', ('time',))
+        utc_offset.long_name = 'UTCOffset'
+        utc_offset.units = 'hours'
+        return True
+
+    @staticmethod
+    def _Seconds(values):
+        return np.asarray(values, dtype='datetime64[ms]').astype(np.int64) / 1000.0
+
+    def _CreateVariables(self, dataframe):
+        self._variables = []
+        used_names = set(['time', 'local_time', 'utc_offset'])
+        for column in dataframe.columns:
+            name = re.sub(r'[^A-Za-z0-9_]', '_', unicode(column))
+            if not name or not name[0].isalpha():
+                name = 'v_' + name
+            while name in used_names:
+                name += '_'
+            used_names.add(name)
+
+            is_text = _IsTextColumn(dataframe, column)
+            variable = self._dataset.createVariable(name, str if is_text else 'f8', ('time',))
+            variable.long_name = unicode(column)
+            self._variables.append((variable, is_text))
+
+    def Write(self, dataframe):
+        if self._variables is None:
+            self._CreateVariables(dataframe)
+
+        start = len(self._dataset.dimensions['time'])
+        stop = start + len(dataframe)
+        self._dataset.variables['time'][start:stop] = self._Seconds(dataframe.index.get_level_values(2).values)
+        self._dataset.variables['local_time'][start:stop] = self._Seconds(dataframe.index.get_level_values(0).values)
+        self._dataset.variables['utc_offset'][start:stop] = dataframe.index.get_level_values(1).values
+
+        for column, (variable, is_text) in enumerate(self._variables):
+            values = dataframe.iloc[:, column]
+            if is_text:
+                values = np.array([u'' if value is None else value for value in _TextValues(values)], dtype=object)
+            else:
+                values = values.values.astype(np.float64)
+            variable[start:stop] = values
+
+    def Close(self, headers=None):
+        if self._dataset is None:
+            return False
+        try:
+            if headers is not None:
+                self._dataset.h2o_header = headers
+        finally:
+            self._dataset.close()
+            self._dataset = None
+        return True
+
+    def Discard(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+        _RemoveFile(self._file_path)
+
+
+# In the order they are offered in the file format choice
+DATASET_FORMATS = [CsvWriter.FORMAT, GzipCsvWriter.FORMAT, ParquetWriter.FORMAT, NetCdfWriter.FORMAT]
+DATASET_WRITERS = dict((writer.FORMAT, writer) for writer in [CsvWriter, GzipCsvWriter, ParquetWriter, NetCdfWriter])
+
+
+def GetDatasetWriter(file_format=CSV_FORMAT):
+    """
+    :param file_format: a key of DATASET_WRITERS
+    :return: a new DatasetWriter for the format
+    """
+    if file_format not in DATASET_WRITERS:
+        raise ValueError('Unknown dataset file format: {}'.format(file_format))
+    return DATASET_WRITERS[file_format]()
+
+
+def GetDatasetFileExtension(file_format=CSV_FORMAT):
+    return DATASET_WRITERS[file_format].EXTENSION
+
+
+def GetDatasetFormatDescription(file_format=CSV_FORMAT):
+    return DATASET_WRITERS[file_format].DESCRIPTION
@@ -1,17 +1,24 @@
+import atexit
 import datetime
 from exceptions import IOError
-from threading import Thread
+from Queue import Empty, Full, Queue
+from threading import Lock, Thread, current_thread
+from time import time
 
-import jsonpickle
+import os
 import sys
 from pubsub import pub
 # from pubsub import pub
 
+from GAMUTRawData.odmdata import engine_registry
 from GAMUTRawData.odmservices import ServiceManager
 from H2OSeries import OdmSeriesHelper
 from Common import APP_SETTINGS, InitializeDirectories
-from Utilities.DatasetUtilities import BuildCsvFile, GetSeriesYearRange, H2OManagedResource, OdmDatasetConnection
-from Utilities.HydroShareUtility import HydroShareAccountDetails, HydroShareUtility, ResourceTemplate
+from Utilities.DatasetUtilities import BuildCsvFile, BuildYearlyCsvFiles, GetSeriesYearRange, H2OManagedResource, \
+    OdmDatasetConnection
+from Utilities.DatasetWriters import CSV_FORMAT
+from Utilities.HydroShareUtility import HydroShareAccountDetails, HydroShareUtility, ResourceTemplate, UploadJournal
+from Utilities.OperationsFile import OperationsFile, OperationsFileException
 
 __title__ = 'H2O Service'
 
@@ -40,13 +47,19 @@ class H2OService:
         self.ManagedResources = managed_resources if managed_resources is not None else {}  # type: dict[str, H2OManagedResource]
         self.Subscriptions = subscriptions if subscriptions is not None else []  # type: list[str]
 
-        InitializeDirectories([APP_SETTINGS.DATASET_DIR, APP_SETTINGS.LOGFILE_DIR])
-        sys.stdout = H2OLogger(log_to_gui='logger' in self.Subscriptions)
+        InitializeDirectories([APP_SETTINGS.DATASET_DIR, APP_SETTINGS.LOGFILE_DIR, APP_SETTINGS.CATALOG_CACHE_DIR])
+        engine_registry.configure(pool_size=APP_SETTINGS.DB_POOL_SIZE,
+                                  pool_timeout=APP_SETTINGS.DB_POOL_TIMEOUT,
+                                  pool_recycle=APP_SETTINGS.DB_POOL_RECYCLE,
+                                  pool_pre_ping=APP_SETTINGS.DB_POOL_PRE_PING,
+                                  connect_timeout=APP_SETTINGS.DB_CONNECT_TIMEOUT)
+        self.Logger = H2OLogger(log_to_gui='logger' in self.Subscriptions)
 
         self.ThreadedFunction = None  # type: Thread
         self.StopThread = False
 
         self.ActiveHydroshare = None  # type: HydroShareUtility
+        self._operations_files = {}  # type: dict[str, OperationsFile]
 
         self.csv_indexes = ["LocalDateTime", "UTCOffset", "DateTimeUTC"]
         self.qualifier_columns = ["QualifierID", "QualifierCode", "QualifierDescription"]
@@ -99,9 +112,115 @@ class H2OService:
         else:
             return True
 
+    def _build_chunk_files(self, series_service, chunk, chunk_years, db_name, odm_series, file_format=CSV_FORMAT):
+        """
+        Generates the file (or the files for each year) for one chunk of series
+
+        :type series_service: SeriesService
+        :type chunk: list[H2OSeries]
+        :param odm_series: dict of odm_id to the ODM series already fetched from the database
+        :param file_format: a key of DatasetWriters.DATASET_WRITERS
+        :return: a tuple of (generated file paths, list of (file name, failure message) tuples)
+        """
+        failed_files = []
+        generated_files = []
+        odm_series_list = []
+        for h2o_series in chunk:
+            result_series = odm_series.get(h2o_series.odm_id, None)
+            if result_series is None:
+                msg = 'Error: Unable to fetch ODM series {} from database {}'.format(h2o_series, db_name)
+
+                self.NotifyVisualH2O('Operations_Stopped', msg)
+
+            else:
+                odm_series_list.append(result_series)
+
+        if chunk_years and (not APP_SETTINGS.INCREMENTAL_EXPORT or file_format != CSV_FORMAT):
+            self._thread_checkpoint()
+
+            # Split the values into yearly files in one pass instead of querying them once per year
+            generated_files.extend(BuildYearlyCsvFiles(series_service, odm_series_list, failed_files, file_format))
+
+        elif chunk_years:
+
+            # Incremental exports keep a manifest per yearly file, so each year is brought up to date on its own
+            for year in GetSeriesYearRange(odm_series_list):
+                self._thread_checkpoint()
+
+                result_file = BuildCsvFile(series_service, odm_series_list, year, failed_files, file_format=file_format)
+                if result_file is not None:
+                    generated_files.append(result_file)
+
+        else:
+            self._thread_checkpoint()
+
+            result_file = BuildCsvFile(series_service, odm_series_list, failed_files=failed_files,
+                                       file_format=file_format)
+            if result_file is not None:
+                generated_files.append(result_file)
+
+        return generated_files, failed_files
+
+    @staticmethod
+    def _chunk_task_keys(rsrc, chunk):
+        """
+        Dataset files are named after their site, source, QC level and (for a single variable) variable, not after
+        their resource, so chunks of different resources can write the same files.
+
+        :type rsrc: H2OManagedResource
+        :type chunk: list[H2OSeries]
+        :return: a tuple of (the key of the files the chunk writes, the key of the chunk's task). Chunks with the
+                 same task key write the same files with the same values.
+        """
+        file_format = getattr(rsrc, 'file_format', CSV_FORMAT)  # Resources saved before formats existed are CSV
+        variable_codes = set(series.VariableCode for series in chunk)
+        file_key = (chunk[0].SiteCode, chunk[0].SourceID, chunk[0].QualityControlLevelCode,
+                    variable_codes.pop() if len(variable_codes) == 1 else None, file_format)
+        task_key = (file_key, bool(rsrc.chunk_years), frozenset(series.odm_id for series in chunk))
+        return file_key, task_key
+
+    def _dataset_worker(self, series_service_factory, db_name, odm_ids, task_queue, result_queue):
+        """
+        Builds chunk files from `task_queue` until it receives `None`. Each worker uses its own SeriesService, and
+        therefore its own database session, and fetches all of the series in `odm_ids` with it in one query.
+        Each task comes with the lock of the files it writes, so two workers never write the same file at once.
+        """
+        series_service = None
+        odm_series = None
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            task_key, rsrc, chunk, file_lock = task
+            file_format = getattr(rsrc, 'file_format', CSV_FORMAT)
+            try:
+                self._thread_checkpoint()
+                if series_service is None:
+                    series_service = series_service_factory()
+                if odm_series is None:
+                    odm_series = series_service.get_series_by_odm_ids(odm_ids)
+                with file_lock:
+                    if APP_SETTINGS.VERBOSE:
+                        with series_service.count_statements() as counter:
+                            result = self._build_chunk_files(series_service, chunk, rsrc.chunk_years, db_name,
+                                                             odm_series, file_format)
+                        print('-- {} SQL statements for {} file(s) of {}'.format(counter.count, len(result[0]),
+                                                                                rsrc.resource_id))
+                    else:
+                        result = self._build_chunk_files(series_service, chunk, rsrc.chunk_years, db_name,
+                                                         odm_series, file_format)
+                result_queue.put((task_key, result, None))
+            except Exception as e:
+                result_queue.put((task_key, None, e))
+
+        if series_service is not None:
+            series_service.close()
+
     def _generate_datasets(self, resource=None):
         dataset_count = len(self.ManagedResources)
         current_dataset = 0
+        generated_datasets = 0
         odm_service = ServiceManager()
 
         database_resource_dict = {}
@@ -135,13 +254,39 @@ class H2OService:
             else:
                 continue
 
-            series_service = odm_service.get_series_service()
+            odm_ids = set()
             for rsrc in database_resource_dict[db_dame]:
+                odm_ids.update(h2o_series.odm_id for h2o_series in rsrc.selected_series.itervalues())
 
-                # Reset the associated files so they don't keep getting uploaded over, and over, and over, and over, and over, and...
-                rsrc.associated_files = []
+            # Qualifiers are read once per run and shared by every file of this database
+            series_service = odm_service.get_series_service()
+            try:
+                series_service.clear_catalog_cache()
+                series_service.get_qualifier_lookup()
+            finally:
+                series_service.close()
+
+            task_queue = Queue()
+            result_queue = Queue()
+            workers = [Thread(target=self._dataset_worker,
+                              args=(odm_service.get_series_service, db_dame, odm_ids, task_queue, result_queue))
+                       for _ in range(APP_SETTINGS.DATASET_WORKERS)]
+            for worker in workers:
+                worker.start()
+
+            pending_chunks = {}  # type: dict[str, int]
+            chunk_files = {}  # type: dict[str, dict[int, list[str]]]
+            # Identical chunks of different resources are only built once, and share their files
+            task_chunks = {}  # type: dict[tuple, list[tuple(H2OManagedResource, int)]]
+            file_locks = {}  # type: dict[tuple, Lock]
+
+            try:
+                for rsrc in database_resource_dict[db_dame]:
+
+                    # Reset the associated files so they don't keep getting uploaded over, and over, and over, and over, and over, and...
+                    rsrc.associated_files = []
+                    self.MarkResourceChanged(rsrc.resource_id)
 
-                try:
                     self._thread_checkpoint()
                     if rsrc.resource is None:
                         print('Error encountered: resource {} is missing values'.format(rsrc.resource_id))
@@ -149,63 +294,90 @@ class H2OService:
 
                     current_dataset += 1
                     self.NotifyVisualH2O('Dataset_Started', rsrc.resource.title, current_dataset, dataset_count)
-                    self._thread_checkpoint()
 
                     chunks = OdmSeriesHelper.DetermineForcedSeriesChunking(rsrc)
                     print('\n -- {} has {} chunks {}'.format(rsrc.resource.title, len(chunks),
                                                              'per year' if rsrc.chunk_years else ''))
-                    for chunk in chunks:
-                        self._thread_checkpoint()
-                        failed_files = []
-                        odm_series_list = []
-                        for h2o_series in chunk:
-                            result_series = series_service.get_series_from_filter(h2o_series.SiteID,
-                                                                                  h2o_series.VariableID,
-                                                                                  h2o_series.QualityControlLevelID,
-                                                                                  h2o_series.SourceID,
-                                                                                  h2o_series.MethodID)
-                            if result_series is None:
-                                msg = 'Error: Unable to fetch ODM series {} from database {}'.format(
-                                    h2o_series, db_dame)
 
-                                self.NotifyVisualH2O('Operations_Stopped', msg)
+                    if not len(chunks):
+                        generated_datasets += 1
+                        self.NotifyVisualH2O('Dataset_Generated', rsrc.resource.title, generated_datasets,
+                                             dataset_count)
+                        continue
 
-                            else:
-                                odm_series_list.append(result_series)
+                    pending_chunks[rsrc.resource_id] = len(chunks)
+                    chunk_files[rsrc.resource_id] = {}
+                    for chunk_index, chunk in enumerate(chunks):
+                        file_key, task_key = self._chunk_task_keys(rsrc, chunk)
+                        if task_key in task_chunks:
+                            task_chunks[task_key].append((rsrc, chunk_index))
+                            continue
 
-                        if rsrc.chunk_years:
+                        task_chunks[task_key] = [(rsrc, chunk_index)]
+                        if file_key not in file_locks:
+                            file_locks[file_key] = Lock()
+                        task_queue.put((task_key, rsrc, chunk, file_locks[file_key]))
 
-                            for year in GetSeriesYearRange(odm_series_list):
-                                self._thread_checkpoint()
+                while len(pending_chunks):
+                    try:
+                        task_key, result, error = result_queue.get(True, 0.5)
+                    except Empty:
+                        self._thread_checkpoint()
+                        continue
 
-                                result_file = BuildCsvFile(series_service, odm_series_list, year, failed_files)
-                                if result_file is not None:
-                                    rsrc.associated_files.append(result_file)
+                    if error is not None:
+                        raise error
 
-                        else:
-                            self._thread_checkpoint()
+                    generated_files, failed_files = result
+                    for filename, message in failed_files:
+                        self.NotifyVisualH2O('File_Failed', filename, message)
 
-                            result_file = BuildCsvFile(series_service, odm_series_list, failed_files=failed_files)
-                            if result_file is not None:
-                                rsrc.associated_files.append(result_file)
+                    for rsrc, chunk_index in task_chunks.pop(task_key):
+                        chunk_files[rsrc.resource_id][chunk_index] = generated_files
+                        pending_chunks[rsrc.resource_id] -= 1
 
-                        for filename, message in failed_files:
-                            self.NotifyVisualH2O('File_Failed', filename, message)
+                        if pending_chunks[rsrc.resource_id] == 0:
+                            del pending_chunks[rsrc.resource_id]
+                            # Keep the files in chunk order, no matter which worker finished first
+                            for index in sorted(chunk_files[rsrc.resource_id].keys()):
+                                rsrc.associated_files.extend(chunk_files[rsrc.resource_id][index])
+                            self.MarkResourceChanged(rsrc.resource_id)
 
-                    self.NotifyVisualH2O('Dataset_Generated', rsrc.resource.title, current_dataset, dataset_count)
+                            generated_datasets += 1
+                            self.NotifyVisualH2O('Dataset_Generated', rsrc.resource.title, generated_datasets,
+                                                 dataset_count)
 
-                except H2OService.StopThreadException as e:
-                    print('Dataset generation stopped: {}'.format(e))
-                    return 0
-                except Exception as e:
-                    self.NotifyVisualH2O('Operations_Stopped',
-                                         'Exception encountered while generating datasets:\n{}'.format(e))
-                    return 0
+            except H2OService.StopThreadException as e:
+                print('Dataset generation stopped: {}'.format(e))
+                return 0
+            except Exception as e:
+                self.NotifyVisualH2O('Operations_Stopped',
+                                     'Exception encountered while generating datasets:\n{}'.format(e))
+                return 0
+            finally:
+                self._stop_dataset_workers(workers, task_queue)
 
         print('Dataset generation completed without error')
         self.NotifyVisualH2O('Datasets_Completed', current_dataset, dataset_count)
         return current_dataset
 
+    @staticmethod
+    def _stop_dataset_workers(workers, task_queue):
+        """
+        Drops any chunks that haven't been started and waits for the workers to finish the files they are writing
+        """
+        try:
+            while True:
+                task_queue.get_nowait()
+        except Empty:
+            pass
+
+        for _ in workers:
+            task_queue.put(None)
+
+        for worker in workers:
+            worker.join()
+
     def _upload_files(self, resource=None):
         dataset_count = len(self.ManagedResources)
         current_dataset = 0
@@ -216,6 +388,8 @@ class H2OService:
         else:
             resources = self.ManagedResources.values()
 
+        upload_journal = UploadJournal()
+
         for resource in resources:
             self._thread_checkpoint()
 
@@ -250,8 +424,11 @@ class H2OService:
 
                 if APP_SETTINGS.DELETE_RESOURCE_FILES:
                     self.ActiveHydroshare.deleteFilesInResource(resource.resource_id)
+                    upload_journal.ClearResource(resource.resource.id)
 
-                self.ActiveHydroshare.UploadFiles(resource.associated_files, resource.resource)
+                self.ActiveHydroshare.UploadFiles(resource.associated_files, resource.resource, journal=upload_journal,
+                                                  stop_check=lambda: self.StopThread)
+                self._thread_checkpoint()
 
                 if APP_SETTINGS.SET_RESOURCES_PUBLIC:
                     self.ActiveHydroshare.setResourcesAsPublic([resource.resource_id])
@@ -297,6 +474,7 @@ class H2OService:
         if self.ThreadedFunction is not None:
             self.StopThread = True
             self.ThreadedFunction.join(3)
+            self.Logger.flush()
         else:
             self.NotifyVisualH2O('Operations_Stopped', 'Script was not running')
 
@@ -353,45 +531,59 @@ class H2OService:
                 'resource_templates': self.ResourceTemplates,
                 'managed_resources': self.ManagedResources}
 
-    def SaveData(self, output_file=None):
-        if output_file is None:
-            output_file = APP_SETTINGS.SETTINGS_FILE_NAME
-        try:
-
-            data = jsonpickle.encode(self.to_json())
+    def _get_operations_file(self, file_path=None):
+        """
+        Returns the OperationsFile for a path, keeping one per path so each remembers what it last saved
+        """
+        if file_path is None:
+            file_path = APP_SETTINGS.SETTINGS_FILE_NAME
+        if file_path not in self._operations_files:
+            self._operations_files[file_path] = OperationsFile(file_path)
+        return self._operations_files[file_path]
 
-            with open(output_file, 'w') as fout:
-                fout.write(data)
+    def MarkResourceChanged(self, resource_id):
+        """
+        Records that a managed resource was modified in place, so the next SaveData writes it again
+        """
+        for operations_file in self._operations_files.itervalues():
+            operations_file.MarkChanged(resource_id)
 
-            print('Dataset information successfully saved to {}'.format(output_file))
+    def SaveData(self, output_file=None):
+        operations_file = self._get_operations_file(output_file)
+        try:
+            if operations_file.Save(self.to_json()):
+                print('Dataset information successfully saved to {}'.format(operations_file.file_path))
             return True
-        except IOError as e:
-            print('Error saving to disk - file name {}\n{}'.format(output_file, e))
+        except (IOError, OSError, OperationsFileException) as e:
+            print('Error saving to disk - file name {}\n{}'.format(operations_file.file_path, e))
             return False
 
     def LoadData(self, input_file=None):
-        if input_file is None:
-            input_file = APP_SETTINGS.SETTINGS_FILE_NAME
+        operations_file = self._get_operations_file(input_file)
         try:
-            with open(input_file, 'r') as fin:
-
-                data = jsonpickle.decode(fin.read())
+            data = operations_file.Load()
 
-                if data is not None:
-                    self.HydroShareConnections = data.get('hydroshare_connections', {})
-                    self.DatabaseConnections = data.get('odm_connections', {})
-                    self.ResourceTemplates = data.get('resource_templates', {})
-                    self.ManagedResources = data.get('managed_resources', {})
+            if data is not None:
+                self.HydroShareConnections = data.get('hydroshare_connections', {})
+                self.DatabaseConnections = data.get('odm_connections', {})
+                self.ResourceTemplates = data.get('resource_templates', {})
+                self.ManagedResources = data.get('managed_resources', {})
 
-            print('Dataset information loaded from {}'.format(input_file))
+            print('Dataset information loaded from {}'.format(operations_file.file_path))
 
             return data
 
-        except IOError:
-            json_out = open(input_file, 'w')
-            json_out.write(jsonpickle.encode(self.to_json()))
-            json_out.close()
-            print('Settings file does not exist - creating: {}'.format(input_file))
+        except OperationsFileException as e:
+            print('Unable to load dataset information - {}'.format(e))
+            return None
+
+        except IOError as e:
+            if os.path.exists(operations_file.file_path):
+                # Never replace a file that exists but couldn't be read
+                print('Unable to read settings file {}\n{}'.format(operations_file.file_path, e))
+                return None
+            operations_file.Save(self.to_json())
+            print('Settings file does not exist - creating: {}'.format(operations_file.file_path))
             return None
 
     def CreateResourceFromTemplate(self, template):
@@ -404,16 +596,29 @@ class H2OService:
 
 
 class H2OLogger:
+    """
+    Replaces sys.stdout (and sys.stderr) and writes the messages to the terminal, the log file and, in verbose GUI
+    mode, the GUI log. `write` only queues the message; a background thread writes the queued messages in batches,
+    flushing the log file once per batch and rotating it when it grows past APP_SETTINGS.LOG_MAX_BYTES.
+    """
     def __init__(self, logfile_dir=None, log_to_gui=False):
         if logfile_dir is None:
             logfile_dir = APP_SETTINGS.LOGFILE_DIR
         self.log_to_gui = log_to_gui
         self.terminal = sys.stdout
         if APP_SETTINGS.H2O_DEBUG:
-            file_name = '{}/H2O_Log_{}.csv'.format(logfile_dir, 'TestFile')
+            self.file_name = '{}/H2O_Log_{}.csv'.format(logfile_dir, 'TestFile')
         else:
-            file_name = '{}/H2O_Log_{}.csv'.format(logfile_dir, datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-        self.LogFile = open(file_name, mode='w')
+            self.file_name = '{}/H2O_Log_{}.csv'.format(logfile_dir,
+                                                        datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+        self.LogFile = open(self.file_name, mode='w')
+
+        self._queue = Queue(maxsize=APP_SETTINGS.LOG_QUEUE_SIZE)
+        self._closed = False
+        self._writer = Thread(target=self._write_queued_messages, name='H2OLogger')
+        self._writer.setDaemon(True)
+        self._writer.start()
+        atexit.register(self.close)
 
         sys.stdout = self
         if not APP_SETTINGS.H2O_DEBUG:
@@ -421,16 +626,122 @@ class H2OLogger:
 
     def write(self, message):
         if len(message) > 0 and not message.isspace():
-            self.terminal.write(H2OLogger.prefix_date(message))
-            self.LogFile.write(H2OLogger.prefix_date(message))
-            self.LogFile.flush()
-            if APP_SETTINGS.GUI_MODE and APP_SETTINGS.VERBOSE:
-                pub.sendMessage('logger', message='H2OService: ' + str(message))
+            entry = (datetime.datetime.now(), message)
+            if current_thread() is self._writer:
+                # Anything printed while writing a batch (e.g. by a GUI log handler) can't wait on its own queue
+                self._write_batch([entry])
+                return
+
+            # Waits while the queue is full rather than dropping messages, unless the writer has stopped and
+            # will never empty it
+            while not self._closed and self._writer.is_alive():
+                try:
+                    self._queue.put(entry, True, APP_SETTINGS.LOG_FLUSH_INTERVAL)
+                    return
+                except Full:
+                    continue
+            self._write_unqueued(entry)
 
     @staticmethod
-    def prefix_date(message):
-        date_string = datetime.datetime.now().strftime('%H-%M-%S')
+    def prefix_date(message, timestamp=None):
+        date_string = (timestamp or datetime.datetime.now()).strftime('%H-%M-%S')
         return '{date}: {message}\n'.format(date=date_string, message=message)
 
-    def flush(self):
-        pass
+    def flush(self, timeout=None):
+        """
+        Waits until every message written so far is in the log file, but no longer than `timeout` seconds
+        (APP_SETTINGS.LOG_FLUSH_TIMEOUT by default)
+
+        :return: True if every message was written
+        """
+        if current_thread() is self._writer or not self._writer.is_alive():
+            return not self._queue.unfinished_tasks
+
+        if timeout is None:
+            timeout = APP_SETTINGS.LOG_FLUSH_TIMEOUT
+        deadline = time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time()
+                if remaining <= 0 or not self._writer.is_alive():
+                    return False
+                self._queue.all_tasks_done.wait(min(remaining, APP_SETTINGS.LOG_FLUSH_INTERVAL))
+        return True
+
+    def close(self):
+        """
+        Writes the remaining messages and closes the log file. Runs when the process exits. Messages written
+        afterwards only go to the terminal.
+        """
+        self._closed = True
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        if not self.LogFile.closed:
+            self.LogFile.close()
+
+    def _write_queued_messages(self):
+        while True:
+            try:
+                batch = [self._queue.get(True, APP_SETTINGS.LOG_FLUSH_INTERVAL)]
+            except Empty:
+                continue
+
+            try:
+                while len(batch) < APP_SETTINGS.LOG_QUEUE_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+
+            stop = None in batch
+            try:
+                self._write_batch([entry for entry in batch if entry is not None])
+            except Exception as e:
+                self.terminal.write('Unable to write to the log file: {}\n'.format(e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                break
+
+    def _write_unqueued(self, entry):
+        """
+        Writes a message straight to the terminal, for messages written once the log writer has stopped
+        """
+        try:
+            self.terminal.write(H2OLogger.prefix_date(entry[1], entry[0]))
+        except (IOError, ValueError):
+            pass
+
+    def _write_batch(self, batch):
+        if not len(batch):
+            return
+
+        lines = ''.join(H2OLogger.prefix_date(message, timestamp) for timestamp, message in batch)
+        self.terminal.write(lines)
+        self.LogFile.write(lines)
+        self.LogFile.flush()
+
+        if self.LogFile.tell() > APP_SETTINGS.LOG_MAX_BYTES:
+            self._rotate_log_file()
+
+        if APP_SETTINGS.GUI_MODE and APP_SETTINGS.VERBOSE:
+            # One message per batch; the GUI splits it back into lines
+            pub.sendMessage('logger', message='\n'.join('H2OService: ' + str(message) for _, message in batch))
+
+    def _rotate_log_file(self):
+        """
+        Renames the current log file to <name>.1.csv (and the older ones to .2, .3 and so on, keeping
+        APP_SETTINGS.LOG_BACKUP_COUNT of them) and starts a new one
+        """
+        self.LogFile.close()
+        root, extension = os.path.splitext(self.file_name)
+        for number in range(APP_SETTINGS.LOG_BACKUP_COUNT, 0, -1):
+            source = '{}.{}{}'.format(root, number - 1, extension) if number > 1 else self.file_name
+            target = '{}.{}{}'.format(root, number, extension)
+            if os.path.exists(source):
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        self.LogFile = open(self.file_name, mode='w')
@@ -3,14 +3,19 @@ import os
 import re
 import sys
 import json
+import urllib
+from Queue import Empty, Queue
+from threading import Lock, Thread
+from time import sleep, time
 
 import dateutil.parser
 from hs_restclient import HydroShareNotFound, HydroShareAuthBasic, HydroShareAuthOAuth2, HydroShare, HydroShareException
 from oauthlib.oauth2 import InvalidClientError, InvalidGrantError
+from requests.exceptions import RequestException
 
 from pubsub import pub
 from Common import APP_SETTINGS
-from Utilities.DatasetUtilities import H2OManagedResource
+from Utilities.DatasetUtilities import GetFileHash, H2OManagedResource
 
 
 class HydroShareAccountDetails:
@@ -186,6 +191,103 @@ class ResourceTemplate(object):
         return self.template_name
 
 
+class UploadJournal(object):
+    """
+    Records the content of the files that reached HydroShare. An interrupted upload resumes where it stopped, and
+    files whose content is the same as what was last uploaded are not sent again.
+
+    Uploads are written to disk in batches, every APP_SETTINGS.UPLOAD_JOURNAL_FLUSH_COUNT files or
+    APP_SETTINGS.UPLOAD_JOURNAL_FLUSH_INTERVAL seconds, and by `Flush`. A crash can only lose the last batch, whose
+    files are then compared with the checksums on HydroShare instead.
+    """
+
+    def __init__(self, journal_path=None):
+        if journal_path is None:
+            journal_path = os.path.join(APP_SETTINGS.USER_APP_DIR, 'upload_journal.json')
+        self.journal_path = journal_path
+        self._lock = Lock()
+        self._save_lock = Lock()  # Keeps snapshots of the entries reaching the file in the order they were taken
+        self._entries = self._load()  # type: dict[str, dict[str, dict]]
+        self._unsaved = 0
+        self._saved_at = time()
+
+    def _load(self):
+        try:
+            with open(self.journal_path, 'r') as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        """
+        Writes the entries to the journal file. The entries are copied under the lock, but written without holding
+        it, so uploads that finish meanwhile don't wait for the disk.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved:
+                    return
+                text = json.dumps(self._entries)
+                self._unsaved = 0
+                self._saved_at = time()
+
+            temp_path = self.journal_path + '.tmp'
+            with open(temp_path, 'w') as fout:
+                fout.write(text)
+            if os.path.exists(self.journal_path) and APP_SETTINGS.IS_WINDOWS:
+                os.remove(self.journal_path)
+            os.rename(temp_path, self.journal_path)
+
+    def Flush(self):
+        """
+        Writes the uploads recorded since the last save
+        """
+        self._save()
+
+    def IsUploaded(self, resource_id, file_path):
+        """
+        Checks whether the file, as it is on disk now, is the one last uploaded to the resource. The size and
+        modification time are compared first; the content hash is only computed if the file was rewritten.
+        """
+        entry = self._entries.get(resource_id, {}).get(os.path.basename(file_path))
+        if not isinstance(entry, dict) or not os.path.exists(file_path):
+            return False
+
+        stat = os.stat(file_path)
+        if entry.get('size') != stat.st_size:
+            return False
+        if entry.get('mtime') == stat.st_mtime:
+            return True
+
+        if entry.get('md5') != GetFileHash(file_path):
+            return False
+
+        # Same content in a regenerated file - remember the new modification time so the hash isn't needed next time
+        self.MarkUploaded(resource_id, file_path, entry['md5'])
+        return True
+
+    def MarkUploaded(self, resource_id, file_path, file_hash=None):
+        if file_hash is None:
+            file_hash = GetFileHash(file_path)
+        stat = os.stat(file_path)
+        with self._lock:
+            self._entries.setdefault(resource_id, {})[os.path.basename(file_path)] = {'size': stat.st_size,
+                                                                                      'mtime': stat.st_mtime,
+                                                                                      'md5': file_hash}
+            self._unsaved += 1
+            save = self._unsaved >= APP_SETTINGS.UPLOAD_JOURNAL_FLUSH_COUNT or \
+                time() - self._saved_at >= APP_SETTINGS.UPLOAD_JOURNAL_FLUSH_INTERVAL
+        if save:
+            self._save()
+
+    def ClearResource(self, resource_id):
+        with self._lock:
+            if self._entries.pop(resource_id, None) is None:
+                return
+            self._unsaved += 1
+        self._save()
+
+
 class HydroShareUtilityException(Exception):
     def __init__(self, *args):
         super(HydroShareUtilityException, self).__init__(*args)
@@ -417,33 +519,121 @@ class HydroShareUtility:
             filtered_resources.append(resource_object)
         return filtered_resources
 
-    def UploadFiles(self, files, resource):  # type: ([str], HydroShareResource) -> bool
+    def UploadFiles(self, files, resource, journal=None, workers=None, stop_check=None):  # type: ([str], HydroShareResource, UploadJournal, int, callable) -> bool
+        """
+        Uploads files to a resource, replacing files with the same name. Up to `workers` files are sent at the same
+        time, and each file is retried with an increasing delay before it is counted as failed.
+
+        :param journal: if given, files that are still on HydroShare with the same content - according to the
+                        journal or to the checksum reported by HydroShare - are skipped, and new uploads are recorded
+        :param stop_check: callable returning True when the remaining uploads should be abandoned
+        :return: True if every file was uploaded
+        """
         if self.auth is None:
             raise HydroShareUtilityException("Cannot modify resources without authentication")
+
+        if workers is None:
+            workers = APP_SETTINGS.UPLOAD_WORKERS
+
+        remote_files = {}
+        if journal is not None:
+            for remote_file in self.getResourceFileList(resource.id):
+                remote_files[os.path.basename(urllib.unquote(remote_file.get('url', '')))] = remote_file
+
+        upload_queue = Queue()
+        for csv_file in files:
+            if type(csv_file) != str:
+                csv_file = str(csv_file)
+
+            file_name = os.path.basename(csv_file)
+            if file_name in remote_files:
+                if journal.IsUploaded(resource.id, csv_file):
+                    print('File {} is unchanged on remote {}'.format(file_name, repr(resource)))
+                    continue
+
+                remote_checksum = remote_files[file_name].get('checksum')
+                if remote_checksum:
+                    file_hash = GetFileHash(csv_file)
+                    if remote_checksum == file_hash:
+                        print('File {} matches the checksum on remote {}'.format(file_name, repr(resource)))
+                        journal.MarkUploaded(resource.id, csv_file, file_hash)
+                        continue
+
+            upload_queue.put(csv_file)
+
+        failed_files = []
+        stopped = []
+
+        def upload_worker(client):
+            while True:
+                if stop_check is not None and stop_check():
+                    stopped.append(True)
+                    return
+                try:
+                    csv_file = upload_queue.get_nowait()
+                except Empty:
+                    return
+
+                if self._uploadFile(csv_file, resource, client):
+                    if journal is not None:
+                        journal.MarkUploaded(resource.id, csv_file)
+                else:
+                    failed_files.append(csv_file)
+
         try:
-            for csv_file in files:
+            # A client wraps a single requests session, which threads can't share, so each worker gets its own
+            thread_count = min(workers, upload_queue.qsize())
+            clients = [self.client] + [self._createClient() for _ in range(thread_count - 1)]
+            threads = [Thread(target=upload_worker, args=(client,)) for client in clients[:thread_count]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if journal is not None:
+                journal.Flush()
+
+        if len(failed_files):
+            print('Upload failed for {} file(s): {}'.format(len(failed_files),
+                                                            ', '.join([os.path.basename(f) for f in failed_files])))
+        return not len(failed_files) and not len(stopped)
+
+    def _createClient(self):  # type: () -> HydroShare
+        """
+        Returns a new client for the same server and account as `self.client`, with its own session
+        """
+        return HydroShare(hostname=self.client.hostname, port=getattr(self.client, 'port', None),
+                          use_https=self.client.use_https, verify=self.client.verify, auth=self.auth,
+                          prompt_auth=False)
+
+    def _uploadFile(self, csv_file, resource, client=None):  # type: (str, HydroShareResource, HydroShare) -> bool
+        if client is None:
+            client = self.client
+        file_name = os.path.basename(csv_file)
+        for attempt in range(APP_SETTINGS.UPLOAD_RETRIES + 1):
+            if attempt:
+                delay = APP_SETTINGS.UPLOAD_BACKOFF * (2 ** (attempt - 1))
+                print('Retrying upload of {} in {} seconds (attempt {})'.format(file_name, delay, attempt + 1))
+                sleep(delay)
+            try:
                 try:
-                    self.client.deleteResourceFile(resource.id, os.path.basename(csv_file))
+                    client.deleteResourceFile(resource.id, file_name)
                 except HydroShareNotFound:
                     pass
-                # except Exception as e:
-                #     if APP_SETTINGS.H2O_DEBUG and APP_SETTINGS.VERBOSE:
-                #         print 'File did not exist in remote: {}, {}'.format(type(e), e)
-                if type(csv_file) != str:
-                    csv_file = str(csv_file)
-                self.client.addResourceFile(resource.id, csv_file)
-
-                msg = "File {} uploaded to remote {}".format(os.path.basename(csv_file), repr(resource))
+                client.addResourceFile(resource.id, csv_file)
+
+                msg = "File {} uploaded to remote {}".format(file_name, repr(resource))
                 print(msg)
                 pub.sendMessage('logger', message=msg)
+                return True
 
-        except HydroShareException as e:
-            print("Upload failed - could not complete upload to HydroShare due to exception: {}".format(e))
-            return False
-        except KeyError as e:
-            print('Incorrectly formatted arguments given. Expected key not found: {}'.format(e))
-            return False
-        return True
+            except (HydroShareException, RequestException, IOError) as e:
+                print("Upload of {} failed - could not complete upload to HydroShare due to exception: {}".format(
+                    file_name, e))
+            except KeyError as e:
+                print('Incorrectly formatted arguments given. Expected key not found: {}'.format(e))
+                return False
+        return False
 
     def setResourcesAsPublic(self, resource_ids):
         if self.auth is None:
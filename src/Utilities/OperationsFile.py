@@ -0,0 +1,263 @@
+import datetime
+import json
+import os
+import shutil
+
+import dateutil.parser
+import jsonpickle
+
+from Common import APP_SETTINGS
+from Utilities.DatasetUtilities import H2OManagedResource, OdmDatasetConnection
+from Utilities.H2OSeries import H2OSeries
+from Utilities.HydroShareUtility import HydroShareAccountDetails, HydroShareResource, ResourceTemplate
+
+__title__ = 'Operations File'
+
+OPERATIONS_FILE_VERSION = 3
+
+
+class OperationsFileException(Exception):
+    """
+    Raised when an operations file exists but can't be used, e.g. it isn't valid JSON or was written by a newer
+    version. Such a file is never overwritten.
+    """
+    def __init__(self, *args):
+        super(OperationsFileException, self).__init__(*args)
+
+
+def _EncodeValue(value):
+    """
+    Converts an attribute value to plain JSON. Dates are kept as ISO strings, tuples and sets are tagged so they are
+    loaded as tuples and sets again, and anything else that JSON can't hold is stored with jsonpickle, so no
+    attribute is ever lost.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, list):
+        return [_EncodeValue(item) for item in value]
+    if isinstance(value, tuple):
+        return {'py/tuple': [_EncodeValue(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        # Sorted so an unchanged set is always written the same way
+        items = sorted([_EncodeValue(item) for item in value], key=lambda item: json.dumps(item, sort_keys=True))
+        return {'py/frozenset' if isinstance(value, frozenset) else 'py/set': items}
+    if isinstance(value, dict) and all(isinstance(key, basestring) for key in value):
+        return dict((key, _EncodeValue(item)) for key, item in value.iteritems())
+    if isinstance(value, datetime.datetime):
+        return {'py/datetime': value.isoformat()}
+    return {'py/jsonpickle': jsonpickle.encode(value)}
+
+
+def _DecodeValue(value):
+    if isinstance(value, list):
+        return [_DecodeValue(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1 and 'py/datetime' in value:
+            return dateutil.parser.parse(value['py/datetime'])
+        if len(value) == 1 and 'py/tuple' in value:
+            return tuple(_DecodeValue(item) for item in value['py/tuple'])
+        if len(value) == 1 and 'py/set' in value:
+            return set(_DecodeValue(item) for item in value['py/set'])
+        if len(value) == 1 and 'py/frozenset' in value:
+            return frozenset(_DecodeValue(item) for item in value['py/frozenset'])
+        if len(value) == 1 and 'py/jsonpickle' in value:
+            return jsonpickle.decode(value['py/jsonpickle'])
+        return dict((key, _DecodeValue(item)) for key, item in value.iteritems())
+    return value
+
+
+def _SetAttributes(obj, fields):
+    for name, value in fields.iteritems():
+        setattr(obj, str(name), _DecodeValue(value))
+    return obj
+
+
+class OperationsFile(object):
+    """
+    Reads and writes the operations file: database connections, HydroShare accounts, resource templates and managed
+    resources. The file is plain, versioned JSON with one entry per object, and is written to a temporary file that
+    then replaces the old one, so an interrupted save never leaves a broken file behind.
+
+    Saving only encodes the managed resources that changed since the last save - new ones, ones replaced by another
+    object and ones passed to `MarkChanged` - and doesn't touch the file at all if nothing changed. Files written
+    with jsonpickle (version 1) are converted when they are loaded.
+    """
+
+    # Section name: (function that creates an empty object, attributes that are not saved)
+    SCHEMA = {
+        'odm_connections': (lambda: OdmDatasetConnection(), ()),
+        'hydroshare_connections': (lambda: HydroShareAccountDetails(),
+                                   ('client_id', 'client_secret', 'CLIENT_ID', 'CLIENT_SECRET')),
+        'resource_templates': (lambda: ResourceTemplate(), ()),
+        'managed_resources': (lambda: H2OManagedResource(), ('resource', 'selected_series'))
+    }
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path if file_path is not None else APP_SETTINGS.SETTINGS_FILE_NAME
+        self._saved_text = None  # type: str
+        self._encoded_resources = {}  # type: dict[str, tuple(H2OManagedResource, str)]
+        self._changed_resources = set()  # type: set[str]
+        self._unreadable = False  # True once the file failed to load, so it is never saved over
+
+    def Load(self):
+        """
+        :return: dict with the 'odm_connections', 'hydroshare_connections', 'resource_templates' and
+                 'managed_resources' dicts, or None if the file is empty
+        :raises IOError: if the file doesn't exist or can't be opened
+        :raises OperationsFileException: if the file isn't valid JSON or was written by a newer version
+        """
+        try:
+            with open(self.file_path, 'r') as fin:
+                text = fin.read()
+        except IOError:
+            self._unreadable = os.path.exists(self.file_path)
+            raise
+
+        try:
+            data = json.loads(text) if len(text.strip()) else None
+        except ValueError as e:
+            self._unreadable = True
+            raise OperationsFileException('Operations file {} is not valid JSON: {}'.format(self.file_path, e))
+        if not isinstance(data, dict) or not len(data):
+            self._unreadable = False
+            return None
+
+        version = data.get('version', 1)
+        if version > OPERATIONS_FILE_VERSION:
+            self._unreadable = True
+            raise OperationsFileException('Operations file {} was written by a newer version (file version {})'.format(
+                self.file_path, version))
+
+        self._unreadable = False
+        self._changed_resources.clear()
+
+        if version == 1:
+            return self._MigrateVersion1(text)
+
+        self._saved_text = text
+        return self._Decode(data)
+
+    def MarkChanged(self, resource_id):
+        """
+        Makes the next save encode a managed resource again. Needed whenever a managed resource, its series or its
+        HydroShare resource is modified in place.
+        """
+        self._changed_resources.add(resource_id)
+
+    def Save(self, data):
+        """
+        :param data: dict with the same sections as `Load` returns
+        :return: True if the file was written, False if nothing had changed
+        :raises OperationsFileException: if the file exists but couldn't be loaded
+        """
+        if self._unreadable:
+            raise OperationsFileException('Operations file {} could not be loaded, so it will not be '
+                                          'overwritten'.format(self.file_path))
+
+        sections = ['"version": {}'.format(OPERATIONS_FILE_VERSION)]
+        for section in ['odm_connections', 'hydroshare_connections', 'resource_templates']:
+            _, excluded = OperationsFile.SCHEMA[section]
+            encoded = dict((name, self._EncodeObject(obj, excluded)) for name, obj in data.get(section, {}).iteritems())
+            sections.append('{}: {}'.format(json.dumps(section), json.dumps(encoded, sort_keys=True)))
+
+        # Managed resources are the bulk of the file, so only the ones that changed are encoded again
+        resources = []
+        encoded_resources = {}
+        for resource_id in sorted(data.get('managed_resources', {}).keys()):
+            managed_resource = data['managed_resources'][resource_id]
+            previous = self._encoded_resources.get(resource_id, None)
+            if previous is not None and previous[0] is managed_resource and \
+                    resource_id not in self._changed_resources:
+                encoded_resources[resource_id] = previous
+            else:
+                encoded = self._EncodeManagedResource(managed_resource)
+                encoded_resources[resource_id] = (managed_resource, json.dumps(encoded, sort_keys=True))
+            resources.append('{}: {}'.format(json.dumps(resource_id), encoded_resources[resource_id][1]))
+        self._encoded_resources = encoded_resources
+        self._changed_resources.clear()
+        sections.append('"managed_resources": {{{}}}'.format(', '.join(resources)))
+
+        text = '{{{}}}'.format(', '.join(sections))
+        if text == self._saved_text and os.path.exists(self.file_path):
+            return False
+
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as fout:
+            fout.write(text)
+        if os.path.exists(self.file_path) and APP_SETTINGS.IS_WINDOWS:
+            os.remove(self.file_path)
+        os.rename(temp_path, self.file_path)
+
+        self._saved_text = text
+        return True
+
+    @staticmethod
+    def _EncodeObject(obj, excluded=()):
+        return dict((name, _EncodeValue(value)) for name, value in vars(obj).iteritems() if name not in excluded)
+
+    @staticmethod
+    def _DecodeObject(section, fields):
+        factory, _ = OperationsFile.SCHEMA[section]
+        return _SetAttributes(factory(), fields)
+
+    def _EncodeManagedResource(self, managed_resource):
+        _, excluded = OperationsFile.SCHEMA['managed_resources']
+        encoded = self._EncodeObject(managed_resource, excluded)
+        encoded['resource'] = self._EncodeObject(managed_resource.resource) \
+            if managed_resource.resource is not None else None
+        encoded['selected_series'] = [self._EncodeObject(series) for series in
+                                      sorted(managed_resource.selected_series.itervalues(), key=lambda s: s.odm_id)]
+        return encoded
+
+    def _DecodeManagedResource(self, fields):
+        fields = dict(fields)
+        resource_fields = fields.pop('resource', None)
+        series_fields = fields.pop('selected_series', [])
+
+        managed_resource = self._DecodeObject('managed_resources', fields)
+        if resource_fields is not None:
+            managed_resource.resource = _SetAttributes(HydroShareResource({}), resource_fields)
+
+        for fields in series_fields:
+            series = _SetAttributes(H2OSeries(), fields)
+            managed_resource.selected_series[series.odm_id] = series
+        return managed_resource
+
+    def _Decode(self, data):
+        decoded = {}
+        for section in ['odm_connections', 'hydroshare_connections', 'resource_templates']:
+            decoded[section] = dict((name, self._DecodeObject(section, fields))
+                                    for name, fields in data.get(section, {}).iteritems())
+
+        decoded['managed_resources'] = {}
+        self._encoded_resources = {}
+        for resource_id, fields in data.get('managed_resources', {}).iteritems():
+            managed_resource = self._DecodeManagedResource(fields)
+            decoded['managed_resources'][resource_id] = managed_resource
+            self._encoded_resources[resource_id] = (managed_resource, json.dumps(fields, sort_keys=True))
+        return decoded
+
+    def _MigrateVersion1(self, text):
+        """
+        Reads a jsonpickle operations file, keys the selected series by their odm_id (as
+        utility-scripts/patch_series_id.py did by hand), keeps a copy of the old file next to it and rewrites it in
+        the current format
+        """
+        data = jsonpickle.decode(text)
+        if not isinstance(data, dict):
+            return None
+
+        for managed_resource in data.get('managed_resources', {}).itervalues():
+            selected_series = managed_resource.selected_series
+            managed_resource.selected_series = {}
+            for series in selected_series.itervalues():
+                series.SeriesID = series.odm_id
+                managed_resource.selected_series[series.odm_id] = series
+
+        backup_path = self.file_path + '.v1.bak'
+        shutil.copyfile(self.file_path, backup_path)
+        self.Save(data)
+        print('Converted operations file {} to version {}, the original was saved as {}'.format(
+            self.file_path, OPERATIONS_FILE_VERSION, backup_path))
+
+        return dict((section, data.get(section, {})) for section in OperationsFile.SCHEMA)
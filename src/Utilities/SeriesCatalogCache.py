@@ -0,0 +1,136 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+from threading import Lock
+
+from GAMUTRawData.odmdata import Series
+from Common import APP_SETTINGS
+
+__title__ = 'Series Catalog Cache'
+
+CATALOG_CACHE_VERSION = 1
+
+
+class CatalogSeries(object):
+    """
+    The series catalog entry of one series, with the same attribute names as `Series`, holding only what the series
+    grids and `OdmSeriesHelper.CreateH2OSeriesFromOdmSeries` read. `end_date_time` is kept as an ISO string.
+    """
+    __slots__ = ['id', 'site_id', 'site_code', 'site_name', 'variable_id', 'variable_code', 'variable_name',
+                 'method_id', 'method_description', 'source_id', 'source_description', 'quality_control_level_id',
+                 'quality_control_level_code', 'value_count', 'end_date_time']
+
+    def __init__(self, row):
+        for name, value in zip(CatalogSeries.__slots__, row):
+            setattr(self, name, value)
+
+    def get_odm_id(self):
+        return '{}_{}_{}_{}_{}'.format(self.site_id, self.variable_id, self.method_id,
+                                       self.source_id, self.quality_control_level_id)
+    odm_id = property(get_odm_id)
+
+    def ToRow(self):
+        return tuple(getattr(self, name) for name in CatalogSeries.__slots__)
+
+
+def _DateText(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+class SeriesCatalogCache:
+    """
+    Keeps a copy of a database's series catalog in a SQLite file under APP_SETTINGS.CATALOG_CACHE_DIR, so the series
+    grids can be filled before the database has answered. `Refresh` then brings the copy up to date by reading the
+    full entry only of the series that are new or whose value count or end date changed.
+    """
+
+    # Cache column: Series attribute
+    COLUMNS = [('SeriesID', 'id'),
+               ('SiteID', 'site_id'),
+               ('SiteCode', 'site_code'),
+               ('SiteName', 'site_name'),
+               ('VariableID', 'variable_id'),
+               ('VariableCode', 'variable_code'),
+               ('VariableName', 'variable_name'),
+               ('MethodID', 'method_id'),
+               ('MethodDescription', 'method_description'),
+               ('SourceID', 'source_id'),
+               ('SourceDescription', 'source_description'),
+               ('QualityControlLevelID', 'quality_control_level_id'),
+               ('QualityControlLevelCode', 'quality_control_level_code'),
+               ('ValueCount', 'value_count'),
+               ('EndDateTime', 'end_date_time')]
+
+    def __init__(self, connection):
+        """
+        :type connection: OdmDatasetConnection
+        """
+        # Connections with different names or logins that point to the same database share a cache
+        key = '{}|{}|{}|{}'.format(connection.engine, connection.address, connection.port, connection.database)
+        self.file_path = os.path.join(APP_SETTINGS.CATALOG_CACHE_DIR,
+                                      'catalog_{}.sqlite'.format(hashlib.md5(key).hexdigest()))
+        self._lock = Lock()
+
+    def _Connect(self):
+        connection = sqlite3.connect(self.file_path)
+        if connection.execute('PRAGMA user_version').fetchone()[0] != CATALOG_CACHE_VERSION:
+            connection.execute('DROP TABLE IF EXISTS SeriesCatalog')
+            connection.execute('CREATE TABLE SeriesCatalog ({})'.format(', '.join(
+                [SeriesCatalogCache.COLUMNS[0][0] + ' INTEGER PRIMARY KEY'] +
+                [name for name, _ in SeriesCatalogCache.COLUMNS[1:]])))
+            connection.execute('PRAGMA user_version = {}'.format(CATALOG_CACHE_VERSION))
+            connection.commit()
+        return connection
+
+    @staticmethod
+    def _ReadAll(connection):
+        statement = 'SELECT {} FROM SeriesCatalog'.format(', '.join(name for name, _ in SeriesCatalogCache.COLUMNS))
+        return [CatalogSeries(row) for row in connection.execute(statement)]
+
+    def Load(self):
+        """
+        :return: list of the cached CatalogSeries; empty if the database was never loaded before
+        """
+        with self._lock:
+            connection = self._Connect()
+            try:
+                return self._ReadAll(connection)
+            finally:
+                connection.close()
+
+    def Refresh(self, series_service):
+        """
+        Updates the cache from the database of `series_service`
+
+        :type series_service: SeriesService
+        :return: (list of the CatalogSeries that were added or changed, list of the odm_ids of the removed series)
+        """
+        remote = dict((series_id, (value_count, _DateText(end_date_time))) for series_id, value_count, end_date_time in
+                      series_service.get_series_catalog_rows([Series.id, Series.value_count, Series.end_date_time]))
+
+        with self._lock:
+            connection = self._Connect()
+            try:
+                cached = dict((series.id, series) for series in self._ReadAll(connection))
+                stale = set(series_id for series_id, version in remote.iteritems() if series_id not in cached or
+                            (cached[series_id].value_count, cached[series_id].end_date_time) != version)
+                removed = [series for series_id, series in cached.iteritems() if series_id not in remote]
+
+                changed = []
+                if len(stale):
+                    columns = [getattr(Series, name) for _, name in SeriesCatalogCache.COLUMNS]
+                    # One query for everything on the first load, rather than hundreds of batches
+                    rows = series_service.get_series_catalog_rows(columns, None if len(stale) > len(remote) / 2
+                                                                  else stale)
+                    changed = [CatalogSeries(row[:-1] + (_DateText(row[-1]),)) for row in rows if row[0] in stale]
+
+                connection.executemany('INSERT OR REPLACE INTO SeriesCatalog VALUES ({})'.format(
+                    ', '.join('?' * len(SeriesCatalogCache.COLUMNS))), [series.ToRow() for series in changed])
+                connection.executemany('DELETE FROM SeriesCatalog WHERE SeriesID = ?',
+                                       [(series.id,) for series in removed])
+                connection.commit()
+            finally:
+                connection.close()
+
+        return changed, [series.odm_id for series in removed]
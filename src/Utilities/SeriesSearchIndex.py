@@ -0,0 +1,80 @@
+from bisect import bisect_left
+
+__title__ = 'Series Search Index'
+
+
+class SeriesSearchIndex:
+    """
+    Inverted indexes over the ODM series shown in the series grids, one per facet, that answer prefix searches
+    without scanning every series.
+
+    A search is a list of terms that must all match. `facet:prefix` matches one facet, e.g. `site:LR_` or `qc:1`;
+    a term without a facet matches the site code or the variable code. Matching ignores case.
+    """
+
+    # Facet name: Series attribute, as shown in the grid columns
+    FACETS = {'site': 'site_code',
+              'variable': 'variable_code',
+              'qc': 'quality_control_level_code',
+              'source': 'source_description',
+              'method': 'method_description'}
+    FACET_ALIASES = {'var': 'variable', 'qcl': 'qc', 'src': 'source'}
+    FREE_TEXT_FACETS = ['site', 'variable']
+    # Descriptions are indexed word by word, since a search term can't contain spaces
+    WORD_FACETS = ['source', 'method']
+
+    def __init__(self, series_dict=None):
+        self._keys = {}  # type: dict[str, list[unicode]]
+        self._postings = {}  # type: dict[str, dict[unicode, set[str]]]
+        self.Build(series_dict if series_dict is not None else {})
+
+    def Build(self, series_dict):
+        """
+        :param series_dict: Series keyed by odm_id
+        """
+        for facet, attribute in SeriesSearchIndex.FACETS.iteritems():
+            postings = {}
+            for odm_id, series in series_dict.iteritems():
+                value = getattr(series, attribute, None)
+                key = SeriesSearchIndex._Key(value if value is not None else u'')
+                keys = key.split() if facet in SeriesSearchIndex.WORD_FACETS else [key]
+                for key in keys:
+                    postings.setdefault(key, set()).add(odm_id)
+            self._postings[facet] = postings
+            self._keys[facet] = sorted(postings)
+
+    @staticmethod
+    def _Key(value):
+        return (value if isinstance(value, unicode) else unicode(value)).lower()
+
+    def _PrefixMatches(self, facet, prefix):
+        keys = self._keys[facet]
+        postings = self._postings[facet]
+        matches = set()
+        index = bisect_left(keys, prefix)
+        while index < len(keys) and keys[index].startswith(prefix):
+            matches |= postings[keys[index]]
+            index += 1
+        return matches
+
+    def Search(self, text):
+        """
+        :return: set of the odm_ids of the matching series, or None if `text` has no terms (everything matches)
+        """
+        result = None
+        for term in SeriesSearchIndex._Key(text).split():
+            facet, separator, prefix = term.partition(':')
+            facet = SeriesSearchIndex.FACET_ALIASES.get(facet, facet)
+            if separator and facet in SeriesSearchIndex.FACETS:
+                if not prefix:
+                    continue  # Still typing the value
+                matches = self._PrefixMatches(facet, prefix)
+            else:
+                matches = set()
+                for facet in SeriesSearchIndex.FREE_TEXT_FACETS:
+                    matches |= self._PrefixMatches(facet, term)
+
+            result = matches if result is None else result & matches
+            if not result:
+                break
+        return result
@@ -0,0 +1,222 @@
+import cgi
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep, time
+
+from hs_restclient import HydroShare, HydroShareAuthBasic
+
+from Common import APP_SETTINGS
+from Utilities.HydroShareUtility import HydroShareResource, HydroShareUtility, UploadJournal
+
+file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+worker_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+flaky_failures = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+RESOURCE_ID = 'abcdef0123456789abcdef0123456789'
+FILES_URL = re.compile(r'^/hsapi/resource/(?P<pid>\w+)/files/(?P<name>[^/?]*)$')
+
+
+class StandInHydroShare(object):
+    """
+    Keeps the files of one resource in memory and fails the uploads it is told to, recording every attempt
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}             # file name -> content
+        self.failures = {}          # file name -> number of uploads still to fail, or -1 to always fail
+        self.attempts = {}          # file name -> times of each upload attempt
+        self.active_uploads = 0
+        self.peak_uploads = 0
+        self.upload_delay = 0.05    # Keeps each upload open long enough for concurrent uploads to overlap
+
+    def Reset(self):
+        with self.lock:
+            self.failures = {}
+            self.attempts = {}
+            self.peak_uploads = 0
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_version = 'StandInHydroShare/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, content=None):
+        body = json.dumps(content) if content is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _match(self):
+        match = FILES_URL.match(self.path)
+        if match is None or match.group('pid') != RESOURCE_ID:
+            self._reply(404, {'detail': 'Not found.'})
+            return None
+        return match
+
+    def do_GET(self):
+        if self.path.startswith('/hsapi/userInfo/'):
+            return self._reply(200, {'username': 'user', 'first_name': 'Stand', 'last_name': 'In', 'email': ''})
+        match = self._match()
+        if match is None:
+            return
+        state = self.server.state
+        with state.lock:
+            results = [{'url': 'http://localhost/django_irods/download/{}/data/contents/{}'.format(RESOURCE_ID, name),
+                        'size': len(content), 'content_type': 'text/csv',
+                        'checksum': hashlib.md5(content).hexdigest()} for name, content in state.files.items()]
+        self._reply(200, {'count': len(results), 'next': None, 'previous': None, 'results': results})
+
+    def do_DELETE(self):
+        match = self._match()
+        if match is None:
+            return
+        state = self.server.state
+        with state.lock:
+            if state.files.pop(match.group('name'), None) is None:
+                return self._reply(404, {'detail': 'Not found.'})
+        self._reply(200, {'resource_id': RESOURCE_ID, 'file_name': match.group('name')})
+
+    def do_POST(self):
+        match = self._match()
+        if match is None:
+            return
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+        file_name = form['file'].filename
+        content = form['file'].value
+
+        state = self.server.state
+        with state.lock:
+            state.attempts.setdefault(file_name, []).append(time())
+            state.active_uploads += 1
+            state.peak_uploads = max(state.peak_uploads, state.active_uploads)
+            remaining = state.failures.get(file_name, 0)
+            if remaining > 0:
+                state.failures[file_name] = remaining - 1
+        sleep(state.upload_delay)
+        with state.lock:
+            state.active_uploads -= 1
+            if not remaining:
+                state.files[file_name] = content
+
+        if remaining:
+            return self._reply(500, {'detail': 'Stand-in failure'})
+        self._reply(201, {'resource_id': RESOURCE_ID, 'file_name': file_name})
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def write_file(file_path, content):
+    with open(file_path, 'w') as fout:
+        fout.write(content)
+
+
+def check(condition, message):
+    if not condition:
+        print('ERROR: {}'.format(message))
+        sys.exit(1)
+
+
+server = StandInServer(('localhost', 0), StandInHandler)
+server.state = StandInHydroShare()
+server_thread = Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+port = server.server_address[1]
+
+APP_SETTINGS.UPLOAD_RETRIES = 3
+APP_SETTINGS.UPLOAD_BACKOFF = 0.1
+
+utility = HydroShareUtility()
+utility.auth = HydroShareAuthBasic('user', 'password')
+utility.client = HydroShare(hostname='localhost', port=port, use_https=False, auth=utility.auth)
+resource = HydroShareResource({'resource_id': RESOURCE_ID})
+state = server.state
+
+work_dir = tempfile.mkdtemp()
+try:
+    journal_path = os.path.join(work_dir, 'upload_journal.json')
+    files = []
+    for index in range(file_count):
+        file_path = os.path.join(work_dir, 'Series_{}.csv'.format(index))
+        write_file(file_path, '# Series {}\nLocalDateTime,Value\n2017-01-01 00:00:00,{}\n'.format(index, index))
+        files.append(file_path)
+    names = [os.path.basename(f) for f in files]
+    flaky_names = names[:2]
+    broken_name = names[-1]
+
+    print('- Uploading {} files with {} workers to a stand-in server on port {}'.format(file_count, worker_count, port))
+    for name in flaky_names:
+        state.failures[name] = flaky_failures
+    state.failures[broken_name] = -1
+    uploaded = utility.UploadFiles(files, resource, journal=UploadJournal(journal_path), workers=worker_count)
+    check(not uploaded, 'UploadFiles reported success although {} could not be uploaded'.format(broken_name))
+    check(state.peak_uploads <= worker_count and (worker_count == 1 or state.peak_uploads > 1),
+          '{} uploads ran at the same time with {} workers'.format(state.peak_uploads, worker_count))
+    print('-- At most {} uploads ran at the same time'.format(state.peak_uploads))
+
+    for name in flaky_names:
+        attempts = state.attempts.get(name, [])
+        check(len(attempts) == flaky_failures + 1, '{} was sent {} times'.format(name, len(attempts)))
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        for retry, gap in enumerate(gaps):
+            expected = APP_SETTINGS.UPLOAD_BACKOFF * (2 ** retry)
+            check(gap >= expected, 'Retry {} of {} came after {:.2f}s instead of {:.2f}s'.format(retry + 1, name,
+                                                                                                  gap, expected))
+    print('-- Flaky files were retried with delays of {}'.format(
+        ', '.join(['{:.2f}s'.format(APP_SETTINGS.UPLOAD_BACKOFF * (2 ** retry)) for retry in range(flaky_failures)])))
+    check(len(state.attempts.get(broken_name, [])) == APP_SETTINGS.UPLOAD_RETRIES + 1,
+          '{} was sent {} times'.format(broken_name, len(state.attempts.get(broken_name, []))))
+    print('-- The failing file was given up after {} attempts'.format(APP_SETTINGS.UPLOAD_RETRIES + 1))
+    check(sorted(state.files) == sorted(names[:-1]), 'The server has {}'.format(sorted(state.files)))
+
+    print('- Resuming after the server recovered')
+    state.Reset()
+    uploaded = utility.UploadFiles(files, resource, journal=UploadJournal(journal_path), workers=worker_count)
+    check(uploaded, 'UploadFiles reported a failure on the resumed upload')
+    check(list(state.attempts) == [broken_name], 'The resumed upload sent {}'.format(sorted(state.attempts)))
+    print('-- Only {} was sent again'.format(broken_name))
+
+    print('- Re-uploading after one file changed')
+    state.Reset()
+    sleep(1)  # Some file systems only keep modification times to the second
+    write_file(files[0], '# Series 0\nLocalDateTime,Value\n2017-01-01 00:00:00,100\n')
+    uploaded = utility.UploadFiles(files, resource, journal=UploadJournal(journal_path), workers=worker_count)
+    check(uploaded and list(state.attempts) == [names[0]], 'The changed file upload sent {}'.format(
+        sorted(state.attempts)))
+    print('-- Only {} was sent again'.format(names[0]))
+
+    print('- Uploading with a new journal to a resource that already has the files')
+    state.Reset()
+    os.remove(journal_path)
+    uploaded = utility.UploadFiles(files, resource, journal=UploadJournal(journal_path), workers=worker_count)
+    check(uploaded and not state.attempts, 'Files matching the remote checksums were sent: {}'.format(
+        sorted(state.attempts)))
+    print('-- Every file matched its remote checksum and none were sent')
+
+    print('- Stopping an upload')
+    state.Reset()
+    uploaded = utility.UploadFiles(files, resource, workers=worker_count, stop_check=lambda: True)
+    check(not uploaded and not state.attempts, 'A stopped upload sent {}'.format(sorted(state.attempts)))
+    print('-- No files were sent after the stop was requested')
+finally:
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(work_dir)
+
+print('DONE!')
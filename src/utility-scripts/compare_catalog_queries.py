@@ -0,0 +1,129 @@
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+from sqlalchemy import distinct
+
+from GAMUTRawData.odmdata import Base, Series, Site, SpatialReference, Unit, Variable, engine_registry
+from GAMUTRawData.odmservices import SeriesService
+
+site_counts = [int(count) for count in sys.argv[1].split(',')] if len(sys.argv) > 1 else [10, 100, 500]
+variables_per_site = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+
+def seed_database(connection_string, site_count):
+    """
+    Creates the ODM tables the catalog queries read and fills them with `site_count` sites, each with a series for
+    `variables_per_site` of the variables
+    """
+    engine = engine_registry.get_engine(connection_string)
+    Base.metadata.create_all(engine, tables=[SpatialReference.__table__, Unit.__table__, Site.__table__,
+                                             Variable.__table__, Series.__table__])
+    variable_count = max(variables_per_site, site_count)
+    connection = engine.connect()
+    with connection.begin():
+        connection.execute(SpatialReference.__table__.insert(), [{'SpatialReferenceID': 1, 'SRSID': 4269,
+                                                                  'SRSName': 'NAD83', 'IsGeographic': True}])
+        connection.execute(Unit.__table__.insert(), [
+            {'UnitsID': 1, 'UnitsName': 'degree celsius', 'UnitsType': 'Temperature', 'UnitsAbbreviation': 'degC'},
+            {'UnitsID': 2, 'UnitsName': 'minute', 'UnitsType': 'Time', 'UnitsAbbreviation': 'min'}])
+        connection.execute(Site.__table__.insert(), [
+            {'SiteID': site_id, 'SiteCode': 'Site{}'.format(site_id), 'SiteName': 'Site {}'.format(site_id),
+             'Latitude': 41.0, 'Longitude': -111.0, 'LatLongDatumID': 1, 'LocalProjectionID': 1}
+            for site_id in range(1, site_count + 1)])
+        connection.execute(Variable.__table__.insert(), [
+            {'VariableID': variable_id, 'VariableCode': 'Variable{}'.format(variable_id),
+             'VariableName': 'Temperature', 'Speciation': 'Not Applicable', 'VariableUnitsID': 1,
+             'SampleMedium': 'Surface water', 'ValueType': 'Field Observation', 'IsRegular': True,
+             'TimeSupport': 15, 'TimeUnitsID': 2, 'DataType': 'Average', 'GeneralCategory': 'Hydrology',
+             'NoDataValue': -9999} for variable_id in range(1, variable_count + 1)])
+        connection.execute(Series.__table__.insert(), [
+            {'SiteID': site_id, 'SiteCode': 'Site{}'.format(site_id),
+             'VariableID': (site_id + offset) % variable_count + 1, 'MethodID': 1, 'SourceID': 1,
+             'QualityControlLevelID': 1, 'ValueCount': 1000}
+            for site_id in range(1, site_count + 1) for offset in range(variables_per_site)])
+    connection.close()
+
+
+def old_used_sites(series_service):
+    """
+    get_used_sites as it was before it became one query: the used ids, then one SELECT per id
+    """
+    session = series_service._edit_session
+    site_ids = [x[0] for x in session.query(distinct(Series.site_id)).all()]
+    return [session.query(Site).filter_by(id=site_id).first() for site_id in site_ids]
+
+
+def old_used_variables(series_service):
+    session = series_service._edit_session
+    variable_ids = [x[0] for x in session.query(distinct(Series.variable_id)).all()]
+    return [session.query(Variable).filter_by(id=variable_id).first() for variable_id in variable_ids]
+
+
+def old_variables_by_site_code(series_service, site_code):
+    session = series_service._edit_session
+    variable_ids = [x[0] for x in session.query(distinct(Series.variable_id)).filter_by(site_code=site_code).all()]
+    return [session.query(Variable).filter_by(id=variable_id).first() for variable_id in variable_ids]
+
+
+def measure(series_service, description, function):
+    """
+    Runs `function` and reads the relationships the GUI reads, counting the statements sent to the database
+    """
+    start = time()
+    with series_service.count_statements() as counter:
+        result = function()
+        for obj in result or []:
+            if isinstance(obj, Site):
+                obj.spatial_ref, obj.local_spatial_ref
+            else:
+                obj.variable_unit, obj.time_unit
+    print('-- {}: {} objects, {} statements, {:.3f} seconds'.format(description, len(result or []), counter.count,
+                                                                    time() - start))
+    return result, counter.count
+
+
+output_dir = tempfile.mkdtemp()
+try:
+    for site_count in site_counts:
+        connection_string = 'sqlite:///{}'.format(os.path.join(output_dir, 'odm_{}.sqlite'.format(site_count)))
+        print('- Seeding an ODM database with {} sites and {} series'.format(site_count,
+                                                                            site_count * variables_per_site))
+        seed_database(connection_string, site_count)
+        site_code = 'Site{}'.format(site_count)
+
+        series_service = SeriesService(connection_string)
+        old_sites, _ = measure(series_service, 'get_used_sites, one SELECT per id',
+                               lambda: old_used_sites(series_service))
+        old_variables, _ = measure(series_service, 'get_used_variables, one SELECT per id',
+                                   lambda: old_used_variables(series_service))
+        old_site_variables, _ = measure(series_service, 'get_variables_by_site_code, one SELECT per id',
+                                        lambda: old_variables_by_site_code(series_service, site_code))
+        series_service.close()
+
+        series_service = SeriesService(connection_string)
+        series_service.clear_catalog_cache()
+        new_sites, site_statements = measure(series_service, 'get_used_sites', series_service.get_used_sites)
+        new_variables, variable_statements = measure(series_service, 'get_used_variables',
+                                                     series_service.get_used_variables)
+        new_site_variables, site_variable_statements = measure(
+            series_service, 'get_variables_by_site_code', lambda: series_service.get_variables_by_site_code(site_code))
+        _, cached_statements = measure(series_service, 'get_used_sites again, from the catalog cache',
+                                       series_service.get_used_sites)
+        series_service.close()
+
+        if sorted(site.id for site in new_sites) != sorted(site.id for site in old_sites) or \
+                sorted(v.id for v in new_variables) != sorted(v.id for v in old_variables) or \
+                sorted(v.id for v in new_site_variables) != sorted(v.id for v in old_site_variables):
+            print('ERROR: The catalog queries returned different objects')
+            sys.exit(1)
+        if max(site_statements, variable_statements, site_variable_statements) > 1 or cached_statements:
+            print('ERROR: The catalog queries should take one statement each, and none from the cache')
+            sys.exit(1)
+        engine_registry.dispose(connection_string)
+finally:
+    shutil.rmtree(output_dir)
+
+print('DONE! Each catalog query took one statement, whatever the number of sites')
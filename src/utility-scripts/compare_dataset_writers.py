@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from Utilities.DatasetWriters import DATASET_FORMATS, DATASET_WRITERS, GetDatasetWriter
+
+column_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+value_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+
+print('- Building a dataset with {} columns and {} rows'.format(column_count, value_count))
+local_times = pd.date_range('2015-01-01', periods=value_count, freq='15min')
+index = pd.MultiIndex.from_arrays([local_times, np.repeat(-7.0, value_count), local_times + pd.Timedelta(hours=7)],
+                                  names=["LocalDateTime", "UTCOffset", "DateTimeUTC"])
+values = np.round(np.random.rand(value_count, column_count) * 100, 4)
+# Fill some of the values with the no-data value, as a joined file would
+values[np.random.rand(value_count, column_count) < 0.1] = -9999
+dataframe = pd.DataFrame(values, index=index, columns=['Variable{}'.format(column) for column in range(column_count)])
+chunks = [dataframe.iloc[start:start + chunk_size] for start in range(0, value_count, chunk_size)]
+headers = '# Site: Benchmark\n# Generated by compare_dataset_writers.py\n'
+
+output_dir = tempfile.mkdtemp()
+try:
+    # What WriteSeriesToFile wrote before the writers existed, to check that CSV files haven't changed
+    expected_path = os.path.join(output_dir, 'expected.csv')
+    with open(expected_path, 'w') as file_out:
+        file_out.write(headers)
+        chunks[0].to_csv(file_out)
+        for chunk in chunks[1:]:
+            chunk.to_csv(file_out, header=False)
+
+    csv_size = None
+    for file_format in DATASET_FORMATS:
+        writer_class = DATASET_WRITERS[file_format]
+        if not writer_class.IsAvailable():
+            print('- Skipping {}: its package is not installed'.format(writer_class.DESCRIPTION))
+            continue
+
+        print('- Writing {}'.format(writer_class.DESCRIPTION))
+        file_path = os.path.join(output_dir, 'dataset.{}'.format(writer_class.EXTENSION))
+        start = time()
+        writer = GetDatasetWriter(file_format)
+        if not writer.Open(file_path, headers):
+            print('ERROR: Unable to create {}'.format(file_path))
+            sys.exit(1)
+        for chunk in chunks:
+            writer.Write(chunk)
+        writer.Close()
+        elapsed = time() - start
+
+        file_size = os.path.getsize(file_path)
+        if csv_size is None:
+            csv_size = file_size
+        print('-- {:.2f} seconds, {:.2f} MB ({:.0%} of the CSV file)'.format(elapsed, file_size / 1048576.0,
+                                                                           file_size / float(csv_size)))
+
+        if file_format == 'csv':
+            with open(file_path, 'rb') as written, open(expected_path, 'rb') as expected:
+                if written.read() != expected.read():
+                    print('ERROR: The CSV file is different from what WriteSeriesToFile used to write')
+                    sys.exit(1)
+            print('-- Identical to the CSV file written without a writer')
+finally:
+    shutil.rmtree(output_dir)
+
+print('DONE!')
@@ -0,0 +1,50 @@
+import sys
+from StringIO import StringIO
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from Utilities.DatasetUtilities import JoinSeriesColumns
+
+series_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+value_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+print('- Building {} series with {} values each'.format(series_count, value_count))
+frames = []
+for series_number in range(series_count):
+    local_times = pd.date_range('2015-01-01', periods=value_count, freq='15min')
+    # Leave gaps so the series don't all share the same timestamps
+    keep = np.random.rand(value_count) > 0.1
+    frames.append(pd.DataFrame({'LocalDateTime': local_times[keep],
+                                'UTCOffset': -7.0,
+                                'DateTimeUTC': local_times[keep] + pd.Timedelta(hours=7),
+                                'DataValue': np.random.rand(keep.sum()) * 100,
+                                'VariableCode': 'Variable{}'.format(series_number % 5),
+                                'MethodID': series_number}))
+dataframe = pd.concat(frames, ignore_index=True).sort_values(['LocalDateTime', 'UTCOffset', 'DateTimeUTC'])
+
+print('- Pivoting with pd.pivot_table')
+start = time()
+pivot_table = pd.pivot_table(dataframe,
+                             index=["LocalDateTime", "UTCOffset", "DateTimeUTC"],
+                             columns=['VariableCode', 'MethodID'],
+                             values='DataValue')
+pivot_table.fillna(value=-9999, inplace=True)
+pivot_output = StringIO()
+pivot_table.to_csv(pivot_output)
+print('-- {:.2f} seconds'.format(time() - start))
+
+print('- Joining with JoinSeriesColumns')
+start = time()
+joined_table = JoinSeriesColumns(dataframe)
+joined_table.fillna(value=-9999, inplace=True)
+joined_output = StringIO()
+joined_table.to_csv(joined_output)
+print('-- {:.2f} seconds'.format(time() - start))
+
+if pivot_output.getvalue() == joined_output.getvalue():
+    print('DONE! Both files are identical')
+else:
+    print('ERROR: The files are different')
+    sys.exit(1)